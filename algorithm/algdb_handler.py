@@ -9,6 +9,8 @@ from mongoengine import *
 from bin.start import switch
 from bin.mongodb_driver import MongoDBDriver
 from handler.iddb_handler import TwseIdDBHandler, OtcIdDBHandler
+from handler.registry import get_handler
+from handler.profiler import profiled
 from handler.tasks import *
 from itertools import product
 from zipline.finance.trading import SimulationParameters
@@ -34,6 +36,7 @@ class TwseAlgDBHandler(object):
             'stockids': kwargs.pop('stockids', []),
             'traderids': kwargs.pop('traderids', []),
             'limit': kwargs.pop('limit', 10),
+            'source': kwargs.pop('source', 'mongo'),
             'debug': self._debug
         }
         db = "twsealgdb"
@@ -41,7 +44,7 @@ class TwseAlgDBHandler(object):
         host, port = MongoDBDriver._host, MongoDBDriver._port
         connect(db, host=host, port=port, alias=db)
         self._algcoll = switch(AlgStrategyColl, db)
-        self._id = TwseIdDBHandler(debug=self._debug, opt='twse')
+        self._id = get_handler(TwseIdDBHandler, debug=self._debug, opt='twse')
         self._report = Report(alg, sort=[('buys', False), ('sells', False), ('portfolio_value', False)], limit=100)
 
     @property
@@ -120,6 +123,7 @@ class TwseAlgDBHandler(object):
                 retval.append(coll)
         return retval
 
+    @profiled('algsummary', lambda self: self._algcoll._get_db())
     def query_summary(self, starttime, endtime, cfg, constraint=None, order=None, limit=10, callback=None):
         """ return orm
         <algorithm>
@@ -234,4 +238,4 @@ class OtcAlgDBHandler(TwseAlgDBHandler):
         host, port = MongoDBDriver._host, MongoDBDriver._port
         connect(db, host=host, port=port, alias=db)
         self._sumycoll = switch(AlgSummaryColl, db)
-        self._id = OtcIdDBHandler(debug=self._debug, opt='otc')
+        self._id = get_handler(OtcIdDBHandler, debug=self._debug, opt='otc')
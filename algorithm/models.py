@@ -22,7 +22,7 @@ class AlgSummaryColl(EmbeddedDocument):
     meta = {
         'allow_inheritance': True,
         'indexes': [(
-            'portfolio_value', 'capital_used'
+            'portfolio_value', 'capital_used',
             'ending_cash',  'buys', 'sells', 'max_drawdown'
         )],
         'ordering': [('-portfolio_value', '-capital_used', '-max_drawdown')]
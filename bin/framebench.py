@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# seconds to turn query_raw items into pandas, in memory, no db
+# rows:  per-stock DataFrame builder the long frame replaced, as Panel
+# frame: one pass handler.frame.to_frame long frame
+# panel: to_frame plus the to_panel compat view
+# python bin/framebench.py --stocks 1000 --days 250
+
+import argparse
+import time
+import pytz
+import pandas as pd
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+from handler.frame import to_frame, to_panel
+
+__all__ = ['fixture', 'to_panel_rows', 'bench']
+
+
+def fixture(stocks=1000, days=250):
+    """ query_raw like stock items of stocks over days """
+    dates = [datetime(2015, 1, 1) + timedelta(days=i) for i in range(days)]
+    return [{
+        'stockid': "%04d" % (s),
+        'datalist': [{
+            'date': d, 'open': 10.0, 'high': 11.0, 'low': 9.0, 'close': 10.0 + s % 7, 'price': 10.0, 'volume': s + i
+        } for i, d in enumerate(dates)]
+    } for s in range(stocks)]
+
+
+def to_panel_rows(cursor):
+    """ row by row Panel builder as before to_frame, one DataFrame per stock """
+    item = OrderedDict()
+    for it in cursor:
+        index, data = [], []
+        for i in it['datalist']:
+            i = dict(i)
+            date = i.pop('date', None)
+            if date:
+                index.append(pytz.timezone('UTC').localize(date))
+                data.append(i)
+        if index and data:
+            item.update({it['stockid']: pd.DataFrame(data, index=index).fillna(0)})
+    return pd.Panel(item)
+
+
+def _time(fn, repeat):
+    start = time.time()
+    for i in range(repeat):
+        fn()
+    return (time.time() - start) / repeat
+
+
+def bench(stocks=1000, days=250, repeat=3):
+    """ [(builder, rows, secs)] """
+    cursor = fixture(stocks, days)
+    builders = [
+        ('rows', lambda: to_panel_rows(cursor)),
+        ('frame', lambda: to_frame(cursor, 'stockid')),
+        ('panel', lambda: to_panel(to_frame(cursor, 'stockid')))
+    ]
+    return [(name, stocks * days, _time(fn, repeat)) for name, fn in builders]
+
+
+def report(rows):
+    print "%-10s %10s %10s" % ('builder', 'rows', 'secs')
+    for name, n, secs in rows:
+        print "%-10s %10d %10.3f" % (name, n, secs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='seconds of query_raw items to pandas builders')
+    parser.add_argument('--stocks', dest='stocks', type=int, default=1000, help='fixture stocks')
+    parser.add_argument('--days', dest='days', type=int, default=250, help='fixture days')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3, help='runs per builder')
+    args = parser.parse_args()
+    report(bench(args.stocks, args.days, args.repeat))
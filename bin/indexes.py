@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+# index advisor and provisioning of his/id/alg colls
+# every query shape the handlers issue is listed in shapes below with the index it needs,
+#   advise    declared/needed indexes missing on the server, plus how often each shape
+#             showed up in the profiler metrics log (bin/querystats.py)
+#   provision build the missing ones in the background, reads keep going meanwhile
+#   bench     fill a fixture db, time every shape without and with its index,
+#             report index size against speedup
+# python bin/indexes.py advise --opt twse
+# python bin/indexes.py provision --opt all
+# python bin/indexes.py bench --stocks 200 --days 250
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from mongoengine import *
+from bin.start import switch
+from bin.mongodb_driver import MongoDBDriver
+from handler.models import *
+from handler.profiler import read_log
+from algorithm.models import AlgStrategyColl
+
+__all__ = ['shapes', 'advise', 'provision', 'bench', 'fixture']
+
+colls = {
+    'twse': {
+        'db': 'twsehisdb',
+        'stock': TwseHisStockColl,
+        'trader': TwseHisTraderColl,
+        'credit': TwseHisCreditColl,
+        'future': TwseHisFutureColl,
+        'inverted': TwseTraderStockColl,
+        'summary': TwseHisSummaryColl,
+        'latest': TwseHisLatestColl,
+        'rollup': TwseHisRollupColl
+    },
+    'otc': {
+        'db': 'otchisdb',
+        'stock': OtcHisStockColl,
+        'trader': OtcHisTraderColl,
+        'credit': OtcHisCreditColl,
+        'future': OtcHisFutureColl,
+        'inverted': OtcTraderStockColl,
+        'summary': OtcHisSummaryColl,
+        'latest': OtcHisLatestColl,
+        'rollup': OtcHisRollupColl
+    }
+}
+
+# other colls, db -> {target: coll}
+extras = {
+    'twseiddb': {'stockid': TwseIdColl},
+    'otciddb': {'stockid': OtcIdColl},
+    'traderiddb': {'traderid': TraderIdColl},
+    'twsealgdb': {'alg': AlgStrategyColl}
+}
+
+# (target, shape name, index keys, filter of (starttime, endtime, stockids, traderids))
+# stockids: query_raw/to_array of given stocks
+# market: no stockids, a whole market window as summary/rollup build, calendar, archive freeze
+# traderids: trader query_raw on toplist docs, multikey toplist.traderid
+# inverted: trader query_raw with base='trader' on the inverted coll
+window = lambda s, e: {'$gte': s, '$lte': e}
+shapes = [
+    (target, 'stockids', [('stockid', 1), ('date', 1)],
+        lambda s, e, ids, tids: {'stockid': {'$in': ids}, 'date': window(s, e)})
+    for target in ['stock', 'trader', 'credit', 'future']
+] + [
+    (target, 'market', [('date', 1), ('stockid', 1)],
+        lambda s, e, ids, tids: {'date': window(s, e)})
+    for target in ['stock', 'trader', 'credit', 'future']
+] + [
+    ('trader', 'traderids', [('toplist.traderid', 1), ('date', 1)],
+        lambda s, e, ids, tids: {'toplist.traderid': {'$in': tids}, 'date': window(s, e)}),
+    ('inverted', 'traderids', [('traderid', 1), ('date', 1), ('stockid', 1)],
+        lambda s, e, ids, tids: {'traderid': {'$in': tids}, 'date': window(s, e)}),
+    ('summary', 'market', [('window', 1), ('date', 1)],
+        lambda s, e, ids, tids: {'window': 5, 'date': window(s, e)}),
+    ('rollup', 'stockids', [('frequency', 1), ('stockid', 1), ('date', 1)],
+        lambda s, e, ids, tids: {'frequency': 'week', 'stockid': {'$in': ids}, 'date': window(s, e)})
+]
+
+
+def _connect(db):
+    host, port = MongoDBDriver._host, MongoDBDriver._port
+    connect(db, host=host, port=port, alias=db)
+
+
+def targets(opt='twse', debug=False):
+    """ {(db, target): coll} of opt his db and the id/alg dbs """
+    retval = {}
+    db = colls[opt]['db'] if not debug else 'test' + colls[opt]['db']
+    _connect(db)
+    for k, coll in colls[opt].items():
+        if k != 'db':
+            retval[(db, k)] = switch(coll, db)
+    for db, items in extras.items():
+        db = db if not debug else 'test' + db
+        _connect(db)
+        for k, coll in items.items():
+            retval[(db, k)] = switch(coll, db)
+    return retval
+
+
+def needed(coll, target):
+    """ declared meta indexes of coll and shape indexes of target, as key lists """
+    retval = [spec['fields'] for spec in coll._meta.get('index_specs', [])]
+    retval += [keys for t, name, keys, query in shapes if t == target]
+    # full key lists, a _cls prefixed index doesn't serve raw queries without _cls
+    retval = [[(k, d) for k, d in keys] for keys in retval]
+    uniq = []
+    for keys in retval:
+        if keys not in uniq:
+            uniq.append(keys)
+    return uniq
+
+
+def existing(coll):
+    """ key lists of indexes on the server """
+    info = coll._get_collection().index_information()
+    return [[(k, int(d)) for k, d in it['key']] for it in info.values()]
+
+
+def covered(keys, indexes):
+    """ keys is a prefix of some index """
+    return any(it[:len(keys)] == keys for it in indexes)
+
+
+def seen(path=None):
+    """ {(target, shape name): calls} of the profiler log """
+    retval = {}
+    for it in read_log(path):
+        if it['target'] in ['stock', 'trader', 'credit', 'future']:
+            name = 'stockids' if it['stockids'] else 'market'
+            if it['target'] == 'trader' and it.get('traderids', 0):
+                name = 'traderids'
+        elif it['target'] in ['summary', 'rollup']:
+            name = 'market' if it['target'] == 'summary' else 'stockids'
+        else:
+            continue
+        retval[(it['target'], name)] = retval.get((it['target'], name), 0) + 1
+    return retval
+
+
+def advise(opt='twse', debug=False, path=None):
+    """ [(db, target, index keys, calls seen)] not on the server yet """
+    calls = seen(path)
+    retval = []
+    for (db, target), coll in sorted(targets(opt, debug).items()):
+        indexes = existing(coll)
+        for keys in needed(coll, target):
+            if not covered(keys, indexes):
+                n = sum(v for (t, name), v in calls.items()
+                    if t == target and any(s[1] == name and s[2] == keys for s in shapes if s[0] == t))
+                retval.append((db, target, keys, n))
+    return sorted(retval, key=lambda x: -x[3])
+
+
+def provision(opt='twse', debug=False):
+    """ build missing indexes in the background, return [(db, target, index name)] """
+    found, retval = targets(opt, debug), []
+    for db, target, keys, n in advise(opt, debug):
+        name = found[(db, target)]._get_collection().create_index(keys, background=True)
+        print "%s.%s built %s" % (db, target, name)
+        retval.append((db, target, name))
+    return retval
+
+
+def fixture(db, stocks=200, days=250, traders=100, batch=5000):
+    """ synthetic stock/trader/inverted docs of stocks over days business days in db,
+    tagged with twse _cls so mongoengine querysets see them too
+    """
+    _connect(db)
+    classes = {k: switch(colls['twse'][k], db) for k in ['stock', 'trader', 'inverted']}
+    stock, trader, inverted = [classes[k]._get_collection() for k in ['stock', 'trader', 'inverted']]
+    for coll in [stock, trader, inverted]:
+        coll.drop()
+    rnd = random.Random(0)
+    date, dates = datetime(2014, 1, 1), []
+    while len(dates) < days:
+        if date.weekday() < 5:
+            dates.append(date)
+        date += timedelta(days=1)
+    docs = {'stock': [], 'trader': [], 'inverted': []}
+
+    def flush(force=False):
+        for k, coll in [('stock', stock), ('trader', trader), ('inverted', inverted)]:
+            if docs[k] and (force or len(docs[k]) >= batch):
+                coll.insert(docs[k])
+                docs[k] = []
+
+    for i in range(stocks):
+        stockid = '%04d' % (1000 + i)
+        close = rnd.uniform(10, 500)
+        for date in dates:
+            close = max(1.0, close * rnd.uniform(0.93, 1.07))
+            data = {'open': close, 'high': close * 1.02, 'low': close * 0.98, 'close': close, 'volume': rnd.randint(100, 99999)}
+            toplist = []
+            for tid in rnd.sample(range(traders), 5):
+                it = {'traderid': '%04d' % (tid), 'data': {'buyvolume': rnd.randint(0, 999), 'sellvolume': rnd.randint(0, 999)}}
+                toplist.append(it)
+                docs['inverted'].append({
+                    '_cls': classes['inverted']._class_name, 'traderid': it['traderid'], 'stockid': stockid,
+                    'date': date, 'volume': data['volume'], 'data': it['data']})
+            docs['stock'].append({'_cls': classes['stock']._class_name, 'stockid': stockid, 'date': date, 'data': data})
+            docs['trader'].append({'_cls': classes['trader']._class_name, 'stockid': stockid, 'date': date, 'data': data, 'toplist': toplist})
+            flush()
+    flush(True)
+    return dates
+
+
+def _time(collection, query, repeat):
+    start = time.time()
+    for i in range(repeat):
+        list(collection.find(query, {'_id': 1}))
+    plan = collection.find(query).explain()
+    examined = plan.get('nscannedObjects', plan.get('executionStats', {}).get('totalDocsExamined', None))
+    return (time.time() - start) * 1000 / repeat, examined
+
+
+def bench(stocks=200, days=250, repeat=5, debug=False):
+    """ [(target, shape, index name, index bytes, ms without, ms with, docs examined without/with)] """
+    db = 'benchtwsehisdb' if not debug else 'testbenchtwsehisdb'
+    dates = fixture(db, stocks, days)
+    starttime, endtime = dates[-20], dates[-1]
+    stockids = ['%04d' % (1000 + i) for i in range(0, stocks, max(stocks // 10, 1))]
+    traderids = ['%04d' % (i) for i in range(5)]
+    retval = []
+    for target, name, keys, query in shapes:
+        if target not in ['stock', 'trader', 'inverted']:
+            continue
+        collection = switch(colls['twse'][target], db)._get_collection()
+        collection.drop_indexes()
+        q = query(starttime, endtime, stockids, traderids)
+        before, nbefore = _time(collection, q, repeat)
+        index = collection.create_index(keys, background=True)
+        after, nafter = _time(collection, q, repeat)
+        size = collection.database.command('collStats', collection.name)['indexSizes'][index]
+        retval.append((target, name, index, size, before, after, nbefore, nafter))
+    return retval
+
+
+def report(rows):
+    print "%-10s %-10s %-36s %12s %10s %10s %8s %10s %10s" % (
+        'target', 'shape', 'index', 'size', 'ms before', 'ms after', 'speedup', 'examined', 'examined')
+    for target, name, index, size, before, after, nbefore, nafter in rows:
+        print "%-10s %-10s %-36s %12d %10.2f %10.2f %7.1fx %10s %10s" % (
+            target, name, index, size, before, after, before / max(after, 1e-6), nbefore, nafter)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='advise, build and bench indexes of his/id/alg colls')
+    parser.add_argument('action', choices=['advise', 'provision', 'bench'], help='action')
+    parser.add_argument('--opt', dest='opt', choices=['twse', 'otc', 'all'], default='all', help='market')
+    parser.add_argument('--log', dest='log', default=None, help='profiler metrics log path')
+    parser.add_argument('--stocks', dest='stocks', type=int, default=200, help='bench fixture stocks')
+    parser.add_argument('--days', dest='days', type=int, default=250, help='bench fixture days')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5, help='bench runs per query')
+    parser.add_argument('--debug', dest='debug', action='store_true', default=False, help='debug mode')
+    args = parser.parse_args()
+    if args.action == 'bench':
+        report(bench(args.stocks, args.days, args.repeat, args.debug))
+    else:
+        for opt in ['twse', 'otc'] if args.opt == 'all' else [args.opt]:
+            if args.action == 'advise':
+                for db, target, keys, n in advise(opt, args.debug, args.log):
+                    print "%s.%s missing %s, %d calls seen" % (db, target, keys, n)
+            else:
+                provision(opt, args.debug)
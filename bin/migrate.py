@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+# offline migration from single StockHisColl doc per (stockid, date)
+# to per-domain stock/trader/credit/future his colls
+# resumable, the last migrated _id is kept in migrate_state coll of each db,
+# every write is an upsert on (stockid, date) so a rerun batch is harmless
+# python bin/migrate.py --opt twse --batch 1000
+# then backfill colls derived from the day colls, read paths gated on them stay off until done
+# python bin/migrate.py --opt twse --backfill
+
+import argparse
+import time
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+from mongoengine import *
+from bin.start import switch
+from bin.mongodb_driver import MongoDBDriver
+from handler.models import *
+from handler.hisdb_handler import bulk_upsert, build_state, period, next_period
+from handler.hisdb_handler import TwseHisDBHandler, OtcHisDBHandler
+
+__all__ = ['migrate', 'backfill', 'coll_stats']
+
+colls = {
+    'twse': {
+        'db': 'twsehisdb',
+        'src': TwseHisColl,
+        'stock': TwseHisStockColl,
+        'trader': TwseHisTraderColl,
+        'credit': TwseHisCreditColl,
+        'future': TwseHisFutureColl
+    },
+    'otc': {
+        'db': 'otchisdb',
+        'src': OtcHisColl,
+        'stock': OtcHisStockColl,
+        'trader': OtcHisTraderColl,
+        'credit': OtcHisCreditColl,
+        'future': OtcHisFutureColl
+    }
+}
+
+# fields of legacy doc moved to each target coll
+fields = {
+    'stock': ['data'],
+    'trader': ['toplist', 'data'],
+    'credit': ['finance', 'bearish'],
+    'future': ['future', 'data']
+}
+
+# a target doc is only created when its own domain fields exist
+requires = {
+    'stock': ['data'],
+    'trader': ['toplist'],
+    'credit': ['finance', 'bearish'],
+    'future': ['future']
+}
+
+
+handlers = {
+    'twse': TwseHisDBHandler,
+    'otc': OtcHisDBHandler
+}
+
+# derived colls built from the day colls in resumable steps,
+# target: (his handler, its derived coll attr, step, build of one step)
+# month steps build [starttime, endtime] days in date order,
+# summary windows of a month roll on from the rows of the month before it,
+# a week across months is rebuilt whole by the later month,
+# stockid steps build a batch of stockids in stockid order
+builds = OrderedDict([
+    ('inverted', ('trader', '_invcoll', 'month', lambda handler, starttime, endtime: handler.build_inverted(starttime, endtime))),
+    ('summary', ('summary', '_coll', 'month', lambda handler, starttime, endtime: handler.build(starttime, endtime))),
+    ('latest', ('latest', '_coll', 'stockid', lambda handler, stockids: handler.build(stockids))),
+    ('rollup', ('rollup', '_coll', 'month', lambda handler, starttime, endtime: handler.build(starttime, endtime)))
+])
+
+
+def coll_stats(coll):
+    """ count/size/storageSize/totalIndexSize of coll in bytes """
+    name = coll._get_collection().name
+    db = coll._get_db()
+    if name not in db.collection_names():
+        return {'count': 0, 'size': 0, 'storageSize': 0, 'totalIndexSize': 0}
+    stats = db.command('collStats', name)
+    return {k: stats.get(k, 0) for k in ['count', 'size', 'storageSize', 'totalIndexSize']}
+
+
+def report(title, stats):
+    print "%s" % (title)
+    for k, v in stats.items():
+        print "  %-8s count: %10d, size: %12d, storage: %12d, index: %12d" % (
+            k, v['count'], v['size'], v['storageSize'], v['totalIndexSize'])
+
+
+def migrate(opt='twse', batch=1000, debug=False, restart=False):
+    """ copy legacy his docs to per-domain colls batch by batch in _id order """
+    db = colls[opt]['db'] if not debug else 'test' + colls[opt]['db']
+    host, port = MongoDBDriver._host, MongoDBDriver._port
+    connect(db, host=host, port=port, alias=db)
+    src = switch(colls[opt]['src'], db)
+    dsts = {k: switch(colls[opt][k], db) for k in fields.keys()}
+    state = src._get_db()['migrate_state']
+    name = src._get_collection().name
+    if restart:
+        state.remove({'_id': name})
+    stats = {'src': coll_stats(src)}
+    stats.update({k: coll_stats(v) for k, v in dsts.items()})
+    report("%s before" % (db), stats)
+    last = state.find_one({'_id': name})
+    query = {'_id': {'$gt': last['last']}} if last else {}
+    total = last['total'] if last else 0
+    start = time.time()
+    while True:
+        cursor = src._get_collection().find(query).sort('_id', 1).limit(batch)
+        docs = list(cursor)
+        if not docs:
+            break
+        for k, coll in dsts.items():
+            items = []
+            for doc in docs:
+                if not any(f in doc for f in requires[k]):
+                    continue
+                it = {'stockid': doc['stockid'], 'date': doc['date']}
+                it.update({f: doc[f] for f in fields[k] if f in doc})
+                items.append(it)
+            bulk_upsert(coll, items)
+        total += len(docs)
+        query = {'_id': {'$gt': docs[-1]['_id']}}
+        state.update({'_id': name}, {'$set': {'last': docs[-1]['_id'], 'total': total}}, upsert=True)
+        print "%s migrated: %d, %.2f docs/s" % (db, total, total / max(time.time() - start, 1e-6))
+    for coll in dsts.values():
+        coll.ensure_indexes()
+    stats = {'src': coll_stats(src)}
+    stats.update({k: coll_stats(v) for k, v in dsts.items()})
+    report("%s after" % (db), stats)
+    return stats
+
+
+def backfill(opt='twse', targets=[], batch=1000, debug=False, restart=False):
+    """ build derived colls from the day colls step by step,
+    the last built month or stockid is kept as build_<coll> in migrate_state of each db,
+    done is set once the last step is built, writes after that keep the coll up to date
+    """
+    dbhandler = handlers[opt](debug=debug, bulk=True)
+    stock = dbhandler.stock.coll._get_collection()
+    first = [it['date'] for it in stock.find({}, {'date': 1}).sort('date', 1).limit(1)]
+    endtime = datetime.utcnow()
+    states = {}
+    for target in targets or builds.keys():
+        attr, name, step, build = builds[target]
+        handler = getattr(dbhandler, attr)
+        coll = getattr(handler, name)
+        state = build_state(coll)
+        db = coll._get_db()['migrate_state']
+        if restart:
+            db.remove({'_id': state['_id']})
+            state = {'_id': state['_id']}
+        if state.get('done', False):
+            print "%s built" % (state['_id'])
+            states[target] = state
+            continue
+        begin = time.time()
+        if step == 'month':
+            start = next_period(state['last'], 'month') if 'last' in state else period(first[0], 'month') if first else None
+            while start and start <= endtime:
+                stop = next_period(start, 'month')
+                build(handler, start, stop - timedelta(seconds=1))
+                db.update({'_id': state['_id']}, {'$set': {'last': start}}, upsert=True)
+                print "%s built: %s, %.2fs" % (state['_id'], start.strftime('%Y-%m'), time.time() - begin)
+                start = stop
+        else:
+            stockids = sorted(it for it in stock.distinct('stockid') if 'last' not in state or it > state['last'])
+            for i in range(0, len(stockids), batch):
+                build(handler, stockids[i:i + batch])
+                db.update({'_id': state['_id']}, {'$set': {'last': stockids[i:i + batch][-1]}}, upsert=True)
+                print "%s built: %s, %.2fs" % (state['_id'], stockids[i:i + batch][-1], time.time() - begin)
+        db.update({'_id': state['_id']}, {'$set': {'done': True}}, upsert=True)
+        states[target] = build_state(coll)
+    return states
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='migrate his coll as per-domain stock/trader/credit/future colls')
+    parser.add_argument('--opt', dest='opt', choices=['twse', 'otc', 'all'], default='all', help='market')
+    parser.add_argument('--batch', dest='batch', type=int, default=1000, help='docs per bulk write, stockids per backfill step')
+    parser.add_argument('--restart', dest='restart', action='store_true', default=False, help='ignore last migrated state')
+    parser.add_argument('--debug', dest='debug', action='store_true', default=False, help='debug mode')
+    parser.add_argument('--backfill', dest='backfill', nargs='*', choices=builds.keys(), default=None,
+                        help='build derived colls, all when none given')
+    args = parser.parse_args()
+    for opt in ['twse', 'otc'] if args.opt == 'all' else [args.opt]:
+        if args.backfill is not None:
+            backfill(opt, args.backfill, args.batch, args.debug, args.restart)
+        else:
+            migrate(opt, args.batch, args.debug, args.restart)
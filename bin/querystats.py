@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+# rank hot query shapes of handler/profiler.py metrics log
+# shape is (handler, target, method, window days, stockid count), ranked by total time
+# python bin/querystats.py --top 20 --since 2015-06-01
+
+import argparse
+from datetime import datetime
+from collections import defaultdict
+from handler.profiler import read_log
+
+__all__ = ['summarize', 'shape']
+
+
+def shape(record):
+    return (record['handler'], record['target'], record['method'], record['window'], record['stockids'])
+
+
+def _avg(values):
+    values = [v for v in values if v is not None]
+    return float(sum(values)) / len(values) if values else None
+
+
+def summarize(records, threshold=500):
+    """ per shape count, total/avg/p95/max ms, avg docs returned/examined, avg server wide docs examined, avg bytes, slow count """
+    groups = defaultdict(list)
+    for it in records:
+        groups[shape(it)].append(it)
+    retval = []
+    for k, items in groups.items():
+        elapsed = sorted(it['elapsed'] for it in items)
+        retval.append({
+            'shape': k,
+            'count': len(items),
+            'total': sum(elapsed),
+            'avg': sum(elapsed) / len(elapsed),
+            'p95': elapsed[min(int(len(elapsed) * 0.95), len(elapsed) - 1)],
+            'max': elapsed[-1],
+            'returned': _avg(it['returned'] for it in items),
+            'examined': _avg(it['examined'] for it in items),
+            'server': _avg(it.get('server_examined', None) for it in items),
+            'bytes': _avg(it.get('bytes', None) for it in items),
+            'slow': sum(1 for v in elapsed if v >= threshold)
+        })
+    return sorted(retval, key=lambda x: -x['total'])
+
+
+def report(stats):
+    print "%-28s %-8s %-13s %6s %8s %7s %11s %10s %10s %10s %10s %10s %10s %10s %5s" % (
+        'handler', 'target', 'method', 'window', 'stockids', 'count',
+        'total ms', 'avg ms', 'p95 ms', 'max ms', 'returned', 'examined', 'server', 'bytes', 'slow')
+    fmt = lambda v: '%10.1f' % (v) if v is not None else '%10s' % ('-')
+    for it in stats:
+        handler, target, method, window, stockids = it['shape']
+        print "%-28s %-8s %-13s %6s %8d %7d %11.1f %s %s %s %s %s %s %s %5d" % (
+            handler, target, method, window if window is not None else '-', stockids, it['count'],
+            it['total'], fmt(it['avg']), fmt(it['p95']), fmt(it['max']),
+            fmt(it['returned']), fmt(it['examined']), fmt(it['server']), fmt(it['bytes']), it['slow'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='rank hot handler query shapes of the metrics log')
+    parser.add_argument('--log', dest='log', default=None, help='metrics log path, profiler settings path by default')
+    parser.add_argument('--top', dest='top', type=int, default=20, help='shapes to show')
+    parser.add_argument('--since', dest='since', default=None, help='only records at or after yyyy-mm-dd')
+    parser.add_argument('--threshold', dest='threshold', type=float, default=500, help='slow query ms')
+    args = parser.parse_args()
+    records = read_log(args.log)
+    if args.since:
+        since = datetime.strptime(args.since, '%Y-%m-%d').strftime('%Y-%m-%d')
+        records = (it for it in records if it['at'] >= since)
+    report(summarize(records, args.threshold)[:args.top])
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+# docs/sec of the mongoengine path against the raw pymongo fast path of his colls
+# reads:  Document iteration, rawdb.find_raw dicts, rawdb.to_columns numpy columns
+# writes: Document save with field validation, bulk_upsert of raw dicts
+# on the bin/indexes.py fixture db
+# python bin/rawbench.py --stocks 200 --days 250
+
+import argparse
+import time
+from datetime import timedelta
+
+from mongoengine import *
+from bin.start import switch
+from bin.indexes import fixture, colls
+from handler.models import StockData
+from handler.hisdb_handler import bulk_upsert, to_mongo
+from handler import rawdb
+
+__all__ = ['bench']
+
+
+def _rate(fn):
+    start = time.time()
+    n = fn()
+    return n, n / max(time.time() - start, 1e-6)
+
+
+def bench(stocks=200, days=250, debug=False):
+    """ [(path, docs, docs/sec)] """
+    db = 'benchtwsehisdb' if not debug else 'testbenchtwsehisdb'
+    dates = fixture(db, stocks, days)
+    coll = switch(colls['twse']['stock'], db)
+    coll.ensure_indexes()
+    starttime, endtime = dates[0], dates[-1]
+
+    def read_orm():
+        n = 0
+        for it in coll.objects(Q(date__gte=starttime) & Q(date__lte=endtime)):
+            n += it.data.close is not None
+        return n
+
+    def read_raw():
+        n = 0
+        for it in rawdb.find_raw(coll, starttime, endtime, fields=rawdb.projections['stock']):
+            n += it['data']['close'] is not None
+        return n
+
+    def read_columns():
+        columns = rawdb.to_columns(rawdb.find_raw(coll, starttime, endtime, fields=['data.close']))
+        return len(columns['data.close'])
+
+    # one new day per stock, both write paths on their own date
+    items = [{
+        'stockid': '%04d' % (1000 + i),
+        'open': 10.0, 'high': 11.0, 'low': 9.0, 'close': 10.5, 'volume': 100
+    } for i in range(stocks)]
+
+    def write_orm():
+        date = dates[-1] + timedelta(days=1)
+        keys = [k for k in StockData._fields.iterkeys() if k not in ['id', '_cls']]
+        for it in items:
+            doc = coll(stockid=it['stockid'], date=date, data=StockData(**{k: v for k, v in it.items() if k in keys}))
+            doc.save()
+        return len(items)
+
+    def write_raw():
+        date = dates[-1] + timedelta(days=2)
+        raw = [{'stockid': it['stockid'], 'date': date, 'data': to_mongo(StockData, it)} for it in items]
+        return bulk_upsert(coll, raw)['upserted']
+
+    paths = [
+        ('read mongoengine', read_orm),
+        ('read find_raw', read_raw),
+        ('read to_columns', read_columns),
+        ('write mongoengine', write_orm),
+        ('write bulk_upsert', write_raw)
+    ]
+    retval = []
+    for name, fn in paths:
+        n, rate = _rate(fn)
+        retval.append((name, n, rate))
+    return retval
+
+
+def report(rows):
+    print "%-20s %10s %12s" % ('path', 'docs', 'docs/sec')
+    for name, n, rate in rows:
+        print "%-20s %10d %12.1f" % (name, n, rate)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='docs/sec of mongoengine and raw pymongo his paths')
+    parser.add_argument('--stocks', dest='stocks', type=int, default=200, help='fixture stocks')
+    parser.add_argument('--days', dest='days', type=int, default=250, help='fixture days')
+    parser.add_argument('--debug', dest='debug', action='store_true', default=False, help='debug mode')
+    args = parser.parse_args()
+    report(bench(args.stocks, args.days, args.debug))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# captcha solving off the twisted reactor
+# trader spiders hand the raw captcha body to a process pool and get a deferred of the text,
+# cv2 decode + captcha alg run in the workers while the reactor keeps every other
+# request downloading, spider callbacks return the deferred as scrapy chains on it
+# CAPTCHA_WORKERS sizes the pool, queue depth/solve times go to the crawler stats
+#   captcha/submitted, captcha/solved, captcha/failed, captcha/depth, captcha/depth_max,
+#   captcha/wait_ms (submit -> text, queueing included)
+
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+__all__ = ['CaptchaPool', 'get_pool', 'solve', 'solvers']
+
+# solver name -> (module, captcha class), imported in the worker
+solvers = {
+    'twse0': ('crawler.spiders.twsehistrader_captcha', 'TwseHisTraderCaptcha0'),
+    'twse1': ('crawler.spiders.twsehistrader_captcha', 'TwseHisTraderCaptcha1'),
+    'twse2': ('crawler.spiders.twsehistrader_captcha', 'TwseHisTraderCaptcha2'),
+    'otc0': ('crawler.spiders.otchistrader_captcha', 'OtcHisTraderCaptcha0'),
+    'otc1': ('crawler.spiders.otchistrader_captcha', 'OtcHisTraderCaptcha1')
+}
+
+_lock = threading.Lock()
+_pools = {}
+
+
+def solve(solver, body):
+    """ worker side, raw image body as captcha text """
+    import cv2
+    import numpy as np
+    module, name = solvers[solver]
+    cls = getattr(__import__(module, fromlist=[name]), name)
+    img = cv2.imdecode(np.asarray(bytearray(body), dtype=np.uint8), -1)
+    return cls(False).run(img)
+
+
+def get_pool(workers=2):
+    """ shared pool per size in this process, spiders of one crawl process share it """
+    with _lock:
+        if workers not in _pools:
+            _pools[workers] = CaptchaPool(workers)
+        return _pools[workers]
+
+
+class CaptchaPool(object):
+    """ ref test/test_captchapool.py
+    pool = get_pool(crawler.settings.getint('CAPTCHA_WORKERS'))
+    d = pool.submit('twse1', response.body, crawler.stats)
+    d.addCallback(lambda text: ...)
+    pool.shutdown() on spider_closed
+    """
+
+    def __init__(self, workers=2):
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._workers = workers
+        # touched from the reactor thread only
+        self._depth = 0
+        self._stats = {'submitted': 0, 'solved': 0, 'failed': 0, 'depth_max': 0}
+
+    @property
+    def depth(self):
+        """ captchas submitted and not solved yet, queued or running """
+        return self._depth
+
+    @property
+    def stats(self):
+        return dict(self._stats, depth=self._depth, workers=self._workers)
+
+    def submit(self, solver, body, stats=None):
+        """ deferred of solve(solver, body) fired in the reactor thread
+        stats: crawler stats collector to publish queue metrics on, optional
+        """
+        d = defer.Deferred()
+        start = time.time()
+        self._depth += 1
+        self._stats['submitted'] += 1
+        self._stats['depth_max'] = max(self._stats['depth_max'], self._depth)
+        if stats is not None:
+            stats.inc_value('captcha/submitted')
+            stats.set_value('captcha/depth', self._depth)
+            stats.max_value('captcha/depth_max', self._depth)
+        future = self._executor.submit(solve, solver, body)
+        # done callbacks run in the executor thread, hand back to the reactor
+        future.add_done_callback(lambda f: reactor.callFromThread(self._done, d, f, start, stats))
+        return d
+
+    def _done(self, d, future, start, stats):
+        self._depth -= 1
+        failed = future.exception() is not None
+        self._stats['failed' if failed else 'solved'] += 1
+        if stats is not None:
+            stats.inc_value('captcha/failed' if failed else 'captcha/solved')
+            stats.set_value('captcha/depth', self._depth)
+            stats.inc_value('captcha/wait_ms', int((time.time() - start) * 1000))
+        if failed:
+            d.errback(Failure(future.exception()))
+        else:
+            d.callback(future.result())
+
+    def shutdown(self, wait=True):
+        """ stop the workers, a later get_pool of this size starts a fresh pool """
+        with _lock:
+            if _pools.get(self._workers, None) is self:
+                del _pools[self._workers]
+        self._executor.shutdown(wait=wait)
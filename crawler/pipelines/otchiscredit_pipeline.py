@@ -2,6 +2,7 @@
 
 from crawler.pipelines.twsehiscredit_pipeline import TwseHisCreditPipeline
 from handler.hisdb_handler import *
+from handler.registry import get_handler
 
 __all__ = ['OtcHisCreditPipeline']
 
@@ -16,6 +17,7 @@ class OtcHisCreditPipeline(TwseHisCreditPipeline):
         self._name = 'otchiscredit'
         kwargs = {
             'debug': crawler.settings.getbool('GIANT_DEBUG'),
+            'bulk': crawler.settings.getbool('GIANT_BULK'),
             'opt': 'otc'
         }
-        self._db = OtcHisDBHandler(**kwargs)
+        self._db = get_handler(OtcHisDBHandler, **kwargs)
@@ -2,6 +2,7 @@
 
 from crawler.pipelines.twsehisstock_pipeline import TwseHisStockPipeline
 from handler.hisdb_handler import *
+from handler.registry import get_handler
 
 __all__ = ['OtcHisStockPipeline']
 
@@ -16,6 +17,7 @@ class OtcHisStockPipeline(TwseHisStockPipeline):
         self._name = 'otchisstock'
         kwargs = {
             'debug': crawler.settings.getbool('GIANT_DEBUG'),
+            'bulk': crawler.settings.getbool('GIANT_BULK'),
             'opt': 'otc'
         }
-        self._db = OtcHisDBHandler(**kwargs)
+        self._db = get_handler(OtcHisDBHandler, **kwargs)
@@ -4,6 +4,7 @@
 from crawler.pipelines.twsehistrader_pipeline import TwseHisTraderPipeline
 from handler.hisdb_handler import *
 from handler.iddb_handler import *
+from handler.registry import get_handler
 
 __all__ = ['OtcHisTraderPipeline']
 
@@ -20,7 +21,8 @@ class OtcHisTraderPipeline(TwseHisTraderPipeline):
         for i in range(2):
             kwargs.append({
                 'debug': crawler.settings.getbool('GIANT_DEBUG'),
+                'bulk': crawler.settings.getbool('GIANT_BULK'),
                 'opt': 'otc'
         })
-        self._db = OtcHisDBHandler(**kwargs[0])
-        self._id = OtcIdDBHandler(**kwargs[1])
+        self._db = get_handler(OtcHisDBHandler, **kwargs[0])
+        self._id = get_handler(OtcIdDBHandler, **kwargs[1])
@@ -2,6 +2,7 @@
 
 from crawler.pipelines.twseid_pipeline import TwseIdPipeline
 from handler.iddb_handler import *
+from handler.registry import get_handler
 
 __all__ = ['OtcIdPipeline']
 
@@ -18,4 +19,4 @@ class OtcIdPipeline(TwseIdPipeline):
             'debug': crawler.settings.getbool('GIANT_DEBUG'),
             'opt': 'otc'
         }
-        self._id = OtcIdDBHandler(**kwargs)
+        self._id = get_handler(OtcIdDBHandler, **kwargs)
@@ -8,6 +8,7 @@ from datetime import datetime
 from scrapy import log
 from crawler.pipelines.base_pipeline import BasePipeline
 from handler.hisdb_handler import *
+from handler.registry import get_handler
 
 __all__ = ['TwseHisCreditPipeline']
 
@@ -22,9 +23,10 @@ class TwseHisCreditPipeline(BasePipeline):
         self._name = 'twsehiscredit'
         kwargs = {
             'debug': crawler.settings.getbool('GIANT_DEBUG'),
+            'bulk': crawler.settings.getbool('GIANT_BULK'),
             'opt': 'twse'
         }
-        self._db = TwseHisDBHandler(**kwargs)
+        self._db = get_handler(TwseHisDBHandler, **kwargs)
 
     def process_item(self, item, spider):
         if spider.name not in [self._name]:
@@ -60,4 +62,7 @@ class TwseHisCreditPipeline(BasePipeline):
         return item
 
     def _write_item(self, item):
-        self._db.credit.insert_raw(item)
+        result = self._db.credit.insert_raw(item)
+        if result:
+            log.msg("bulk: %s" % (result), level=log.INFO)
+        self._db.refresh(item, 'credit')
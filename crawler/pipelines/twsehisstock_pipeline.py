@@ -8,6 +8,7 @@ from datetime import datetime
 from scrapy import log
 from crawler.pipelines.base_pipeline import BasePipeline
 from handler.hisdb_handler import *
+from handler.registry import get_handler
 
 __all__ = ['TwseHisStockPipeline']
 
@@ -22,9 +23,10 @@ class TwseHisStockPipeline(BasePipeline):
         self._name = 'twsehisstock'
         kwargs = {
             'debug': crawler.settings.getbool('GIANT_DEBUG'),
+            'bulk': crawler.settings.getbool('GIANT_BULK'),
             'opt': 'twse'
         }
-        self._db = TwseHisDBHandler(**kwargs)
+        self._db = get_handler(TwseHisDBHandler, **kwargs)
 
     def process_item(self, item, spider):
         if spider.name not in [self._name]:
@@ -56,4 +58,7 @@ class TwseHisStockPipeline(BasePipeline):
         return item
 
     def _write_item(self, item):
-        self._db.stock.insert_raw(item)
+        result = self._db.stock.insert_raw(item)
+        if result:
+            log.msg("bulk: %s" % (result), level=log.INFO)
+        self._db.refresh(item, 'stock')
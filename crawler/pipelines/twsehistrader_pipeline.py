@@ -11,6 +11,7 @@ from scrapy import log
 from crawler.pipelines.base_pipeline import BasePipeline
 from handler.hisdb_handler import *
 from handler.iddb_handler import *
+from handler.registry import get_handler
 
 __all__ = ['TwseHisTraderPipeline']
 
@@ -27,10 +28,11 @@ class TwseHisTraderPipeline(BasePipeline):
         for i in range(2):
             kwargs.append({
                 'debug': crawler.settings.getbool('GIANT_DEBUG'),
+                'bulk': crawler.settings.getbool('GIANT_BULK'),
                 'opt': 'twse'
             })
-        self._db = TwseHisDBHandler(**kwargs[0])
-        self._id = TwseIdDBHandler(**kwargs[1])
+        self._db = get_handler(TwseHisDBHandler, **kwargs[0])
+        self._id = get_handler(TwseIdDBHandler, **kwargs[1])
         self._debug = crawler.settings.getbool('GIANT_DEBUG')
 
     def process_item(self, item, spider):
@@ -98,5 +100,8 @@ class TwseHisTraderPipeline(BasePipeline):
         return item
 
     def _write_item(self, item):
-        self._db.trader.insert_raw(item)
+        result = self._db.trader.insert_raw(item)
+        if result:
+            log.msg("bulk: %s" % (result), level=log.INFO)
+        self._db.refresh(item, 'trader')
         self._id.trader.insert_raw(item['toplist'])
@@ -7,6 +7,7 @@ import os
 from scrapy import log
 from crawler.pipelines.base_pipeline import BasePipeline
 from handler.iddb_handler import *
+from handler.registry import get_handler
 
 __all__ = ['TwseIdPipeline']
 
@@ -23,7 +24,7 @@ class TwseIdPipeline(BasePipeline):
             'debug': crawler.settings.getbool('GIANT_DEBUG'),
             'opt': 'twse'
         }
-        self._id = TwseIdDBHandler(**kwargs)
+        self._id = get_handler(TwseIdDBHandler, **kwargs)
 
     def process_item(self, item, spider):
         if spider.name not in [self._name]:
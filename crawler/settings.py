@@ -46,6 +46,10 @@ LOG_LEVEL = 'INFO'
 # our ginat internal debug set
 GIANT_DEBUG = False
 GIANT_LIMIT = 0
+# his pipelines write each item batch as one unordered bulk upsert
+GIANT_BULK = True
+# trader spiders solve captchas in this many worker processes off the reactor
+CAPTCHA_WORKERS = 2
 
 # proxy list to avoid ip blocker
 PROXY_LIST = 'crawler/list.txt'
@@ -4,6 +4,7 @@ from crawler.spiders.twsehisfuture_spider import TwseHisFutureSpider
 from handler.hisdb_handler import *
 
 from handler.iddb_handler import OtcIdDBHandler
+from handler.registry import get_handler
 
 __all__ = ['OtcHisFutureSpider']
 
@@ -17,5 +18,5 @@ class OtcHisFutureSpider(TwseHisFutureSpider):
             'limit': crawler.settings.getint('GIANT_LIMIT'),
             'opt': 'otc'
         }
-        self._id = OtcIdDBHandler(**kwargs)
+        self._id = get_handler(OtcIdDBHandler, **kwargs)
         self._table = {}
\ No newline at end of file
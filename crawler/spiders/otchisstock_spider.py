@@ -14,6 +14,7 @@ from scrapy import log
 from crawler.items import OtcHisStockItem
 
 from handler.iddb_handler import OtcIdDBHandler
+from handler.registry import get_handler
 
 __all__ = ['OtcHisStockSpider']
 
@@ -43,7 +44,7 @@ class OtcHisStockSpider(CrawlSpider):
             'limit': crawler.settings.getint('GIANT_LIMIT'),
             'opt': 'otc'
         }
-        self._id = OtcIdDBHandler(**kwargs)
+        self._id = get_handler(OtcIdDBHandler, **kwargs)
 
     def start_requests(self):
         for i,stockid in enumerate(self._id.stock.get_ids()):
@@ -5,17 +5,18 @@ import pandas as pd
 import numpy as np
 from StringIO import StringIO
 import string
-import cv2
 
+from scrapy import signals
 from scrapy.selector import Selector
 from scrapy.spider import BaseSpider
 from scrapy.contrib.spiders import CrawlSpider, Rule
 from scrapy import Request, FormRequest
 from scrapy import log
 from crawler.items import OtcHisTraderItem
-from crawler.spiders.otchistrader_captcha import OtcHisTraderCaptcha1
+from crawler.captchapool import get_pool
 
 from handler.iddb_handler import OtcIdDBHandler
+from handler.registry import get_handler
 
 __all__ = ['OtcHisTraderSpider']
 
@@ -43,7 +44,14 @@ class OtcHisTraderSpider(CrawlSpider):
 #            'slice': crawler.settings.getint('GIANT_SLICE'),
             'opt': 'otc'
         }
-        self._id = OtcIdDBHandler(**kwargs)
+        self._id = get_handler(OtcIdDBHandler, **kwargs)
+        self._stats = crawler.stats
+        self._captcha = get_pool(crawler.settings.getint('CAPTCHA_WORKERS', 2))
+        crawler.signals.connect(self.spider_closed, signals.spider_closed)
+
+    def spider_closed(self, spider):
+        # no worker process outlives the crawl
+        self._captcha.shutdown()
 
     def start_requests(self):
         for i,stockid in enumerate(self._id.stock.get_ids()):
@@ -81,11 +89,13 @@ class OtcHisTraderSpider(CrawlSpider):
         yield request
 
     def parse_after_captcha_find(self, response):
+        # use captcha alg as text decode, solved in captcha pool off the reactor
+        d = self._captcha.submit('otc1', response.body, self._stats)
+        d.addCallback(self.parse_after_captcha_solve, response)
+        return d
+
+    def parse_after_captcha_solve(self, text, response):
         item = response.meta['item']
-        # use captcha alg as text decode
-        arr = np.asarray(bytearray(response.body), dtype=np.uint8)
-        img = cv2.imdecode(arr, -1)
-        text = OtcHisTraderCaptcha1(False).run(img)
         # or use rank recorder to find best text selected
         #text = raw_input('test:')
         #print text
@@ -104,7 +114,7 @@ class OtcHisTraderSpider(CrawlSpider):
             formdata=content,
             callback=self.parse_after_form_submit,
             dont_filter=True)
-        yield request
+        return [request]
 
     def parse_after_form_submit(self, response):
         item, content = response.meta['item'], response.meta['content']
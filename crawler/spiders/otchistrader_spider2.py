@@ -13,6 +13,7 @@ from scrapy import log
 from crawler.items import OtcHisTraderItem
 
 from handler.iddb_handler import OtcIdDBHandler
+from handler.registry import get_handler
 
 
 __all__ = ['OtcHisTraderSpider2']
@@ -41,7 +42,7 @@ class OtcHisTraderSpider2(CrawlSpider):
 #            'slice': crawler.settings.getint('GIANT_SLICE'),
             'opt': 'otc'
         }
-        self._id = OtcIdDBHandler(**kwargs)
+        self._id = get_handler(OtcIdDBHandler, **kwargs)
 
     def start_requests(self):
         for i,stockid in enumerate(self._id.stock.get_ids()):
@@ -18,6 +18,7 @@ from scrapy import log
 from crawler.items import TwseHisFutureItem
 
 from handler.iddb_handler import TwseIdDBHandler
+from handler.registry import get_handler
 
 __all__ = ['TwseHisFutureSpider']
 
@@ -52,7 +53,7 @@ class TwseHisFutureSpider(CrawlSpider):
             'limit': crawler.settings.getint('GIANT_LIMIT'),
             'opt': 'twse'
         }
-        self._id = TwseIdDBHandler(**kwargs)
+        self._id = get_handler(TwseIdDBHandler, **kwargs)
         self._table = {}
 
     def start_requests(self):
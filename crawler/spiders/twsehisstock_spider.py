@@ -16,6 +16,7 @@ from scrapy import log
 from crawler.items import TwseHisStockItem
 
 from handler.iddb_handler import TwseIdDBHandler
+from handler.registry import get_handler
 
 __all__ = ['TwseHisStockSpider']
 
@@ -50,7 +51,7 @@ class TwseHisStockSpider(CrawlSpider):
             'limit': crawler.settings.getint('GIANT_LIMIT'),
             'opt': 'twse'
         }
-        self._id = TwseIdDBHandler(**kwargs)
+        self._id = get_handler(TwseIdDBHandler, **kwargs)
 
     def start_requests(self):
         URL = 'http://www.twse.com.tw/ch/trading/exchange/STOCK_DAY/STOCK_DAYMAIN.php'
@@ -7,17 +7,18 @@ import pandas as pd
 import numpy as np
 from StringIO import StringIO
 import string
-import cv2
 
+from scrapy import signals
 from scrapy.selector import Selector
 from scrapy.spider import BaseSpider
 from scrapy.contrib.spiders import CrawlSpider, Rule
 from scrapy import Request, FormRequest
 from scrapy import log
 from crawler.items import TwseHisTraderItem
-from crawler.spiders.twsehistrader_captcha import TwseHisTraderCaptcha0, TwseHisTraderCaptcha1, TwseHisTraderCaptcha2
+from crawler.captchapool import get_pool
 
 from handler.iddb_handler import TwseIdDBHandler
+from handler.registry import get_handler
 
 __all__ = ['TwseHisTraderSpider']
 
@@ -45,7 +46,14 @@ class TwseHisTraderSpider(CrawlSpider):
 #            'slice': crawler.settings.getint('GIANT_SLICE'),
             'opt': 'twse'
         }
-        self._id = TwseIdDBHandler(**kwargs)
+        self._id = get_handler(TwseIdDBHandler, **kwargs)
+        self._stats = crawler.stats
+        self._captcha = get_pool(crawler.settings.getint('CAPTCHA_WORKERS', 2))
+        crawler.signals.connect(self.spider_closed, signals.spider_closed)
+
+    def spider_closed(self, spider):
+        # no worker process outlives the crawl
+        self._captcha.shutdown()
 
     def start_requests(self):
         URL = 'http://bsr.twse.com.tw/bshtm/bsMenu.aspx'
@@ -95,11 +103,13 @@ class TwseHisTraderSpider(CrawlSpider):
         yield request
 
     def parse_after_captcha_find(self, response):
-        # use captcha alg as text decode
+        # use captcha alg as text decode, solved in captcha pool off the reactor
+        d = self._captcha.submit('twse1', response.body, self._stats)
+        d.addCallback(self.parse_after_captcha_solve, response)
+        return d
+
+    def parse_after_captcha_solve(self, text, response):
         item, content = response.meta['item'], response.meta['content']
-        arr = np.asarray(bytearray(response.body), dtype=np.uint8)
-        img = cv2.imdecode(arr, -1)
-        text = TwseHisTraderCaptcha1(False).run(img)
         #text = raw_input('test:')
         content.update({
             'CaptchaControl1': text
@@ -114,7 +124,7 @@ class TwseHisTraderSpider(CrawlSpider):
             formdata=content,
             callback=self.parse_after_form_submit,
             dont_filter=True)
-        yield request
+        return [request]
 
     def parse_after_form_submit(self, response):
         item = response.meta['item']
@@ -12,6 +12,7 @@ from scrapy import log
 from crawler.items import TwseHisTraderItem
 
 from handler.iddb_handler import TwseIdDBHandler
+from handler.registry import get_handler
 
 
 __all__ = ['TwseHisTraderSpider2']
@@ -40,7 +41,7 @@ class TwseHisTraderSpider2(CrawlSpider):
 #            'slice': crawler.settings.getint('GIANT_SLICE'),
             'opt': 'twse'
         }
-        self._id = TwseIdDBHandler(**kwargs)
+        self._id = get_handler(TwseIdDBHandler, **kwargs)
 
     def start_requests(self):
         for i,stockid in enumerate(self._id.stock.get_ids()):
@@ -415,6 +415,44 @@ CELERYBEAT_SCHEDULE = {
             True,
             _debug
             )
+    },
+    # rebuild local columnar his store after his crawls
+    'run_colstore_service_twse': {
+        'task': 'handler.tasks.build_colstore',
+        'schedule': crontab(minute=0, hour='20'),
+        'args': (
+            'twse',
+            365*5,
+            _debug
+        )
+    },
+    'run_colstore_service_otc': {
+        'task': 'handler.tasks.build_colstore',
+        'schedule': crontab(minute=30, hour='20'),
+        'args': (
+            'otc',
+            365*5,
+            _debug
+        )
+    },
+    # weekly move of old his days into the local cold archive
+    'run_archive_service_twse': {
+        'task': 'handler.tasks.archive_his',
+        'schedule': crontab(minute=0, hour='3', day_of_week='sunday'),
+        'args': (
+            'twse',
+            365*6,
+            _debug
+        )
+    },
+    'run_archive_service_otc': {
+        'task': 'handler.tasks.archive_his',
+        'schedule': crontab(minute=0, hour='5', day_of_week='sunday'),
+        'args': (
+            'otc',
+            365*6,
+            _debug
+        )
     }
     # register run all feature collection
     # register run all portfolios
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+# aggregation pipeline engine as map_reduce replacement, no temp output collection
+# ref: http://docs.mongodb.org/manual/reference/operator/aggregation-pipeline/
+
+import heapq
+import operator
+from itertools import ifilter
+from bson.son import SON
+from handler.profiler import capture, account
+from handler.pipeline import run
+
+__all__ = [
+    'AggregateResult', 'aggregate', 'absolute', 'ratio', 'trend', 'project',
+    'compile_constraint', 'compile_order', 'constraint_func', 'order_func', 'order_fields',
+    'check_fields', 'pushdown', 'callbacks', 'ordered', 'select'
+]
+
+# declarative constraint ops as mongo/python ops
+_ops = {
+    '>': ('$gt', operator.gt),
+    '>=': ('$gte', operator.ge),
+    '<': ('$lt', operator.lt),
+    '<=': ('$lte', operator.le),
+    '==': ('$eq', operator.eq),
+    '!=': ('$ne', operator.ne),
+    'in': ('$in', lambda a, b: a in b),
+    'nin': ('$nin', lambda a, b: a not in b)
+}
+
+
+class AggregateResult(object):
+    """ same key/value access as mongoengine MapReduceDocument,
+    so constraint/order lambdas work on both engines
+    """
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+    def __repr__(self):
+        return "<AggregateResult key: %s>" % (self.key)
+
+
+def absolute(expr):
+    """ $abs for mongod < 3.2 """
+    return {'$cond': [{'$lt': [expr, 0]}, {'$subtract': [0, expr]}, expr]}
+
+
+def project(fields):
+    """ leading $project of stockid, date and fields, as 'data' or 'data.close' """
+    stage = {'stockid': 1, 'date': 1}
+    stage.update({k: 1 for k in fields})
+    return {'$project': stage}
+
+
+def ratio(num, den):
+    """ num / den * 100 as percent, 0 if den <= 0 """
+    return {'$cond': [{'$gt': [den, 0]}, {'$multiply': [{'$divide': [num, den]}, 100]}, 0]}
+
+
+def trend(cur, pre):
+    """ (cur - pre) / pre, 0 if pre <= 0 """
+    return {'$cond': [{'$gt': [pre, 0]}, {'$divide': [{'$subtract': [cur, pre]}, pre]}, 0]}
+
+
+def _round(it, keys, ndigits=2):
+    # js map_f did toFixed(2) on derived fields
+    for k in keys:
+        if isinstance(it.get(k, None), float):
+            it[k] = round(it[k], ndigits)
+
+
+def aggregate(cursor, pipeline, rounds=[], docs=None):
+    """ run pipeline over mongoengine queryset filter
+    cursor: queryset, its filter(include _cls) is used as the leading $match
+    pipeline: stages after $match, last $group must emit _id as key
+    rounds: derived fields rounded as 2 digits
+    docs: raw docs to run the pipeline on in process instead of the server, as archive thaw
+    """
+    stages = [{'$match': cursor._query}] + pipeline
+    if docs is not None:
+        results = run(docs, stages)
+    else:
+        capture(cursor._collection, cursor._query)
+        results = cursor._collection.aggregate(stages, cursor={}, allowDiskUse=True)
+    for it in results:
+        account(it)
+        key = it.pop('_id')
+        _round(it, rounds)
+        for data in it.get('data', []):
+            _round(data, rounds)
+        yield AggregateResult(key, it)
+
+
+def is_spec(it):
+    """ declarative spec as dict constraint or list order, lambda is not """
+    return isinstance(it, (dict, list, tuple)) and len(it) > 0
+
+
+def compile_constraint(spec, keys=[]):
+    """ declarative constraint to $match query
+    {"eclose": {">": 30}, "or": [{"edfcdiff": {"<": 0}}, {"totalvolume": {">": 100}}]}
+    keys: fields as group _id key, like stockid/traderid
+    """
+    query = {}
+    for k, cond in spec.items():
+        if k in ['or', 'and']:
+            query['$' + k] = [compile_constraint(it, keys) for it in cond]
+            continue
+        cond = cond if isinstance(cond, dict) else {'==': cond}
+        name = "_id.%s" % (k) if k in keys else k
+        query[name] = {_ops[op][0]: v for op, v in cond.items()}
+    return query
+
+
+def compile_order(spec, keys=[]):
+    """ declarative order to $sort, ["-totalvolume", "+eclose"] """
+    order = SON()
+    for it in spec:
+        sign = -1 if it.startswith('-') else 1
+        k = it.lstrip('+-')
+        order["_id.%s" % (k) if k in keys else k] = sign
+    return order
+
+
+def _field(x, k, keys):
+    return x.key[k] if k in keys else x.value[k]
+
+
+def constraint_func(spec, keys=[]):
+    """ declarative constraint as python filter on map_reduce results """
+    def match(x, spec):
+        for k, cond in spec.items():
+            if k == 'or':
+                if not any(match(x, it) for it in cond):
+                    return False
+                continue
+            if k == 'and':
+                if not all(match(x, it) for it in cond):
+                    return False
+                continue
+            cond = cond if isinstance(cond, dict) else {'==': cond}
+            v = _field(x, k, keys)
+            if not all(_ops[op][1](v, c) for op, c in cond.items()):
+                return False
+        return True
+    return lambda x: match(x, spec)
+
+
+def order_func(spec, keys=[]):
+    """ declarative order as python sort key on map_reduce results """
+    order = [(-1 if it.startswith('-') else 1, it.lstrip('+-')) for it in spec]
+    return lambda x: [sign * _field(x, k, keys) for sign, k in order]
+
+
+def order_fields(spec, keys=[]):
+    """ value fields a declarative order sorts on, none for a lambda order """
+    if not is_spec(spec):
+        return []
+    return [k for k in (it.lstrip('+-') for it in spec) if k not in keys]
+
+
+def _spec_fields(constraint):
+    """ fields a declarative constraint tests, through or/and """
+    retval = []
+    for k, cond in constraint.items():
+        if k in ['or', 'and']:
+            for it in cond:
+                retval += _spec_fields(it)
+        else:
+            retval.append(k)
+    return retval
+
+
+def _paths(expr):
+    """ $paths an aggregation expression reads """
+    if isinstance(expr, basestring):
+        return [expr[1:]] if expr.startswith('$') else []
+    if isinstance(expr, dict):
+        return [p for v in expr.values() for p in _paths(v)]
+    if isinstance(expr, (list, tuple)):
+        return [p for v in expr for p in _paths(v)]
+    return []
+
+
+def sources(pipeline):
+    """ {field: raw doc paths it is computed from} of $project/$group outputs along pipeline """
+    deps = {}
+
+    def resolve(path):
+        head = path.split('.')[0]
+        return deps[head] if head in deps else [path]
+
+    for stage in pipeline:
+        name, spec = stage.items()[0]
+        if name not in ['$project', '$group']:
+            continue
+        out = {}
+        for k, v in spec.items():
+            if k == '_id' or v in [0, 1, True, False]:
+                continue
+            out[k] = sorted(set(p for path in _paths(v) for p in resolve(path)))
+        deps.update(out)
+    return deps
+
+
+def check_fields(pipeline, fields, constraint=None, order=None, keys=[], engine='aggregate'):
+    """ raise ValueError when a fields projection leaves out raw paths the constraint/order
+    specs are computed from, or the engine doesn't read a projection
+    """
+    if engine != 'aggregate':
+        raise ValueError("fields: projection is aggregate engine only, not %s" % (engine))
+    names = _spec_fields(constraint) if is_spec(constraint) and isinstance(constraint, dict) else []
+    names += order_fields(order, keys)
+    deps = sources(pipeline)
+    covered = lambda p: any(p == f or p.startswith(f + '.') or f.startswith(p + '.') for f in fields)
+    missing = sorted(set(p for k in names if k not in keys for p in deps.get(k, [k]) if not covered(p)))
+    if missing:
+        raise ValueError("fields: %s leave out %s the constraint/order reads" % (list(fields), missing))
+
+
+def pushdown(constraint=None, order=None, limit=10, keys=[]):
+    """ split constraint/order as server side stages and python callbacks
+    only push $sort/$limit when there is no python constraint left behind,
+    lambda strings still work as fallback
+    return (stages, constraint, order)
+    """
+    stages = []
+    if is_spec(constraint):
+        stages.append({'$match': compile_constraint(constraint, keys)})
+        constraint = None
+    if is_spec(order):
+        if not constraint:
+            stages.append({'$sort': compile_order(order, keys)})
+            # limit=None as full scan, $limit: null is rejected by the server
+            if limit:
+                stages.append({'$limit': limit})
+            order = None
+        else:
+            order = order_func(order, keys)
+    return stages, constraint, order
+
+
+def callbacks(constraint=None, order=None, keys=[]):
+    """ declarative constraint/order as python callbacks for map_reduce engine """
+    if is_spec(constraint):
+        constraint = constraint_func(constraint, keys)
+    if is_spec(order):
+        order = order_func(order, keys)
+    return constraint, order
+
+
+def ordered(stages, keys):
+    """ sort group results by key fields when nothing else sorts them,
+    so streaming callers get records in stockid/traderid order
+    """
+    if any('$sort' in it for it in stages):
+        return stages
+    return stages + [{'$sort': SON([("_id.%s" % (k), 1) for k in keys])}]
+
+
+def select(results, constraint=None, order=None, limit=10):
+    """ lazy python constraint filter, order/limit as top-k heap
+    so only limit results are kept in memory, a full sort without limit
+    """
+    if constraint:
+        results = ifilter(constraint, results)
+    if order:
+        results = iter(heapq.nsmallest(limit, results, key=order) if limit else sorted(results, key=order))
+    return results
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+# cold tier of his colls on local disk, docs older than cutoff leave mongo
+# <rootpath>/archive/<opt>/<collname>/
+#   meta.json       {"cutoff": <iso date>}, docs before cutoff live in files
+#   <yyyymm>.npz    one compressed month partition, one column per doc field path
+#                   list fields like toplist as child columns "toplist[].<path>" with
+#                   "toplist[]." as parent row, "~<col>" masks missing values
+# reads crossing cutoff decode the window months in memory and merge them with the hot cursor,
+# aggregate pipelines then run in process over the merged docs, ref pipeline.py
+
+import os
+import json
+import numpy as np
+from datetime import datetime
+from collections import defaultdict
+from bin.mongodb_driver import MongoDBDriver
+from handler.pipeline import match, run
+
+__all__ = ['Archive', 'encode', 'decode']
+
+
+def _naive(v):
+    """ aware datetime as naive utc, as docs are stored """
+    return v.replace(tzinfo=None) - v.utcoffset() if v.tzinfo is not None else v
+
+
+def _flatten(doc, prefix='', out=None):
+    """ {'data': {'close': 1}} -> {'data.close': 1}, list of docs kept as is """
+    out = {} if out is None else out
+    for k, v in doc.items():
+        if k == '_id':
+            continue
+        if isinstance(v, dict):
+            _flatten(v, prefix + k + '.', out)
+        else:
+            out[prefix + k] = v
+    return out
+
+
+def _unflatten(row):
+    doc = {}
+    for path, v in row.items():
+        it = doc
+        keys = path.split('.')
+        for k in keys[:-1]:
+            it = it.setdefault(k, {})
+        it[keys[-1]] = v
+    return doc
+
+
+def _column(values):
+    """ typed array of values, None as masked zero value """
+    mask = np.array([v is None for v in values], dtype=bool)
+    sample = next((v for v in values if v is not None), None)
+    if isinstance(sample, datetime):
+        arr = np.array([v if v is not None else datetime(1970, 1, 1) for v in values], dtype='datetime64[ns]')
+    elif isinstance(sample, basestring):
+        arr = np.array([v if v is not None else u'' for v in values], dtype=np.unicode_)
+    elif isinstance(sample, bool):
+        arr = np.array([bool(v) for v in values], dtype=bool)
+    elif isinstance(sample, (int, long)) and all(isinstance(v, (int, long)) for v in values if v is not None):
+        arr = np.array([v if v is not None else 0 for v in values], dtype=np.int64)
+    else:
+        arr = np.array([v if v is not None else np.nan for v in values], dtype=np.float64)
+    return arr, (mask if mask.any() else None)
+
+
+def _value(arr, i):
+    v = arr[i]
+    if arr.dtype.kind == 'M':
+        return v.astype('datetime64[us]').astype(datetime)
+    if arr.dtype.kind == 'U':
+        return unicode(v)
+    return v.item()
+
+
+def _table(rows, prefix, arrays):
+    paths = sorted(set(k for it in rows for k in it.keys()))
+    for path in paths:
+        arr, mask = _column([it.get(path, None) for it in rows])
+        arrays[prefix + path] = arr
+        if mask is not None:
+            arrays['~' + prefix + path] = mask
+
+
+def encode(docs):
+    """ raw his docs as {column: array} """
+    rows, children = [], defaultdict(list)
+    for i, doc in enumerate(docs):
+        row = _flatten(doc)
+        for k, v in row.items():
+            if isinstance(v, list):
+                del row[k]
+                children[k].extend(dict(_flatten(it), **{'': i}) for it in v)
+        rows.append(row)
+    arrays = {}
+    _table(rows, '', arrays)
+    for k, items in children.items():
+        _table(items, k + '[].', arrays)
+    return arrays
+
+
+def decode(arrays):
+    """ {column: array} back to raw his docs """
+    columns = [k for k in arrays.keys() if not k.startswith('~') and '[].' not in k]
+    n = len(arrays[columns[0]]) if columns else 0
+    rows = [{} for i in range(n)]
+    for k in columns:
+        mask = arrays.get('~' + k, None)
+        for i in range(n):
+            if mask is None or not mask[i]:
+                rows[i][k] = _value(arrays[k], i)
+    lists = set(k.split('[].')[0] for k in arrays.keys() if '[].' in k and not k.startswith('~'))
+    for name in lists:
+        prefix = name + '[].'
+        parents = arrays[prefix]
+        cols = [k for k in arrays.keys() if k.startswith(prefix) and k != prefix]
+        for i in range(n):
+            rows[i][name] = []
+        for j in range(len(parents)):
+            item = {}
+            for k in cols:
+                mask = arrays.get('~' + k, None)
+                if mask is None or not mask[j]:
+                    item[k[len(prefix):]] = _value(arrays[k], j)
+            rows[int(parents[j])][name].append(_unflatten(item))
+    return [_unflatten(it) for it in rows]
+
+
+class Archive(object):
+    """ ref tests.py
+    archive = Archive(opt='twse')
+    archive.freeze(dbhandler.stock.coll, datetime(2012, 1, 1))
+    docs = archive.thaw(coll, cursor._query, starttime, endtime)
+    aggregate(cursor, pipeline, docs=docs)
+    """
+
+    def __init__(self, opt='twse', rootpath=None, debug=False):
+        rootpath = rootpath if rootpath else MongoDBDriver._rootpath
+        self._path = os.path.join(rootpath, 'archive', opt if not debug else 'test' + opt)
+
+    def _dir(self, coll):
+        return os.path.join(self._path, coll._get_collection_name())
+
+    def _file(self, coll, month):
+        return os.path.join(self._dir(coll), '%s.npz' % (month))
+
+    def cutoff(self, coll):
+        """ docs of coll before this date are in files, None as nothing archived """
+        path = os.path.join(self._dir(coll), 'meta.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return datetime.strptime(json.load(f)['cutoff'], '%Y-%m-%d')
+
+    def reaches(self, coll, starttime):
+        """ window starting at starttime needs archived docs of coll """
+        cutoff = self.cutoff(coll)
+        return bool(cutoff) and _naive(starttime) < cutoff
+
+    def _set_cutoff(self, coll, cutoff):
+        with open(os.path.join(self._dir(coll), 'meta.json'), 'w') as f:
+            json.dump({'cutoff': cutoff.strftime('%Y-%m-%d')}, f)
+
+    def months(self, coll, starttime=None, endtime=None):
+        """ archived partitions overlapping [starttime, endtime] """
+        if not os.path.exists(self._dir(coll)):
+            return []
+        lo = starttime.strftime('%Y%m') if starttime else '000000'
+        hi = endtime.strftime('%Y%m') if endtime else '999999'
+        months = [it[:-4] for it in os.listdir(self._dir(coll)) if it.endswith('.npz')]
+        return sorted(it for it in months if lo <= it <= hi)
+
+    def load(self, coll, month):
+        with np.load(self._file(coll, month)) as f:
+            return decode({k: f[k] for k in f.files})
+
+    def _save(self, coll, month, docs):
+        tmp = self._file(coll, month) + '.tmp.npz'
+        np.savez_compressed(tmp, **encode(docs))
+        os.rename(tmp, self._file(coll, month))
+
+    def freeze(self, coll, cutoff):
+        """ move docs of coll before cutoff into month partitions, a month at a time:
+        write partition, move meta cutoff, then drop the month from mongo
+        """
+        if not os.path.exists(self._dir(coll)):
+            os.makedirs(self._dir(coll))
+        collection = coll._get_collection()
+        cutoff = datetime(cutoff.year, cutoff.month, cutoff.day)
+        first = list(collection.find({'date': {'$lt': cutoff}}, {'date': 1}).sort('date', 1).limit(1))
+        result = {'months': 0, 'docs': 0}
+        if not first:
+            return result
+        start = datetime(first[0]['date'].year, first[0]['date'].month, 1)
+        while start < cutoff:
+            end = min(datetime(start.year + start.month // 12, start.month % 12 + 1, 1), cutoff)
+            query = {'date': {'$gte': start, '$lt': end}}
+            docs = list(collection.find(query).sort('date', 1))
+            month = start.strftime('%Y%m')
+            if docs:
+                n = len(docs)
+                if month in self.months(coll):
+                    # merge into partition of an earlier freeze, hot docs win on same (stockid, date)
+                    keys = set((it['stockid'], it['date']) for it in docs)
+                    docs = [it for it in self.load(coll, month) if (it['stockid'], it['date']) not in keys] + docs
+                    docs.sort(key=lambda x: x['date'])
+                self._save(coll, month, docs)
+                result['months'] += 1
+                result['docs'] += n
+            old = self.cutoff(coll)
+            self._set_cutoff(coll, max(old, end) if old else end)
+            collection.remove(query)
+            start = end
+        return result
+
+    def cold(self, coll, query, starttime, endtime):
+        """ archived docs of [starttime, endtime] passing query, sorted by (stockid, date) """
+        cutoff = self.cutoff(coll)
+        lo, hi = _naive(starttime), _naive(endtime)
+        if not cutoff or lo >= cutoff:
+            return []
+        docs = []
+        for month in self.months(coll, lo, min(hi, cutoff)):
+            docs.extend(it for it in self.load(coll, month) if lo <= it['date'] <= hi and match(it, query))
+        docs.sort(key=lambda x: (x['stockid'], x['date']))
+        return docs
+
+    def thaw(self, coll, query, starttime, endtime, fields=None, batch_size=1000):
+        """ docs of [starttime, endtime] from both tiers sorted by (stockid, date),
+        archived months decoded in memory and merged with the hot cursor, nothing written to mongo,
+        hot docs win on the same (stockid, date) as late days landed before cutoff
+        query: mongo filter of the caller with its date range, run by the server on hot docs
+               and by pipeline.match on archived ones
+        fields: pymongo projection applied to both tiers, keep stockid/date in it
+        """
+        cold = self.cold(coll, query, starttime, endtime)
+        cold = run(cold, [{'$project': fields}]) if fields else iter(cold)
+        hot = coll._get_collection().find(query, fields, sort=[('stockid', 1), ('date', 1)]).batch_size(batch_size)
+        c = next(cold, None)
+        for it in hot:
+            key = (it['stockid'], it['date'])
+            while c is not None and (c['stockid'], c['date']) < key:
+                yield c
+                c = next(cold, None)
+            if c is not None and (c['stockid'], c['date']) == key:
+                c = next(cold, None)
+            yield it
+        while c is not None:
+            yield c
+            c = next(cold, None)
+
+    def read(self, coll, query, starttime, endtime, fields=None, sort=None, batch_size=1000):
+        """ docs of query over [starttime, endtime], the one archive check of every read path:
+        hot cursor when the window stays after cutoff, thaw of both tiers when it reaches back
+        sort: hot cursor order, thawed docs are always in (stockid, date) order
+        """
+        if self.reaches(coll, starttime):
+            return self.thaw(coll, query, starttime, endtime, fields, batch_size)
+        return coll._get_collection().find(query, fields, sort=sort).batch_size(batch_size)
+
+    def distinct(self, coll, key, query, starttime, endtime):
+        """ sorted distinct key values of query over both tiers, as calendar and stockid axes """
+        values = set(coll._get_collection().distinct(key, query))
+        if self.reaches(coll, starttime):
+            values.update(it[key] for it in self.cold(coll, query, starttime, endtime))
+        return sorted(values)
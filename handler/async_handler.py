@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# futures based async layer over his/id handlers
+# py2.7 has no asyncio, so every call runs on a shared thread pool and returns a
+# concurrent.futures.Future, pymongo pools its sockets per thread and tornado.gen
+# coroutines can yield the futures as they are
+# independent queries fan out together, latency is the slowest one instead of the sum
+# every task runs on the registry handler of its worker thread, so concurrent queries
+# never share a handler and its per-query state (trader alias pool, ids)
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from handler.registry import get_handler
+
+__all__ = ['AsyncHisDBHandler', 'AsyncIdDBHandler', 'get_executor', 'gather']
+
+_lock = threading.Lock()
+_executors = {}
+
+
+def get_executor(max_workers=8):
+    """ shared pool per size in this process """
+    with _lock:
+        if max_workers not in _executors:
+            _executors[max_workers] = ThreadPoolExecutor(max_workers=max_workers)
+        return _executors[max_workers]
+
+
+def gather(futures, timeout=None):
+    """ results in futures order, first failure raised as soon as it happens """
+    done, pending = wait(futures, timeout=timeout, return_when=FIRST_EXCEPTION)
+    for it in futures:
+        if it in done and it.exception():
+            for f in pending:
+                f.cancel()
+            raise it.exception()
+    return [it.result(timeout=0) for it in futures]
+
+
+class AsyncHisDBHandler(object):
+    """ ref tests.py
+    db = AsyncHisDBHandler(TwseHisDBHandler, debug=True)
+    fs = [db.query_raw(target, starttime, endtime, stockids) for target in ['stock', 'credit']]
+    stockitem, credititem = gather(fs)
+    """
+
+    def __init__(self, cls, max_workers=8, **kwargs):
+        self._cls = cls
+        self._kwargs = kwargs
+        self._executor = get_executor(max_workers)
+
+    @property
+    def db(self):
+        """ handler of the calling thread """
+        return get_handler(self._cls, **self._kwargs)
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def _call(self, target, callback, *args, **kwargs):
+        # worker side, handler of this worker thread
+        ptr = getattr(get_handler(self._cls, **self._kwargs), target)
+        if callback:
+            kwargs.update({'callback': getattr(ptr, callback)})
+        return ptr.query_raw(*args, **kwargs)
+
+    def query_raw(self, target, *args, **kwargs):
+        """ Future of getattr(db, target).query_raw(*args, **kwargs) """
+        return self.submit(self._call, target, None, *args, **kwargs)
+
+    def to_pandas(self, target, *args, **kwargs):
+        """ Future of query_raw with target to_pandas as callback """
+        return self.submit(self._call, target, 'to_pandas', *args, **kwargs)
+
+    def to_frame(self, target, *args, **kwargs):
+        return self.submit(self._call, target, 'to_frame', *args, **kwargs)
+
+
+class AsyncIdDBHandler(object):
+    """ ref tests.py
+    db = AsyncIdDBHandler(TwseIdDBHandler, debug=True)
+    name = db.call('stock', 'get_name', '2317').result()
+    """
+
+    def __init__(self, cls, max_workers=8, **kwargs):
+        self._cls = cls
+        self._kwargs = kwargs
+        self._executor = get_executor(max_workers)
+
+    @property
+    def db(self):
+        """ handler of the calling thread """
+        return get_handler(self._cls, **self._kwargs)
+
+    def _call(self, target, method, *args, **kwargs):
+        return getattr(getattr(get_handler(self._cls, **self._kwargs), target), method)(*args, **kwargs)
+
+    def call(self, target, method, *args, **kwargs):
+        """ Future of getattr(db, target).<method>(*args, **kwargs) """
+        return self._executor.submit(self._call, target, method, *args, **kwargs)
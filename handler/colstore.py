@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# local columnar his store, one memory-mapped array per (market, field)
+# <rootpath>/colstore/<opt>/
+#   dates.npy       datetime64[ns] date axis
+#   stockids.npy    stockid axis
+#   <field>.npy     (stockid, date) float64/int64 matrix
+# built nightly from his stock colls, read back as zero-copy numpy views
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from bin.mongodb_driver import MongoDBDriver
+from handler.frame import to_panel
+
+__all__ = ['ColumnStore']
+
+# StockData fields as column dtype, missing day as nan/0
+fields = OrderedDict([
+    ('open', np.float64),
+    ('high', np.float64),
+    ('low', np.float64),
+    ('close', np.float64),
+    ('price', np.float64),
+    ('volume', np.int64)
+])
+
+
+class ColumnStore(object):
+    """ ref tests.py
+    store = ColumnStore(opt='twse')
+    store.build(dbhandler.stock.coll, starttime, endtime)
+    dates = store.dates(starttime, endtime)
+    views = store.read(['2317'], starttime, endtime)
+    """
+
+    def __init__(self, opt='twse', rootpath=None, debug=False):
+        self._opt = opt
+        self._debug = debug
+        rootpath = rootpath if rootpath else MongoDBDriver._rootpath
+        self._path = os.path.join(rootpath, 'colstore', opt if not debug else 'test' + opt)
+        self._dates = None
+        self._stockids = None
+        self._index = {}
+        self._arrays = {}
+
+    @property
+    def path(self):
+        return self._path
+
+    def exists(self):
+        return os.path.exists(os.path.join(self._path, 'dates.npy'))
+
+    def build(self, coll, starttime, endtime, chunk=10000, archive=None):
+        """ rebuild store from his stock coll over [starttime, endtime],
+        axes come from distinct, the cursor streams in chunks of docs straight into
+        preallocated memory-mapped arrays, so the window never sits in memory as docs
+        swap the new dir in as a whole so readers never see half written arrays
+        archive: window reaching it reads both tiers, ref archive.read
+        """
+        query = {'date': {'$gte': starttime, '$lte': endtime}, 'data': {'$exists': True}}
+        projection = {'_id': 0, 'stockid': 1, 'date': 1, 'data': 1}
+        pcoll = coll._get_collection()
+        if archive is not None:
+            dates = archive.distinct(coll, 'date', query, starttime, endtime)
+            stockids = archive.distinct(coll, 'stockid', query, starttime, endtime)
+            cursor = archive.read(coll, query, starttime, endtime, projection, batch_size=chunk)
+        else:
+            dates = sorted(pcoll.distinct('date', query))
+            stockids = sorted(pcoll.distinct('stockid', query))
+            cursor = pcoll.find(query, projection).batch_size(chunk)
+        dindex = {d: i for i, d in enumerate(dates)}
+        sindex = {s: i for i, s in enumerate(stockids)}
+        tmppath = self._path + '.tmp'
+        if os.path.exists(tmppath):
+            shutil.rmtree(tmppath)
+        os.makedirs(tmppath)
+        arrays = OrderedDict()
+        for k, dtype in fields.items():
+            arrays[k] = np.lib.format.open_memmap(
+                os.path.join(tmppath, '%s.npy' % (k)), mode='w+', dtype=dtype, shape=(len(stockids), len(dates)))
+            arrays[k][:] = np.nan if dtype == np.float64 else 0
+        n, rows = 0, []
+        for it in cursor:
+            rows.append(it)
+            if len(rows) >= chunk:
+                n += self._fill(arrays, rows, sindex, dindex)
+                rows = []
+        n += self._fill(arrays, rows, sindex, dindex)
+        for arr in arrays.values():
+            arr.flush()
+        del arrays
+        np.save(os.path.join(tmppath, 'dates.npy'), np.array(dates, dtype='datetime64[ns]'))
+        np.save(os.path.join(tmppath, 'stockids.npy'), np.array(stockids, dtype='S16'))
+        if os.path.exists(self._path):
+            shutil.rmtree(self._path)
+        os.rename(tmppath, self._path)
+        self.close()
+        return {'stockids': len(stockids), 'dates': len(dates), 'rows': n}
+
+    def _fill(self, arrays, rows, sindex, dindex):
+        """ scatter one chunk of docs into arrays, return docs written """
+        if not rows:
+            return 0
+        i = np.array([sindex[it['stockid']] for it in rows], dtype=np.intp)
+        j = np.array([dindex[it['date']] for it in rows], dtype=np.intp)
+        for k, arr in arrays.items():
+            values = [it['data'].get(k, None) for it in rows]
+            has = np.array([v is not None for v in values], dtype=bool)
+            arr[i[has], j[has]] = np.array([v for v in values if v is not None], dtype=arr.dtype)
+        return len(rows)
+
+    def open(self):
+        if self._dates is None:
+            self._dates = np.load(os.path.join(self._path, 'dates.npy'), mmap_mode='r')
+            self._stockids = np.load(os.path.join(self._path, 'stockids.npy'))
+            self._index = {s: i for i, s in enumerate(self._stockids)}
+        return self
+
+    def close(self):
+        self._dates = None
+        self._stockids = None
+        self._index = {}
+        self._arrays = {}
+
+    def array(self, field):
+        """ whole (stockid, date) matrix of field as read-only mmap """
+        self.open()
+        if field not in self._arrays:
+            self._arrays[field] = np.load(os.path.join(self._path, '%s.npy' % (field)), mmap_mode='r')
+        return self._arrays[field]
+
+    def window(self, starttime=None, endtime=None):
+        """ [start, end) date axis positions of [starttime, endtime] """
+        self.open()
+        s = np.searchsorted(self._dates, np.datetime64(starttime, 'ns'), 'left') if starttime else 0
+        e = np.searchsorted(self._dates, np.datetime64(endtime, 'ns'), 'right') if endtime else len(self._dates)
+        return s, e
+
+    def dates(self, starttime=None, endtime=None):
+        s, e = self.window(starttime, endtime)
+        return self._dates[s:e]
+
+    def stockids(self):
+        self.open()
+        return list(self._stockids)
+
+    def block(self, field, starttime=None, endtime=None):
+        """ all stockids x date range of field as one view """
+        s, e = self.window(starttime, endtime)
+        return self.array(field)[:, s:e]
+
+    def read(self, stockids=[], starttime=None, endtime=None, names=None):
+        """ {stockid: {field: view}}, each a zero-copy row slice of the mmap """
+        s, e = self.window(starttime, endtime)
+        names = names if names else fields.keys()
+        stockids = stockids if stockids else self.stockids()
+        item = OrderedDict()
+        for stockid in stockids:
+            i = self._index.get(stockid, None)
+            if i is None:
+                continue
+            item[stockid] = OrderedDict((k, self.array(k)[i, s:e]) for k in names)
+        return item
+
+    def to_frame(self, stockids=[], starttime=None, endtime=None):
+        """ long df indexed by (stockid, date) as TwseStockHisDBHandler.to_frame, days without trade dropped """
+        dates = pd.DatetimeIndex(np.asarray(self.dates(starttime, endtime))).tz_localize('UTC')
+        views = self.read(stockids, starttime, endtime)
+        if not views or not len(dates):
+            return pd.DataFrame()
+        index = pd.MultiIndex.from_product([views.keys(), dates], names=['stockid', 'date'])
+        df = pd.DataFrame(OrderedDict(
+            (k, np.concatenate([v[k] for v in views.values()])) for k in fields.keys()), index=index)
+        return df[df['close'].notnull()].fillna(0)
+
+    def to_pandas(self, stockids=[], starttime=None, endtime=None):
+        """ same Panel layout as TwseStockHisDBHandler.to_pandas """
+        return to_panel(self.to_frame(stockids, starttime, endtime))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# single pass builders from query_raw items to pandas
+# long frame indexed as MultiIndex (<key>, date), Panel kept as compat view
+
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+__all__ = ['to_frame', 'to_panel']
+
+
+def to_frame(cursor, key='stockid', names=None, prefix=None):
+    """ query_raw items to long frame
+    <stockid> <date>      open| high| low| ...
+    2317      20140928    100 | 101 | 99 | ...
+    2317      20140929    100 | 102 | 98 | ...
+    2330      20140928    ...
+    key: item field as 1st index level, stockid or traderid
+    names: datalist fields as columns, all but date if None
+    prefix: item field as column prefix, like trader alias top0_buyvolume
+    """
+    ids, dates = [], []
+    columns = OrderedDict()
+    n = 0
+    for it in cursor:
+        pre = "%s_" % (it[prefix]) if prefix else ''
+        for i in it['datalist']:
+            date = i.get('date', None)
+            if not date:
+                continue
+            ids.append(it[key])
+            dates.append(date)
+            for k in names if names else i.iterkeys():
+                if k == 'date':
+                    continue
+                col = columns.get(pre + k, None)
+                if col is None:
+                    col = columns[pre + k] = [np.nan] * n
+                col.append(i.get(k, np.nan))
+            n += 1
+            for col in columns.itervalues():
+                if len(col) < n:
+                    col.append(np.nan)
+    if not n:
+        return pd.DataFrame()
+    index = pd.MultiIndex.from_arrays(
+        [ids, pd.DatetimeIndex(dates).tz_localize('UTC')], names=[key, 'date'])
+    df = pd.DataFrame(columns, index=index)
+    if prefix:
+        # one row per (key, date) across prefixes
+        df = df.groupby(level=[0, 1]).first()
+    return df.fillna(0).sortlevel()
+
+
+def to_panel(df):
+    """ compat Panel view of long frame, items=<key>, major=date, minor=field """
+    if df.empty:
+        return pd.Panel()
+    return df.to_panel().transpose(1, 2, 0)
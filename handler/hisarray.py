@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+# dense (stockid, date, field) float64 array over his colls
+# dates are the market trading calendar, so every stock/target lines up on the same axis
+# missing days/fields are nan, no per-stock DataFrame is built on the way
+
+import numpy as np
+from collections import OrderedDict
+
+__all__ = ['fields', 'to_array']
+
+
+def _path(path):
+    def get(it):
+        for k in path.split('.'):
+            it = it.get(k, None) if isinstance(it, dict) else None
+        return it
+    return get
+
+
+def _toplist(key):
+    def get(it):
+        return sum(t['data'].get(key, 0) for t in it.get('toplist', []) if 'data' in t)
+    return get
+
+# target -> field -> value of raw his doc
+fields = OrderedDict([
+    ('stock', OrderedDict([
+        ('open', _path('data.open')),
+        ('high', _path('data.high')),
+        ('low', _path('data.low')),
+        ('close', _path('data.close')),
+        ('volume', _path('data.volume'))
+    ])),
+    ('trader', OrderedDict([
+        ('topbuyvolume', _toplist('buyvolume')),
+        ('topsellvolume', _toplist('sellvolume'))
+    ])),
+    ('credit', OrderedDict([
+        ('financebuyvolume', _path('finance.buyvolume')),
+        ('financesellvolume', _path('finance.sellvolume')),
+        ('financeremain', _path('finance.curremain')),
+        ('bearishbuyvolume', _path('bearish.buyvolume')),
+        ('bearishsellvolume', _path('bearish.sellvolume')),
+        ('bearishremain', _path('bearish.curremain'))
+    ])),
+    ('future', OrderedDict([
+        ('futureopen', _path('future.open')),
+        ('futurehigh', _path('future.high')),
+        ('futurelow', _path('future.low')),
+        ('futureclose', _path('future.close')),
+        ('futurevolume', _path('future.volume'))
+    ]))
+])
+
+
+def to_array(colls, stockids, dates, names=None, archive=None):
+    """ fill one (stockid, date, field) array from {target: coll}
+    names: field subset, all fields of given targets by default
+    archive: dates reaching it read both tiers, ref archive.read
+    return array, field labels
+    """
+    labels = [(t, k) for t in colls.keys() for k in fields[t].keys() if not names or k in names]
+    sindex = {s: i for i, s in enumerate(stockids)}
+    dindex = {d: i for i, d in enumerate(dates)}
+    array = np.full((len(stockids), len(dates), len(labels)), np.nan, dtype=np.float64)
+    if not len(dates):
+        return array, [k for t, k in labels]
+    for target, coll in colls.items():
+        cols = [(j, fields[t][k]) for j, (t, k) in enumerate(labels) if t == target]
+        if not cols:
+            continue
+        query = {'stockid': {'$in': list(stockids)}, 'date': {'$gte': dates[0], '$lte': dates[-1]}}
+        projection = {'stockid': 1, 'date': 1, 'data': 1, 'toplist': 1, 'finance': 1, 'bearish': 1, 'future': 1}
+        if archive is not None:
+            cursor = archive.read(coll, query, dates[0], dates[-1], projection)
+        else:
+            cursor = coll._get_collection().find(query, projection)
+        for it in cursor:
+            d = dindex.get(it['date'], None)
+            if d is None:
+                continue
+            row = array[sindex[it['stockid']], d]
+            for j, get in cols:
+                v = get(it)
+                if v is not None:
+                    row[j] = v
+    return array, [k for t, k in labels]
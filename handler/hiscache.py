@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+# size bounded LRU cache in front of collect_hisitem/collect_hisframe
+# key: (market, target, starttime, endtime, stockid-set hash, base, limit, ...)
+# every entry remembers the market data version it was computed on,
+# pipelines publish a new version after writes so stale entries drop on next get
+# optional write-through pickle files under <rootpath>/hiscache/<market>/
+# values are deep copied in and out, callers can't mutate what the next hit sees
+
+import os
+import copy
+import json
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from bin.mongodb_driver import MongoDBDriver
+
+__all__ = ['HisCache', 'make_key']
+
+
+def _hash(ids):
+    return hashlib.sha1(','.join(sorted(set(ids)))).hexdigest()[:16] if ids else ''
+
+
+def _spec(it):
+    """ lambda strings and declarative specs as stable key part """
+    if it is None or isinstance(it, basestring):
+        return it
+    return json.dumps(it, sort_keys=True)
+
+
+def make_key(opt, target, starttime, endtime, stockids=[], traderids=[], base='stock', limit=10, constraint=None, order=None, **kwargs):
+    """ constraint/order and extra kwargs (engine, layout, source) also change the result,
+    so they are part of the key as well, python callables can't be keyed and return None
+    """
+    if callable(constraint) or callable(order):
+        return None
+    return (
+        opt, target, starttime, endtime, _hash(stockids), _hash(traderids),
+        base, limit, _spec(constraint), _spec(order), tuple(sorted(kwargs.items())))
+
+
+class HisCache(object):
+    """ ref tests.py
+    cache = HisCache.get_cache('twse', dbhandler.version)
+    value = cache.get(key)
+    cache.put(key, value)
+    """
+
+    _pool = {}
+    _lock = threading.Lock()
+
+    # version stamp poll in secs
+    check = 5
+
+    @classmethod
+    def get_cache(cls, opt, version, maxsize=256, persist=False, debug=False):
+        """ one cache per (market, debug) in this process """
+        key = (opt, debug)
+        with cls._lock:
+            if key not in cls._pool:
+                cls._pool[key] = cls(opt, version, maxsize, persist, debug)
+            return cls._pool[key]
+
+    @classmethod
+    def clear_all(cls):
+        with cls._lock:
+            cls._pool = {}
+
+    def __init__(self, opt, version, maxsize=256, persist=False, debug=False):
+        """ version: callable returning current market data version """
+        self._opt = opt
+        self._version = version
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self._current = None
+        self._checked = 0
+        self._lock = threading.RLock()
+        self._counters = {'hits': 0, 'misses': 0, 'stales': 0, 'evictions': 0}
+        self._path = None
+        if persist:
+            self._path = os.path.join(MongoDBDriver._rootpath, 'hiscache', opt if not debug else 'test' + opt)
+            if not os.path.exists(self._path):
+                os.makedirs(self._path)
+
+    @property
+    def stats(self):
+        stats = dict(self._counters)
+        stats.update({'size': len(self._entries), 'version': self._current})
+        return stats
+
+    def version(self):
+        now = time.time()
+        if self._current is None or now - self._checked > self.check:
+            self._current = self._version()
+            self._checked = now
+        return self._current
+
+    def _file(self, key):
+        return os.path.join(self._path, hashlib.sha1(repr(key)).hexdigest() + '.pkl')
+
+    def _load(self, key):
+        if not self._path or not os.path.exists(self._file(key)):
+            return None
+        try:
+            with open(self._file(key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _drop(self, key):
+        self._entries.pop(key, None)
+        if self._path and os.path.exists(self._file(key)):
+            os.remove(self._file(key))
+
+    def get(self, key):
+        """ copy of cached value or None on miss/stale """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                entry = self._load(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            if entry[0] != self.version():
+                self._drop(key)
+                self._counters['stales'] += 1
+                self._counters['misses'] += 1
+                return None
+            # most recently used at the end
+            self._entries[key] = entry
+            self._counters['hits'] += 1
+            return copy.deepcopy(entry[1])
+
+    def put(self, key, value):
+        with self._lock:
+            entry = (self.version(), copy.deepcopy(value))
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            if self._path:
+                with open(self._file(key), 'wb') as f:
+                    pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            while len(self._entries) > self._maxsize:
+                k, _ = self._entries.popitem(last=False)
+                self._drop(k)
+                self._counters['evictions'] += 1
+
+    def invalidate(self):
+        """ drop every entry, as after local writes """
+        with self._lock:
+            for k in self._entries.keys():
+                self._drop(k)
+            self._current = None
@@ -3,98 +3,387 @@
 import pandas as pd
 import json
 from bson import json_util
-import pytz
 import copy
+import threading
 from collections import OrderedDict, defaultdict
+from itertools import ifilter
 from datetime import datetime, timedelta
 from mongoengine import *
 from bin.start import switch
-from bin.mongodb_driver import MongoDBDriver
 from handler.iddb_handler import TwseIdDBHandler, OtcIdDBHandler
+from handler.registry import connect_db, get_handler, count
 from handler.models import *
+from handler.aggregate import *
+from handler.frame import *
+from handler import hisarray
+from handler import rawdb
+from handler.archive import Archive
+from handler.profiler import profiled
 # use mongoengine(high level mongodb drive) as ORM data backend for Django access
 
+_lock = threading.RLock()
+
+def to_mongo(doccls, it):
+    """ raw embedded doc dict, only cast field types without document validation """
+    return {k: f.to_mongo(it[k]) for k, f in doccls._fields.iteritems() if k not in ['id', '_cls'] and k in it}
+
+def bulk_upsert(coll, items, keys=('stockid', 'date')):
+    """ send items as one unordered bulk write keyed on (stockid, date)
+    items: [{'stockid': ..., 'date': ..., <field>: <raw value>}, ...]
+    return matched/upserted counts
+    """
+    if not items:
+        return {'matched': 0, 'upserted': 0}
+    bulk = coll._get_collection().initialize_unordered_bulk_op()
+    for it in items:
+        bulk.find({k: it[k] for k in keys}).upsert().update_one({
+            '$set': {k: v for k, v in it.iteritems() if k not in keys},
+            '$setOnInsert': {'_cls': coll._class_name}
+        })
+    result = bulk.execute()
+    return {'matched': result['nMatched'], 'upserted': result['nUpserted']}
+
+def percent(num, den):
+    """ num / den * 100 rounded as aggregate ratio(), 0 if den <= 0 """
+    return round(float(num) / den * 100, 2) if den > 0 else 0
+
+def period(date, frequency):
+    """ start day of the week/month date falls in """
+    date = datetime(date.year, date.month, date.day)
+    if frequency == 'week':
+        return date - timedelta(days=date.weekday())
+    if frequency == 'month':
+        return date.replace(day=1)
+    return date
+
+def next_period(start, frequency):
+    if frequency == 'week':
+        return start + timedelta(days=7)
+    return (start + timedelta(days=32)).replace(day=1)
+
+def his_window(coll, rollupcoll, frequency, starttime, endtime, query):
+    """ queryset of query over [starttime, endtime] days on coll,
+    or over week/month rollup rows dated on their period start on rollupcoll
+    """
+    if frequency in ['week', 'month']:
+        return rollupcoll.objects(
+            Q(frequency=frequency) & Q(date__gte=period(starttime, frequency)) & Q(date__lte=endtime) & query)
+    return coll.objects(Q(date__gte=starttime) & Q(date__lte=endtime) & query)
+
+def thawed(archive, coll, cursor, starttime, endtime, fields=[]):
+    """ merged hot and archived raw docs of cursor filter when [starttime, endtime] reaches the cold tier,
+    None as stay on the server
+    fields: the ones the pipeline reads, only those and the filter fields are decoded and sent
+    """
+    if not archive or not archive.reaches(coll, starttime):
+        return None
+    projection = rawdb.projection(fields)
+    projection.update({k: 1 for k in cursor._query.keys() if not k.startswith('$')})
+    return archive.thaw(coll, cursor._query, starttime, endtime, projection)
+
+def build_state(coll):
+    """ backfill marker of a coll derived from the day colls, ref bin/migrate.py backfill
+    {'_id': 'build_<coll>', 'last': <last built day or stockid>, 'done': True once complete}
+    """
+    name = 'build_%s' % (coll._get_collection_name())
+    return coll._get_db()['migrate_state'].find_one({'_id': name}) or {'_id': name}
+
+def is_built(coll):
+    """ derived coll fully backfilled, read paths serving from it switch on only then """
+    return bool(coll) and build_state(coll).get('done', False)
+
+def copy_data(coll, items):
+    """ copy stock day data onto per-domain coll docs sharing (stockid, date) key,
+    only updates docs already there
+    items: [{'stockid': ..., 'date': ..., 'data': <raw StockData>}, ...]
+    """
+    if not coll or not items:
+        return
+    bulk = coll._get_collection().initialize_unordered_bulk_op()
+    for it in items:
+        bulk.find({'stockid': it['stockid'], 'date': it['date']}).update({
+            '$set': {'data': it['data']}
+        })
+    bulk.execute()
+
+def sync_data(stockcoll, coll, keys):
+    """ pull stock day data of [(stockid, date), ...] from stock coll onto coll """
+    if not stockcoll or not keys:
+        return
+    cursor = stockcoll._get_collection().find(
+        {'$or': [{'stockid': stockid, 'date': date} for stockid, date in keys]},
+        {'stockid': 1, 'date': 1, 'data': 1})
+    copy_data(coll, [it for it in cursor if 'data' in it])
+
+
 class TwseHisDBHandler(object):
     """ ref tests.py
     """
 
     def __init__(self, **kwargs):
         self._debug = kwargs.pop('debug', False)
+        self._bulk = kwargs.pop('bulk', False)
+        self._engine = kwargs.pop('engine', 'aggregate')
         db = 'twsehisdb' if not self._debug else 'testtwsehisdb'
-        host, port = MongoDBDriver._host, MongoDBDriver._port
-        connect(db, host=host, port=port, alias=db)
-        twsehiscoll = switch(TwseHisColl, db)
+        connect_db(db)
+        twsestockcoll = switch(TwseHisStockColl, db)
+        twsetradercoll = switch(TwseHisTraderColl, db)
+        twsecreditcoll = switch(TwseHisCreditColl, db)
+        twsefuturecoll = switch(TwseHisFutureColl, db)
+        twsetraderstockcoll = switch(TwseTraderStockColl, db)
+        twsesummarycoll = switch(TwseHisSummaryColl, db)
+        twselatestcoll = switch(TwseHisLatestColl, db)
+        twserollupcoll = switch(TwseHisRollupColl, db)
+        archive = Archive(opt='twse', debug=self._debug)
         kwargs = {
             'stock': {
-                'coll': twsehiscoll,
-                'debug': self._debug
+                'coll': twsestockcoll,
+                'archive': archive,
+                'rollupcoll': twserollupcoll,
+                'syncs': [twsetradercoll, twsefuturecoll],
+                'invcoll': twsetraderstockcoll,
+                'debug': self._debug,
+                'bulk': self._bulk,
+                'engine': self._engine
             },
             'trader': {
-                'coll': twsehiscoll,
-                'debug': self._debug
+                'coll': twsetradercoll,
+                'archive': archive,
+                'rollupcoll': twserollupcoll,
+                'stockcoll': twsestockcoll,
+                'invcoll': twsetraderstockcoll,
+                'debug': self._debug,
+                'bulk': self._bulk,
+                'engine': self._engine
             },
             'credit': {
-                'coll': twsehiscoll,
-                'debug': self._debug
+                'coll': twsecreditcoll,
+                'archive': archive,
+                'rollupcoll': twserollupcoll,
+                'debug': self._debug,
+                'bulk': self._bulk,
+                'engine': self._engine
             },
             'future': {
-                'coll': twsehiscoll,
+                'coll': twsefuturecoll,
+                'archive': archive,
+                'rollupcoll': twserollupcoll,
+                'stockcoll': twsestockcoll,
+                'debug': self._debug,
+                'bulk': self._bulk,
+                'engine': self._engine
+            },
+            'summary': {
+                'coll': twsesummarycoll,
+                'stockcoll': twsestockcoll,
+                'tradercoll': twsetradercoll,
+                'creditcoll': twsecreditcoll,
+                'futurecoll': twsefuturecoll,
+                'debug': self._debug,
+                'bulk': self._bulk,
+                'engine': self._engine
+            },
+            'latest': {
+                'coll': twselatestcoll,
+                'stockcoll': twsestockcoll,
+                'tradercoll': twsetradercoll,
+                'creditcoll': twsecreditcoll,
+                'futurecoll': twsefuturecoll,
+                'debug': self._debug
+            },
+            'rollup': {
+                'coll': twserollupcoll,
+                'stockcoll': twsestockcoll,
+                'tradercoll': twsetradercoll,
+                'creditcoll': twsecreditcoll,
+                'futurecoll': twsefuturecoll,
                 'debug': self._debug
             }
         }
-        self._stock = TwseStockHisDBHandler(**kwargs['stock'])
-        self._trader = TwseTraderHisDBHandler(**kwargs['trader'])
-        self._credit = TwseCreditHisDBHandler(**kwargs['credit'])
-        self._future = TwseFutureHisDBHandler(**kwargs['future'])
+        # sub handlers are built on first access
+        self._kwargs = kwargs
+        self._targets = {
+            'stock': TwseStockHisDBHandler,
+            'trader': TwseTraderHisDBHandler,
+            'credit': TwseCreditHisDBHandler,
+            'future': TwseFutureHisDBHandler,
+            'summary': TwseSummaryHisDBHandler,
+            'latest': TwseLatestHisDBHandler,
+            'rollup': TwseRollupHisDBHandler
+        }
+        self._handlers = {}
+
+    def _get(self, target):
+        # async layer reaches sub handlers from pool threads
+        with _lock:
+            if target not in self._handlers:
+                self._handlers[target] = self._targets[target](**self._kwargs[target])
+                count('subhandler')
+            return self._handlers[target]
+
+    def _versions(self):
+        return self._kwargs['stock']['coll']._get_db()['data_version']
+
+    def version(self):
+        """ market data version, bumped by publish() """
+        it = self._versions().find_one({'_id': 'his'})
+        return it['version'] if it else 0
+
+    def publish(self):
+        """ tell query caches of every process that his data changed """
+        self._versions().update({'_id': 'his'}, {'$inc': {'version': 1}}, upsert=True)
+
+    def refresh(self, item, target=None):
+        """ bring summary/latest/rollup colls in step after insert_raw of target, then publish,
+        rollup applies only the day delta of target, every part rebuilt when target is None
+        """
+        self._get('summary').update(item)
+        self._get('latest').update(item)
+        self._get('rollup').update(item, target)
+        self.publish()
+
+    def calendar(self, starttime, endtime):
+        """ market trading days in [starttime, endtime] """
+        kwargs = self._kwargs['stock']
+        return kwargs['archive'].distinct(kwargs['coll'], 'date', {'date': {'$gte': starttime, '$lte': endtime}}, starttime, endtime)
+
+    def to_array(self, stockids, starttime, endtime, targets=['stock'], names=None):
+        """ dense (stockid, date, field) float64 array of targets aligned on the market calendar
+        stockids: axis order as given, all stocks traded in range if empty
+        names: field subset, ref hisarray.fields
+        return array, {'stockid': [...], 'date': [...], 'field': [...]}
+        """
+        if not stockids:
+            kwargs = self._kwargs['stock']
+            stockids = kwargs['archive'].distinct(kwargs['coll'], 'stockid', {'date': {'$gte': starttime, '$lte': endtime}}, starttime, endtime)
+        dates = self.calendar(starttime, endtime)
+        colls = OrderedDict((t, self._kwargs[t]['coll']) for t in targets)
+        array, labels = hisarray.to_array(colls, stockids, dates, names, self._kwargs['stock']['archive'])
+        return array, {'stockid': list(stockids), 'date': dates, 'field': labels}
 
     @property
     def stock(self):
-        return self._stock
+        return self._get('stock')
 
     @property
     def trader(self):
-        return self._trader
+        return self._get('trader')
 
     @property
     def credit(self):
-        return self._credit
+        return self._get('credit')
 
     @property
     def future(self):
-        return self._future
+        return self._get('future')
+
+    @property
+    def summary(self):
+        return self._get('summary')
+
+    @property
+    def latest(self):
+        return self._get('latest')
+
+    @property
+    def rollup(self):
+        return self._get('rollup')
 
 
 class OtcHisDBHandler(TwseHisDBHandler):
 
     def __init__(self, **kwargs):
-        super(OtcHisDBHandler, self).__init__(**copy.deepcopy(kwargs))
         self._debug = kwargs.pop('debug', False)
+        self._bulk = kwargs.pop('bulk', False)
+        self._engine = kwargs.pop('engine', 'aggregate')
         db = 'otchisdb' if not self._debug else 'testotchisdb'
-        host, port = MongoDBDriver._host, MongoDBDriver._port
-        connect(db, host=host, port=port, alias=db)
-        otchiscoll = switch(OtcHisColl, db)
+        connect_db(db)
+        otcstockcoll = switch(OtcHisStockColl, db)
+        otctradercoll = switch(OtcHisTraderColl, db)
+        otccreditcoll = switch(OtcHisCreditColl, db)
+        otcfuturecoll = switch(OtcHisFutureColl, db)
+        otctraderstockcoll = switch(OtcTraderStockColl, db)
+        otcsummarycoll = switch(OtcHisSummaryColl, db)
+        otclatestcoll = switch(OtcHisLatestColl, db)
+        otcrollupcoll = switch(OtcHisRollupColl, db)
+        archive = Archive(opt='otc', debug=self._debug)
         kwargs = {
             'stock': {
-                'coll': otchiscoll,
-                'debug': self._debug
+                'coll': otcstockcoll,
+                'archive': archive,
+                'rollupcoll': otcrollupcoll,
+                'syncs': [otctradercoll, otcfuturecoll],
+                'invcoll': otctraderstockcoll,
+                'debug': self._debug,
+                'bulk': self._bulk,
+                'engine': self._engine
             },
             'trader': {
-                'coll': otchiscoll,
-                'debug': self._debug
+                'coll': otctradercoll,
+                'archive': archive,
+                'rollupcoll': otcrollupcoll,
+                'stockcoll': otcstockcoll,
+                'invcoll': otctraderstockcoll,
+                'debug': self._debug,
+                'bulk': self._bulk,
+                'engine': self._engine
             },
             'credit': {
-                'coll': otchiscoll,
-                'debug': self._debug
+                'coll': otccreditcoll,
+                'archive': archive,
+                'rollupcoll': otcrollupcoll,
+                'debug': self._debug,
+                'bulk': self._bulk,
+                'engine': self._engine
             },
             'future': {
-                'coll': otchiscoll,
+                'coll': otcfuturecoll,
+                'archive': archive,
+                'rollupcoll': otcrollupcoll,
+                'stockcoll': otcstockcoll,
+                'debug': self._debug,
+                'bulk': self._bulk,
+                'engine': self._engine
+            },
+            'summary': {
+                'coll': otcsummarycoll,
+                'stockcoll': otcstockcoll,
+                'tradercoll': otctradercoll,
+                'creditcoll': otccreditcoll,
+                'futurecoll': otcfuturecoll,
+                'debug': self._debug,
+                'bulk': self._bulk,
+                'engine': self._engine
+            },
+            'latest': {
+                'coll': otclatestcoll,
+                'stockcoll': otcstockcoll,
+                'tradercoll': otctradercoll,
+                'creditcoll': otccreditcoll,
+                'futurecoll': otcfuturecoll,
+                'debug': self._debug
+            },
+            'rollup': {
+                'coll': otcrollupcoll,
+                'stockcoll': otcstockcoll,
+                'tradercoll': otctradercoll,
+                'creditcoll': otccreditcoll,
+                'futurecoll': otcfuturecoll,
                 'debug': self._debug
             }
         }
-        self._stock = OtcStockHisDBHandler(**kwargs['stock'])
-        self._trader = OtcTraderHisDBHandler(**kwargs['trader'])
-        self._credit = OtcCreditHisDBHandler(**kwargs['credit'])
-        self._future = OtcFutureHisDBHandler(**kwargs['future'])
+        # sub handlers are built on first access
+        self._kwargs = kwargs
+        self._targets = {
+            'stock': OtcStockHisDBHandler,
+            'trader': OtcTraderHisDBHandler,
+            'credit': OtcCreditHisDBHandler,
+            'future': OtcFutureHisDBHandler,
+            'summary': OtcSummaryHisDBHandler,
+            'latest': OtcLatestHisDBHandler,
+            'rollup': OtcRollupHisDBHandler
+        }
+        self._handlers = {}
 
 
 class TwseStockHisDBHandler(object):
@@ -102,13 +391,19 @@ class TwseStockHisDBHandler(object):
     def __init__(self, **kwargs):
         self._coll = kwargs.pop('coll', None)
         self._debug = kwargs.pop('debug', False)
+        self._bulk = kwargs.pop('bulk', False)
+        self._engine = kwargs.pop('engine', 'aggregate')
+        self._invcoll = kwargs.pop('invcoll', None)
+        self._syncs = kwargs.pop('syncs', [])
+        self._rollupcoll = kwargs.pop('rollupcoll', None)
+        self._archive = kwargs.pop('archive', None)
         kwargs = {
             'id': {
                 'debug': self._debug,
                 'opt': 'twse'
             }
         }
-        self._id = TwseIdDBHandler(**kwargs['id'])
+        self._id = get_handler(TwseIdDBHandler, **kwargs['id'])
         self._ids = []
 
     @property
@@ -123,6 +418,18 @@ class TwseStockHisDBHandler(object):
     def coll(self):
         return self._coll
 
+    @profiled('stock', lambda self: self._coll._get_db())
+    def find_raw(self, starttime, endtime, stockids=[], fields=None):
+        """ fast path, raw doc dicts of window by pymongo, no Document built
+        fields: projection, rawdb.projections['stock'] by default
+        """
+        fields = fields if fields else rawdb.projections['stock']
+        return rawdb.find_raw(self._coll, starttime, endtime, stockids, fields, self._archive)
+
+    def to_columns(self, starttime, endtime, stockids=[], fields=None):
+        """ fast path, find_raw docs as {path: numpy array} """
+        return rawdb.to_columns(self.find_raw(starttime, endtime, stockids, fields))
+
     def update_raw(self, item):
         pass
 
@@ -131,6 +438,17 @@ class TwseStockHisDBHandler(object):
 
     def insert_raw(self, item):
         """ bulk update stock part """
+        if self._bulk:
+            raw = [{
+                'stockid': it['stockid'],
+                'date': it['date'],
+                'data': to_mongo(StockData, it)
+            } for it in item]
+            result = bulk_upsert(self._coll, raw)
+            for coll in self._syncs:
+                copy_data(coll, raw)
+            self._update_inverted(item)
+            return result
         keys = [k for k,v in StockData._fields.iteritems() if k not in ['id', '_cls']]
         for it in item:
             data = {k:v for k, v in it.items() if k in keys}
@@ -142,13 +460,30 @@ class TwseStockHisDBHandler(object):
             coll.date = it['date']
             coll.data = data
             coll.save()
+        for coll in self._syncs:
+            sync_data(self._coll, coll, [(it['stockid'], it['date']) for it in item])
+        self._update_inverted(item)
+
+    def _update_inverted(self, item):
+        """ keep day volume on trader inverted coll as buy/sell ratio base """
+        if not self._invcoll or not item:
+            return
+        bulk = self._invcoll._get_collection().initialize_unordered_bulk_op()
+        for it in item:
+            bulk.find({'stockid': it['stockid'], 'date': it['date']}).update({
+                '$set': {'volume': int(it['volume'])}
+            })
+        bulk.execute()
 
-    def query_raw(self, starttime, endtime, stockids=[], base='stock', constraint=None, order=None, limit=10, callback=None):
+    @profiled('stock', lambda self: self._coll._get_db())
+    def query_raw(self, starttime, endtime, stockids=[], base='stock', constraint=None, order=None, limit=10, callback=None, stream=False, frequency='day', fields=None):
         """ return orm
         <stockid>                               | <stockid> ...
                     open| high| low|close|volume|          | open | ...
         20140928    100 | 101 | 99 | 100 | 100  | 20140928 | 11   | ...
         20140929    100 | 102 | 98 | 99  | 99   | 20140929 | 11   | ...
+        frequency: 'week'/'month' reads rollup rows dated on period start instead of days
+        fields: projection read from coll, rawdb.projections['stock'] by default, aggregate engine only
         """
         map_f = """
             function () {
@@ -227,46 +562,89 @@ class TwseStockHisDBHandler(object):
         """
         finalize_f = """
         """
+        pipeline = [
+            {'$match': {'data': {'$exists': True}}},
+            {'$sort': {'date': 1}},
+            {'$project': {
+                'stockid': 1,
+                'date': 1,
+                'data': 1,
+                'hldiff': absolute({'$subtract': ['$data.high', '$data.low']}),
+                'ocdiff': absolute({'$subtract': ['$data.open', '$data.close']})
+            }},
+            {'$group': {
+                '_id': {'stockid': '$stockid'},
+                'sopen': {'$first': '$data.open'},
+                'sclose': {'$first': '$data.close'},
+                'svolume': {'$first': '$data.volume'},
+                'eopen': {'$last': '$data.open'},
+                'eclose': {'$last': '$data.close'},
+                'evolume': {'$last': '$data.volume'},
+                'totalvolume': {'$sum': '$data.volume'},
+                'totalhldiff': {'$sum': '$hldiff'},
+                'totalocdiff': {'$sum': '$ocdiff'},
+                'avgvolume': {'$avg': '$data.volume'},
+                'data': {'$push': {
+                    'date': '$date',
+                    'open': '$data.open',
+                    'high': '$data.high',
+                    'low': '$data.low',
+                    'close': '$data.close',
+                    'price': '$data.close',
+                    'volume': '$data.volume'
+                }}
+            }}
+        ]
+        rounds = ['totalhldiff', 'totalocdiff', 'avgvolume']
         bufwin = (endtime - starttime).days
-        cursor = self._coll.objects(Q(date__gte=starttime) & Q(date__lte=endtime) & Q(stockid__in=stockids))
-        results = list(cursor.map_reduce(map_f, reduce_f, 'stockmap'))
-        if constraint:
-            results = filter(constraint, results)
-        if order:
-            results = sorted(results, key=order)[:limit]
-        retval = []
-        for it in results:
-            coll = { 'datalist': [] }
-            for data in sorted(it.value['data'], key=lambda x: x['date']):
-                coll['datalist'].append(data)
-            coll.update({
-                # key
-                'date': endtime,
-                'bufwin': bufwin,
-                'stockid': it.key['stockid'],
-                'stocknm': self._id.stock.get_name(it.key['stockid']),
-                # value
-                'totalvolume': it.value['totalvolume'],
-                'totalhldiff': it.value['totalhldiff'],
-                'totalocdiff': it.value['totalocdiff']
-            })
-            retval.append(coll)
+        cursor = his_window(self._coll, self._rollupcoll, frequency, starttime, endtime, Q(stockid__in=stockids))
+        archive = self._archive if frequency not in ['week', 'month'] else None
+        docs = thawed(archive, self._coll, cursor, starttime, endtime, fields if fields else rawdb.projections['stock'])
+        # map_f runs on the server only, windows reaching the archive take the pipeline in process
+        # fields order sorts on stay on the records, so a merge across markets can sort them again
+        carry = order_fields(order, ['stockid'])
+        if fields:
+            check_fields(pipeline, fields, constraint, order, ['stockid'], self._engine)
+        if self._engine == 'mapreduce' and docs is None:
+            constraint, order = callbacks(constraint, order, ['stockid'])
+            results = cursor.map_reduce(map_f, reduce_f, 'stockmap')
+        else:
+            # only fields the pipeline reads leave the server
+            pipeline.insert(1, project(fields if fields else rawdb.projections['stock']))
+            stages, constraint, order = pushdown(constraint, order, limit, ['stockid'])
+            stages = ordered(stages, ['stockid']) if stream else stages
+            results = aggregate(cursor, pipeline + stages, rounds, docs)
+        results = select(results, constraint, order, limit)
+
+        def iter_results(results):
+            for it in results:
+                coll = { 'datalist': [] }
+                for data in sorted(it.value['data'], key=lambda x: x['date']):
+                    coll['datalist'].append(data)
+                coll.update({
+                    # key
+                    'date': endtime,
+                    'bufwin': bufwin,
+                    'stockid': it.key['stockid'],
+                    'stocknm': self._id.stock.get_name(it.key['stockid']),
+                    # value
+                    'totalvolume': it.value['totalvolume'],
+                    'totalhldiff': it.value['totalhldiff'],
+                    'totalocdiff': it.value['totalocdiff']
+                })
+                coll.update({k: it.value[k] for k in carry if k in it.value})
+                yield coll
+
+        retval = iter_results(results) if stream else list(iter_results(results))
         return callback(retval) if callback else retval
 
+    def to_frame(self, cursor):
+        """ callback as long df indexed by (stockid, date) """
+        return to_frame(cursor, 'stockid')
+
     def to_pandas(self, cursor):
         """ callback as pandas df """
-        item = OrderedDict()
-        for it in cursor:
-            index, data = [], []
-            for i in it['datalist']:
-                date = i.pop('date', None)
-                if date:
-                    index.append(pytz.timezone('UTC').localize(date))
-                    data.append(i)
-            if index and data:
-                id = it['stockid']
-                item.update({id: pd.DataFrame(data, index=index).fillna(0)})
-        return pd.Panel(item)
+        return to_panel(self.to_frame(cursor))
 
 
 class TwseTraderHisDBHandler(object):
@@ -274,13 +652,22 @@ class TwseTraderHisDBHandler(object):
     def __init__(self, **kwargs):
         self._coll = kwargs['coll']
         self._debug = kwargs['debug']
+        self._bulk = kwargs.get('bulk', False)
+        self._engine = kwargs.get('engine', 'aggregate')
+        self._stockcoll = kwargs.get('stockcoll', None)
+        self._invcoll = kwargs.get('invcoll', None)
+        self._archive = kwargs.get('archive', None)
+        self._rollupcoll = kwargs.get('rollupcoll', None)
+        # None follows the invcoll backfill marker, True/False forces it
+        self._inverted = kwargs.get('inverted', None)
+        self._built = False
         kwargs = {
             'id': {
                 'debug': self._debug,
                 'opt': 'twse'
             }
         }
-        self._id = TwseIdDBHandler(**kwargs['id'])
+        self._id = get_handler(TwseIdDBHandler, **kwargs['id'])
         self._cache = []
         self._ids = []
 
@@ -296,6 +683,18 @@ class TwseTraderHisDBHandler(object):
     def coll(self):
         return self._coll
 
+    @profiled('trader', lambda self: self._coll._get_db())
+    def find_raw(self, starttime, endtime, stockids=[], fields=None):
+        """ fast path, raw doc dicts of window by pymongo, no Document built
+        fields: projection, rawdb.projections['trader'] by default
+        """
+        fields = fields if fields else rawdb.projections['trader']
+        return rawdb.find_raw(self._coll, starttime, endtime, stockids, fields, self._archive)
+
+    def to_columns(self, starttime, endtime, stockids=[], fields=None):
+        """ fast path, find_raw docs as {path: numpy array} """
+        return rawdb.to_columns(self.find_raw(starttime, endtime, stockids, fields))
+
     def update_raw(self, item):
         pass
 
@@ -304,6 +703,20 @@ class TwseTraderHisDBHandler(object):
 
     def insert_raw(self, item):
         """ bulk update trader part """
+        if self._bulk:
+            toplist = [{
+                'traderid': it['traderid'],
+                'data': to_mongo(TraderData, it['data'])
+            } for it in item['toplist']]
+            raw = [{
+                'stockid': item['stockid'],
+                'date': item['date'],
+                'toplist': toplist
+            }]
+            result = bulk_upsert(self._coll, raw)
+            sync_data(self._stockcoll, self._coll, [(item['stockid'], item['date'])])
+            self._insert_inverted(item)
+            return result
         keys = [k for k,v in TraderData._fields.iteritems() if k not in ['id', '_cls']]
         toplist = []
         for it in item['toplist']:
@@ -320,8 +733,46 @@ class TwseTraderHisDBHandler(object):
         coll.date = item['date']
         coll.toplist = toplist
         coll.save()
+        sync_data(self._stockcoll, self._coll, [(item['stockid'], item['date'])])
+        self._insert_inverted(item)
+
+    def _insert_inverted(self, item, volume=None):
+        """ maintain (traderid, date, stockid) inverted toplist of this stock day """
+        if not self._invcoll:
+            return
+        if volume is None:
+            coll = self._coll._get_collection().find_one(
+                {'stockid': item['stockid'], 'date': item['date']}, {'data.volume': 1})
+            volume = coll.get('data', {}).get('volume', None) if coll else None
+        traderids = [it['traderid'] for it in item['toplist']]
+        self._invcoll._get_collection().remove({
+            'stockid': item['stockid'],
+            'date': item['date'],
+            'traderid': {'$nin': traderids}
+        })
+        raw = []
+        for it in item['toplist']:
+            data = {
+                'traderid': it['traderid'],
+                'stockid': item['stockid'],
+                'date': item['date'],
+                'data': to_mongo(TraderData, it['data'])
+            }
+            if volume is not None:
+                data.update({'volume': int(volume)})
+            raw.append(data)
+        return bulk_upsert(self._invcoll, raw, keys=('traderid', 'date', 'stockid'))
+
+    def build_inverted(self, starttime, endtime):
+        """ backfill inverted toplist from embedded toplist """
+        cursor = self._coll.objects(Q(date__gte=starttime) & Q(date__lte=endtime))
+        cursor = self._coll._get_collection().find(cursor._query, {'stockid': 1, 'date': 1, 'data.volume': 1, 'toplist': 1})
+        for it in cursor:
+            if it.get('toplist', None):
+                self._insert_inverted(it, it.get('data', {}).get('volume', None))
 
-    def query_raw(self, starttime, endtime, stockids=[], traderids=[], base='stock', constraint=None, order=None, limit=10, callback=None):
+    @profiled('trader', lambda self: self._coll._get_db())
+    def query_raw(self, starttime, endtime, stockids=[], traderids=[], base='stock', constraint=None, order=None, limit=10, callback=None, stream=False, frequency='day', fields=None):
         """ get rank toplist volume stock/trader data
             <stockid>                                          <stockid>
                      | top0_v/p_<traderid>| top1  | ... top10 |          | top0_<traderid>
@@ -336,6 +787,9 @@ class TwseTraderHisDBHandler(object):
             20140929 |    0           |   20  |           | 20140929 | ...
             -------------------------------------------------------------------------
                         100                   50
+        frequency: 'week'/'month' reads rollup rows dated on period start instead of days,
+            their toplist holds the period sums of each trader
+        fields: projection read from coll, rawdb.projections['trader'] by default, aggregate engine only
         """
         map_f = """
             function () {
@@ -438,83 +892,176 @@ class TwseTraderHisDBHandler(object):
         """
         finalize_f = """
         """
+        pipeline = [
+            {'$match': {'data': {'$exists': True}}},
+            {'$project': {
+                'stockid': 1,
+                'date': 1,
+                'volume': '$data.volume',
+                'toplist': 1
+            }},
+            {'$unwind': '$toplist'},
+            {'$sort': {'date': 1}},
+            {'$project': {
+                'stockid': 1,
+                'date': 1,
+                'traderid': '$toplist.traderid',
+                'tradernm': '$toplist.tradernm',
+                'totalvolume': '$toplist.data.totalvolume',
+                'buyvolume': '$toplist.data.buyvolume',
+                'sellvolume': '$toplist.data.sellvolume',
+                'avgbuyprice': '$toplist.data.avgbuyprice',
+                'avgsellprice': '$toplist.data.avgsellprice',
+                'keepbuy': {'$cond': [{'$and': [{'$gt': ['$volume', 0]}, {'$gt': ['$toplist.data.buyvolume', 0]}]}, 1, 0]},
+                'keepsell': {'$cond': [{'$and': [{'$gt': ['$volume', 0]}, {'$gt': ['$toplist.data.sellvolume', 0]}]}, 1, 0]},
+                'buyratio': ratio('$toplist.data.buyvolume', '$volume'),
+                'sellratio': ratio('$toplist.data.sellvolume', '$volume')
+            }},
+            {'$group': {
+                '_id': {'traderid': '$traderid', 'stockid': '$stockid'},
+                'totalvolume': {'$sum': '$totalvolume'},
+                'totalbuyvolume': {'$sum': '$buyvolume'},
+                'totalsellvolume': {'$sum': '$sellvolume'},
+                'totalkeepbuy': {'$sum': '$keepbuy'},
+                'totalkeepsell': {'$sum': '$keepsell'},
+                'totalbuyratio': {'$sum': '$buyratio'},
+                'totalsellratio': {'$sum': '$sellratio'},
+                'ebuyratio': {'$last': '$buyratio'},
+                'esellratio': {'$last': '$sellratio'},
+                'data': {'$push': {
+                    'date': '$date',
+                    'traderid': '$traderid',
+                    'tradernm': '$tradernm',
+                    'keepbuy': '$keepbuy',
+                    'keepsell': '$keepsell',
+                    'buyratio': '$buyratio',
+                    'sellratio': '$sellratio',
+                    'avgbuyprice': '$avgbuyprice',
+                    'avgsellprice': '$avgsellprice',
+                    'buyvolume': '$buyvolume',
+                    'sellvolume': '$sellvolume'
+                }}
+            }}
+        ]
+        rounds = ['totalbuyratio', 'totalsellratio', 'ebuyratio', 'esellratio', 'buyratio', 'sellratio']
+        unwind = {}
+        if stockids:
+            unwind.update({'stockid': {'$in': stockids}})
+        if traderids:
+            unwind.update({'toplist.traderid': {'$in': traderids}})
+        if unwind:
+            pipeline.insert(3, {'$match': unwind})
+        inverted = [
+            {'$match': {'volume': {'$exists': True}}},
+            {'$project': {
+                'stockid': 1,
+                'date': 1,
+                'volume': 1,
+                'toplist.traderid': '$traderid',
+                'toplist.data': '$data'
+            }}
+        ]
         bufwin = (endtime - starttime).days
+        rollup = frequency in ['week', 'month']
         if stockids and traderids:
-            cursor = self._coll.objects(
-                Q(date__gte=starttime) & Q(date__lte=endtime) &
-                (Q(stockid__in=stockids) & Q(toplist__traderid__in=traderids)))
+            query = Q(stockid__in=stockids) & Q(toplist__traderid__in=traderids)
         else:
-            cursor = self._coll.objects(
-                Q(date__gte=starttime) & Q(date__lte=endtime) &
-                (Q(stockid__in=stockids) | Q(toplist__traderid__in=traderids)))
-        results = list(cursor.map_reduce(map_f, reduce_f, 'toptradermap'))
-        retval = []
+            query = Q(stockid__in=stockids) | Q(toplist__traderid__in=traderids)
+        cursor = his_window(self._coll, self._rollupcoll, frequency, starttime, endtime, query)
+        docs = thawed(self._archive if not rollup else None, self._coll, cursor, starttime, endtime,
+                      fields if fields else rawdb.projections['trader'])
+        # map_f runs on the server only, windows reaching the archive take the pipeline in process
+        # fields order sorts on stay on the records, so a merge across markets can sort them again
+        carry = order_fields(order, ['traderid', 'stockid'])
+        if fields:
+            check_fields(pipeline, fields, constraint, order, ['traderid', 'stockid'], self._engine)
+        if self._engine == 'mapreduce' and docs is None:
+            constraint, order = callbacks(constraint, order, ['traderid', 'stockid'])
+            results = cursor.map_reduce(map_f, reduce_f, 'toptradermap')
+        else:
+            # only fields the pipeline reads leave the server
+            pipeline.insert(1, project(fields if fields else rawdb.projections['trader']))
+            stages, constraint, order = pushdown(constraint, order, limit, ['traderid', 'stockid'])
+            # inverted coll is hot daily only, windows reaching the archive or rollups go through toplist docs
+            if base == 'trader' and traderids and self._invcoll and self.inverted and docs is None and not rollup:
+                # index range scan on (traderid, date, stockid) instead of multikey toplist scan
+                query = Q(date__gte=starttime) & Q(date__lte=endtime) & Q(traderid__in=traderids)
+                if stockids:
+                    query = query & Q(stockid__in=stockids)
+                cursor = self._invcoll.objects(query)
+                pipeline = inverted + pipeline[pipeline.index({'$unwind': '$toplist'})+1:]
+            stages = ordered(stages, ['stockid', 'traderid'] if base == 'stock' else ['traderid', 'stockid']) if stream else stages
+            results = aggregate(cursor, pipeline + stages, rounds, docs)
         sort = [('stockid', stockids), ('traderid', traderids)] if base == 'stock' else [('traderid', traderids), ('stockid', stockids)]
-        if constraint:
-            results = filter(constraint, results)
-        for k, s in sort:
-            if s:
-                results = list(filter(lambda x: x.key[k] in s, results))
-        if order:
-            results = sorted(results, key=order)[:limit]
-        for i, it in enumerate(results):
-            coll = { 'datalist': [] }
-            for data in sorted(it.value['data'], key=lambda x: x['date']):
-                coll['datalist'].append(data)
-            coll.update({
-                # html link
-                'opt': 'twse' if self.__class__.__name__ == 'TwseTraderHisDBHandler' else 'otc',
-                'starttime': datetime.strftime(starttime, "%Y%m%d"),
-                'endtime': datetime.strftime(endtime, "%Y%m%d"),
-                # key
-                'date': endtime,
-                'bufwin': bufwin,
-                'traderid': it.key['traderid'],
-                'stockid': it.key['stockid'],
-                'tradernm': self._id.trader.get_name(it.key['traderid']),
-                'stocknm': self._id.stock.get_name(it.key['stockid']),
-                # value
-                'totalvolume': it.value['totalvolume'],
-                'totalbuyvolume': it.value['totalbuyvolume'],
-                'totalsellvolume': it.value['totalsellvolume'],
-                'totalkeepbuy': it.value['totalkeepbuy'],
-                'totalkeepsell': it.value['totalkeepsell'],
-                'totalbuyratio': it.value['totalbuyratio'],
-                'totalsellratio': it.value['totalsellratio'],
-                'alias': "top%d" % (i)
-            })
-            retval.append(coll)
-        self._cache = retval
+        for k, ids in sort:
+            if ids:
+                results = ifilter(lambda x, k=k, ids=set(ids): x.key[k] in ids, results)
+        results = select(results, constraint, order, limit)
+
+        def iter_results(results):
+            for i, it in enumerate(results):
+                coll = { 'datalist': [] }
+                tradernm = self._id.trader.get_name(it.key['traderid'])
+                for data in sorted(it.value['data'], key=lambda x: x['date']):
+                    # toplist docs carry no tradernm, named by id as the record
+                    data['tradernm'] = data.get('tradernm', None) or tradernm
+                    coll['datalist'].append(data)
+                coll.update({
+                    # html link
+                    'opt': 'twse' if self.__class__.__name__ == 'TwseTraderHisDBHandler' else 'otc',
+                    'starttime': datetime.strftime(starttime, "%Y%m%d"),
+                    'endtime': datetime.strftime(endtime, "%Y%m%d"),
+                    # key
+                    'date': endtime,
+                    'bufwin': bufwin,
+                    'traderid': it.key['traderid'],
+                    'stockid': it.key['stockid'],
+                    'tradernm': tradernm,
+                    'stocknm': self._id.stock.get_name(it.key['stockid']),
+                    # value
+                    'totalvolume': it.value['totalvolume'],
+                    'totalbuyvolume': it.value['totalbuyvolume'],
+                    'totalsellvolume': it.value['totalsellvolume'],
+                    'totalkeepbuy': it.value['totalkeepbuy'],
+                    'totalkeepsell': it.value['totalkeepsell'],
+                    'totalbuyratio': it.value['totalbuyratio'],
+                    'totalsellratio': it.value['totalsellratio'],
+                    'alias': "top%d" % (i)
+                })
+                coll.update({k: it.value[k] for k in carry if k in it.value})
+                yield coll
+
+        if stream:
+            # alias cache needs the whole result, not kept on streaming
+            self._cache = []
+            retval = iter_results(results)
+        else:
+            retval = list(iter_results(results))
+            self._cache = retval
         return callback(retval) if callback else retval
 
+    def to_frame(self, cursor, base='stock'):
+        """ callback as long df indexed by (stockid, date) or (traderid, date),
+        columns as <alias>_<field>
+        """
+        names = ['buyratio', 'sellratio', 'keepbuy', 'keepsell', 'avgbuyprice', 'avgsellprice', 'buyvolume', 'sellvolume']
+        return to_frame(cursor, 'stockid' if base == 'stock' else 'traderid', names=names, prefix='alias')
+
     def to_pandas(self, cursor, base='stock'):
         """ callback as pandas df """
-        item = OrderedDict()
-        ids = [it['stockid'] if base =='stock' else it['traderid'] for it in cursor]
-        for id in ids:
-            df = pd.DataFrame()
-            pool = list(filter(lambda x: x['stockid']==id, cursor)) if base == 'stock' else list(filter(lambda x: x['traderid']==id, cursor))
-            for it in pool:
-                index, data= [], []
-                for i in it['datalist']:
-                    date = i.pop('date', None)
-                    if date:
-                        index.append(pytz.timezone('UTC').localize(date))
-                        mdata = {
-                            "%s_buyratio" % (it['alias']): i['buyratio'],
-                            "%s_sellratio" % (it['alias']): i['sellratio'],
-                            "%s_keepbuy" % (it['alias']): i['keepbuy'],
-                            "%s_keepsell" % (it['alias']): i['keepsell'],
-                            "%s_avgbuyprice" % (it['alias']): i['avgbuyprice'],
-                            "%s_avgsellprice" % (it['alias']): i['avgsellprice'],
-                            "%s_buyvolume" % (it['alias']): i['buyvolume'],
-                            "%s_sellvolume" % (it['alias']): i['sellvolume']
-                        }
-                        data.append(mdata)
-                if index and data:
-                    df = pd.concat([df, pd.DataFrame(data, index=index).fillna(0)], axis=1)
-                    item.update({id: df})
-        return pd.Panel(item)
+        return to_panel(self.to_frame(cursor, base))
+
+    @property
+    def inverted(self):
+        if self._inverted is not None:
+            return self._inverted
+        if not self._built:
+            self._built = is_built(self._invcoll)
+        return self._built
+
+    @inverted.setter
+    def inverted(self, inverted):
+        self._inverted = inverted
 
     def get_alias(self, ids=[], base='stock', aliases=['top0']):
         """ get alias map as virtual nick name to physical name """
@@ -529,14 +1076,18 @@ class TwseCreditHisDBHandler(object):
 
     def __init__(self, **kwargs):
         self._coll = kwargs.pop('coll', None)
+        self._archive = kwargs.pop('archive', None)
+        self._rollupcoll = kwargs.pop('rollupcoll', None)
         self._debug = kwargs.pop('debug', False)
+        self._bulk = kwargs.pop('bulk', False)
+        self._engine = kwargs.pop('engine', 'aggregate')
         kwargs = {
             'id': {
                 'debug': self._debug,
                 'opt': 'twse'
             }
         }
-        self._id = TwseIdDBHandler(**kwargs['id'])
+        self._id = get_handler(TwseIdDBHandler, **kwargs['id'])
         self._ids = []
 
     @property
@@ -551,6 +1102,18 @@ class TwseCreditHisDBHandler(object):
     def coll(self):
         return self._coll
 
+    @profiled('credit', lambda self: self._coll._get_db())
+    def find_raw(self, starttime, endtime, stockids=[], fields=None):
+        """ fast path, raw doc dicts of window by pymongo, no Document built
+        fields: projection, rawdb.projections['credit'] by default
+        """
+        fields = fields if fields else rawdb.projections['credit']
+        return rawdb.find_raw(self._coll, starttime, endtime, stockids, fields, self._archive)
+
+    def to_columns(self, starttime, endtime, stockids=[], fields=None):
+        """ fast path, find_raw docs as {path: numpy array} """
+        return rawdb.to_columns(self.find_raw(starttime, endtime, stockids, fields))
+
     def update_raw(self, item):
         pass
 
@@ -559,6 +1122,13 @@ class TwseCreditHisDBHandler(object):
 
     def insert_raw(self, item):
         """ bulk update credit part """
+        if self._bulk:
+            item = [{
+                'stockid': it['stockid'],
+                'date': it['date'],
+                it['type']: to_mongo(CreditData, it)
+            } for it in item if it['type'] in ['finance', 'bearish']]
+            return bulk_upsert(self._coll, item)
         keys = [k for k,v in CreditData._fields.iteritems() if k not in ['id', '_cls']]
         for it in item:
             data = {k:v for k, v in it.items() if k in keys}
@@ -574,12 +1144,15 @@ class TwseCreditHisDBHandler(object):
                 coll.bearish = data
             coll.save()
 
-    def query_raw(self, starttime, endtime, stockids=[], base='stock', constraint=None, order=None, limit=10, callback=None):
+    @profiled('credit', lambda self: self._coll._get_db())
+    def query_raw(self, starttime, endtime, stockids=[], base='stock', constraint=None, order=None, limit=10, callback=None, stream=False, frequency='day', fields=None):
         """ return orm
         <stockid>                                         | <stockid> ...
                     financeremain| financetrend| bearishremain| ...|
         20140928    100        | 101         |        999 | ...|
         20140929    100        | 102         |        999 | ...|
+        frequency: 'week'/'month' reads rollup rows dated on period start instead of days
+        fields: projection read from coll, rawdb.projections['credit'] by default, aggregate engine only
         """
         map_f = """
             function () {
@@ -669,59 +1242,115 @@ class TwseCreditHisDBHandler(object):
         """
         finalize_f = """
         """
+        pipeline = [
+            {'$match': {'finance': {'$exists': True}, 'bearish': {'$exists': True}}},
+            {'$sort': {'date': 1}},
+            {'$project': {
+                'stockid': 1,
+                'date': 1,
+                'finance': 1,
+                'bearish': 1,
+                'financetrend': trend('$finance.curremain', '$finance.preremain'),
+                'financeremain': ratio('$finance.curremain', '$finance.limit'),
+                'bearishtrend': trend('$bearish.curremain', '$bearish.preremain'),
+                'bearishremain': ratio('$bearish.curremain', '$bearish.limit'),
+                'bearfinaratio': ratio('$bearish.curremain', '$finance.curremain')
+            }},
+            {'$group': {
+                '_id': {'stockid': '$stockid'},
+                'totalfinanceremain': {'$sum': '$financeremain'},
+                'totalbearishremain': {'$sum': '$bearishremain'},
+                'efinanceremain': {'$last': '$financeremain'},
+                'efinancetrend': {'$last': '$financetrend'},
+                'ebearishremain': {'$last': '$bearishremain'},
+                'ebearishtrend': {'$last': '$bearishtrend'},
+                'ebearfinaratio': {'$last': '$bearfinaratio'},
+                'data': {'$push': {
+                    'date': '$date',
+                    'financebuyvolume': '$finance.buyvolume',
+                    'financesellvolume': '$finance.sellvolume',
+                    'financeremain': '$financeremain',
+                    'financetrend': '$financetrend',
+                    'bearishbuyvolume': '$bearish.buyvolume',
+                    'bearishsellvolume': '$bearish.sellvolume',
+                    'bearishremain': '$bearishremain',
+                    'bearishtrend': '$bearishtrend',
+                    'bearfinaratio': '$bearfinaratio'
+                }}
+            }}
+        ]
+        rounds = [
+            'totalfinanceremain', 'totalbearishremain', 'efinanceremain', 'efinancetrend',
+            'ebearishremain', 'ebearishtrend', 'ebearfinaratio', 'financeremain', 'financetrend',
+            'bearishremain', 'bearishtrend', 'bearfinaratio'
+        ]
         bufwin = (endtime - starttime).days
-        cursor = self._coll.objects(Q(date__gte=starttime) & Q(date__lte=endtime) & Q(stockid__in=stockids))
-        results = list(cursor.map_reduce(map_f, reduce_f, 'creditmap'))
-        if constraint:
-            results = filter(constraint, results)
-        if order:
-            results = sorted(results, key=order)[:limit]
-        retval = []
-        for it in results:
-            coll = { 'datalist': [] }
-            for data in sorted(it.value['data'], key=lambda x: x['date']):
-                coll['datalist'].append(data)
-            coll.update({
-                #key
-                'date': endtime,
-                'stockid': it.key['stockid'],
-                'stocknm': self._id.stock.get_name(it.key['stockid']),
-                'bufwin': bufwin,
-                # value
-                'totalfinanceremain': it.value['totalfinanceremain'],
-                'totalbearishremain': it.value['totalbearishremain']
-            })
-            retval.append(coll)
+        cursor = his_window(self._coll, self._rollupcoll, frequency, starttime, endtime, Q(stockid__in=stockids))
+        archive = self._archive if frequency not in ['week', 'month'] else None
+        docs = thawed(archive, self._coll, cursor, starttime, endtime, fields if fields else rawdb.projections['credit'])
+        # map_f runs on the server only, windows reaching the archive take the pipeline in process
+        # fields order sorts on stay on the records, so a merge across markets can sort them again
+        carry = order_fields(order, ['stockid'])
+        if fields:
+            check_fields(pipeline, fields, constraint, order, ['stockid'], self._engine)
+        if self._engine == 'mapreduce' and docs is None:
+            constraint, order = callbacks(constraint, order, ['stockid'])
+            results = cursor.map_reduce(map_f, reduce_f, 'creditmap')
+        else:
+            # only fields the pipeline reads leave the server
+            pipeline.insert(1, project(fields if fields else rawdb.projections['credit']))
+            stages, constraint, order = pushdown(constraint, order, limit, ['stockid'])
+            stages = ordered(stages, ['stockid']) if stream else stages
+            results = aggregate(cursor, pipeline + stages, rounds, docs)
+        results = select(results, constraint, order, limit)
+
+        def iter_results(results):
+            for it in results:
+                coll = { 'datalist': [] }
+                for data in sorted(it.value['data'], key=lambda x: x['date']):
+                    coll['datalist'].append(data)
+                coll.update({
+                    #key
+                    'date': endtime,
+                    'stockid': it.key['stockid'],
+                    'stocknm': self._id.stock.get_name(it.key['stockid']),
+                    'bufwin': bufwin,
+                    # value
+                    'totalfinanceremain': it.value['totalfinanceremain'],
+                    'totalbearishremain': it.value['totalbearishremain']
+                })
+                coll.update({k: it.value[k] for k in carry if k in it.value})
+                yield coll
+
+        retval = iter_results(results) if stream else list(iter_results(results))
         return callback(retval) if callback else retval
 
+    def to_frame(self, cursor):
+        """ callback as long df indexed by (stockid, date) """
+        return to_frame(cursor, 'stockid')
+
     def to_pandas(self, cursor):
-        """ callback to pandas df """
-        item = OrderedDict()
-        for it in cursor:
-            index, data = [], []
-            for i in it['datalist']:
-                date = i.pop('date', None)
-                if date:
-                    index.append(pytz.timezone('UTC').localize(date))
-                    data.append(i)
-            if index and data:
-                id = it['stockid']
-                item.update({id: pd.DataFrame(data, index=index).fillna(0)})
-        return pd.Panel(item)
+        """ callback as pandas df """
+        return to_panel(self.to_frame(cursor))
 
 
 class TwseFutureHisDBHandler(object):
 
     def __init__(self, **kwargs):
         self._coll = kwargs.pop('coll', None)
+        self._archive = kwargs.pop('archive', None)
+        self._rollupcoll = kwargs.pop('rollupcoll', None)
         self._debug = kwargs.pop('debug', False)
+        self._bulk = kwargs.pop('bulk', False)
+        self._engine = kwargs.pop('engine', 'aggregate')
+        self._stockcoll = kwargs.pop('stockcoll', None)
         kwargs = {
             'id': {
                 'debug': self._debug,
                 'opt': 'twse'
             }
         }
-        self._id = TwseIdDBHandler(**kwargs['id'])
+        self._id = get_handler(TwseIdDBHandler, **kwargs['id'])
         self._ids = []
 
     @property
@@ -736,6 +1365,18 @@ class TwseFutureHisDBHandler(object):
     def coll(self):
         return self._coll
 
+    @profiled('future', lambda self: self._coll._get_db())
+    def find_raw(self, starttime, endtime, stockids=[], fields=None):
+        """ fast path, raw doc dicts of window by pymongo, no Document built
+        fields: projection, rawdb.projections['future'] by default
+        """
+        fields = fields if fields else rawdb.projections['future']
+        return rawdb.find_raw(self._coll, starttime, endtime, stockids, fields, self._archive)
+
+    def to_columns(self, starttime, endtime, stockids=[], fields=None):
+        """ fast path, find_raw docs as {path: numpy array} """
+        return rawdb.to_columns(self.find_raw(starttime, endtime, stockids, fields))
+
     def update_raw(self, item):
         pass
 
@@ -743,7 +1384,16 @@ class TwseFutureHisDBHandler(object):
         pass
 
     def insert_raw(self, item):
-        """ bulk update credit part """
+        """ bulk update future part """
+        if self._bulk:
+            item = [{
+                'stockid': it['stockid'],
+                'date': it['date'],
+                'future': to_mongo(FutureData, it)
+            } for it in item]
+            result = bulk_upsert(self._coll, item)
+            sync_data(self._stockcoll, self._coll, [(it['stockid'], it['date']) for it in item])
+            return result
         keys = [k for k,v in FutureData._fields.iteritems() if k not in ['id', '_cls']]
         for it in item:
             data = {k:v for k, v in it.items() if k in keys}
@@ -755,13 +1405,17 @@ class TwseFutureHisDBHandler(object):
             coll.date = it['date']
             coll.future = data
             coll.save()
+        sync_data(self._stockcoll, self._coll, [(it['stockid'], it['date']) for it in item])
 
-    def query_raw(self, starttime, endtime, stockids=[], base='stock', constraint=None, order=None, limit=10, callback=None):
+    @profiled('future', lambda self: self._coll._get_db())
+    def query_raw(self, starttime, endtime, stockids=[], base='stock', constraint=None, order=None, limit=10, callback=None, stream=False, frequency='day', fields=None):
         """ return orm
         <stockid>                               | <stockid> ...
                     open| high| low|close|volume|          | open | ...
         20140928    100 | 101 | 99 | 100 | 100  | 20140928 | 11   | ...
         20140929    100 | 102 | 98 | 99  | 99   | 20140929 | 11   | ...
+        frequency: 'week'/'month' reads rollup rows dated on period start instead of days
+        fields: projection read from coll, rawdb.projections['future'] by default, aggregate engine only
         """
         map_f = """
             function () {
@@ -844,46 +1498,627 @@ class TwseFutureHisDBHandler(object):
         """
         finalize_f = """
         """
+        pipeline = [
+            {'$match': {'data': {'$exists': True}, 'future': {'$exists': True}}},
+            {'$sort': {'date': 1}},
+            {'$project': {
+                'stockid': 1,
+                'date': 1,
+                'future': 1,
+                'dfodiff': {'$subtract': ['$data.open', '$future.open']},
+                'dfhdiff': {'$subtract': ['$data.high', '$future.high']},
+                'dfldiff': {'$subtract': ['$data.low', '$future.low']},
+                'dfcdiff': {'$subtract': ['$data.close', '$future.close']},
+                'hldiff': absolute({'$subtract': ['$future.high', '$future.low']}),
+                'ocdiff': absolute({'$subtract': ['$future.open', '$future.close']})
+            }},
+            {'$group': {
+                '_id': {'stockid': '$stockid'},
+                'totalvolume': {'$sum': '$future.volume'},
+                'totalhldiff': {'$sum': '$hldiff'},
+                'totalocdiff': {'$sum': '$ocdiff'},
+                'edfodiff': {'$last': '$dfodiff'},
+                'edfhdiff': {'$last': '$dfhdiff'},
+                'edfldiff': {'$last': '$dfldiff'},
+                'edfcdiff': {'$last': '$dfcdiff'},
+                'data': {'$push': {
+                    'date': '$date',
+                    'fopen': '$future.open',
+                    'fhigh': '$future.high',
+                    'flow': '$future.low',
+                    'fclose': '$future.close',
+                    'fprice': '$future.close',
+                    'fvolume': '$future.volume',
+                    'fsetprice': '$future.setprice',
+                    'funtrdcount': '$future.untrdcount',
+                    'fbestbuy': '$future.bestbuy',
+                    'fbestsell': '$future.bestsell',
+                    'dfodiff': '$dfodiff',
+                    'dfhdiff': '$dfhdiff',
+                    'dfldiff': '$dfldiff',
+                    'dfcdiff': '$dfcdiff'
+                }}
+            }}
+        ]
+        rounds = [
+            'totalhldiff', 'totalocdiff', 'edfodiff', 'edfhdiff', 'edfldiff', 'edfcdiff',
+            'dfodiff', 'dfhdiff', 'dfldiff', 'dfcdiff'
+        ]
         bufwin = (endtime - starttime).days
-        cursor = self._coll.objects(Q(date__gte=starttime) & Q(date__lte=endtime) & Q(stockid__in=stockids))
-        results = list(cursor.map_reduce(map_f, reduce_f, 'futuremap'))
-        if constraint:
-            results = filter(constraint, results)
-        if order:
-            results = sorted(results, key=order)[:limit]
-        retval = []
-        for it in results:
-            coll = { 'datalist': [] }
-            for data in sorted(it.value['data'], key=lambda x: x['date']):
-                coll['datalist'].append(data)
-            coll.update({
-                # key
-                'date': endtime,
-                'bufwin': bufwin,
-                'stockid': it.key['stockid'],
-                'stocknm': self._id.stock.get_name(it.key['stockid']),
-                # value
-                'totalvolume': it.value['totalvolume'],
-                'totalhldiff': it.value['totalhldiff'],
-                'totalocdiff': it.value['totalocdiff'],
-            })
-            retval.append(coll)
+        cursor = his_window(self._coll, self._rollupcoll, frequency, starttime, endtime, Q(stockid__in=stockids))
+        archive = self._archive if frequency not in ['week', 'month'] else None
+        docs = thawed(archive, self._coll, cursor, starttime, endtime, fields if fields else rawdb.projections['future'])
+        # map_f runs on the server only, windows reaching the archive take the pipeline in process
+        # fields order sorts on stay on the records, so a merge across markets can sort them again
+        carry = order_fields(order, ['stockid'])
+        if fields:
+            check_fields(pipeline, fields, constraint, order, ['stockid'], self._engine)
+        if self._engine == 'mapreduce' and docs is None:
+            constraint, order = callbacks(constraint, order, ['stockid'])
+            results = cursor.map_reduce(map_f, reduce_f, 'futuremap')
+        else:
+            # only fields the pipeline reads leave the server
+            pipeline.insert(1, project(fields if fields else rawdb.projections['future']))
+            stages, constraint, order = pushdown(constraint, order, limit, ['stockid'])
+            stages = ordered(stages, ['stockid']) if stream else stages
+            results = aggregate(cursor, pipeline + stages, rounds, docs)
+        results = select(results, constraint, order, limit)
+
+        def iter_results(results):
+            for it in results:
+                coll = { 'datalist': [] }
+                for data in sorted(it.value['data'], key=lambda x: x['date']):
+                    coll['datalist'].append(data)
+                coll.update({
+                    # key
+                    'date': endtime,
+                    'bufwin': bufwin,
+                    'stockid': it.key['stockid'],
+                    'stocknm': self._id.stock.get_name(it.key['stockid']),
+                    # value
+                    'totalvolume': it.value['totalvolume'],
+                    'totalhldiff': it.value['totalhldiff'],
+                    'totalocdiff': it.value['totalocdiff'],
+                })
+                coll.update({k: it.value[k] for k in carry if k in it.value})
+                yield coll
+
+        retval = iter_results(results) if stream else list(iter_results(results))
         return callback(retval) if callback else retval
 
+    def to_frame(self, cursor):
+        """ callback as long df indexed by (stockid, date) """
+        return to_frame(cursor, 'stockid')
+
     def to_pandas(self, cursor):
         """ callback as pandas df """
-        item = OrderedDict()
-        for it in cursor:
-            index, data = [], []
-            for i in it['datalist']:
-                date = i.pop('date', None)
-                if date:
-                    index.append(pytz.timezone('UTC').localize(date))
-                    data.append(i)
-            if index and data:
-                id = it['stockid']
-                item.update({id: pd.DataFrame(data, index=index).fillna(0)})
-        return pd.Panel(item)
+        return to_panel(self.to_frame(cursor))
+
+
+class TwseSummaryHisDBHandler(object):
+    """ rolling window summary over stock/trader/credit/future colls
+    totalvolume/totalhldiff/totalkeepbuy are window sums,
+    ebuyratio/efinanceremain/edfcdiff are values of the window end day
+    a window counts trading days only, days without stock volume are left out
+    trader fields are per stock over the whole toplist, unlike trader query_raw per (traderid, stockid):
+    totalkeepbuy counts net buy days of top traders, ebuyratio is their buy share of day volume
+    """
+
+    sums = ['totalvolume', 'totalhldiff', 'totalkeepbuy']
+    lasts = ['ebuyratio', 'efinanceremain', 'edfcdiff']
+
+    def __init__(self, **kwargs):
+        self._coll = kwargs.pop('coll', None)
+        self._stockcoll = kwargs.pop('stockcoll', None)
+        self._tradercoll = kwargs.pop('tradercoll', None)
+        self._creditcoll = kwargs.pop('creditcoll', None)
+        self._futurecoll = kwargs.pop('futurecoll', None)
+        self._windows = kwargs.pop('windows', [5, 10, 15, 20])
+        self._debug = kwargs.pop('debug', False)
+        self._bulk = kwargs.pop('bulk', False)
+        self._engine = kwargs.pop('engine', 'aggregate')
+        kwargs = {
+            'id': {
+                'debug': self._debug,
+                'opt': 'twse'
+            }
+        }
+        self._id = get_handler(TwseIdDBHandler, **kwargs['id'])
+
+    @property
+    def coll(self):
+        return self._coll
+
+    @property
+    def windows(self):
+        return self._windows
+
+    def _days(self, keys):
+        """ window 1 rows of [(stockid, date), ...] as the day values of each coll,
+        return (rows, keys without stock volume)
+        """
+        groups = defaultdict(list)
+        for stockid, date in keys:
+            groups[stockid].append(date)
+        query = {'$or': [{'stockid': k, 'date': {'$in': v}} for k, v in groups.iteritems()]}
+        days = {}
+        for it in self._stockcoll._get_collection().find(query, {'stockid': 1, 'date': 1, 'data': 1}):
+            data = it.get('data', {})
+            # suspended or not yet landed days are no window days
+            if data.get('volume', 0) <= 0:
+                continue
+            day = dict({k: 0 for k in self.sums + self.lasts}, stockid=it['stockid'], date=it['date'], window=1)
+            day['totalvolume'] = data.get('volume', 0)
+            day['totalhldiff'] = round(abs(data.get('high', 0) - data.get('low', 0)), 2)
+            days[(it['stockid'], it['date'])] = day
+        for it in self._tradercoll._get_collection().find(query, {'stockid': 1, 'date': 1, 'data': 1, 'toplist': 1}):
+            day = days.get((it['stockid'], it['date']), None)
+            if not day:
+                continue
+            buy = sum(t['data'].get('buyvolume', 0) for t in it.get('toplist', []))
+            sell = sum(t['data'].get('sellvolume', 0) for t in it.get('toplist', []))
+            # top traders as a whole, net buy day and buy share of day volume
+            day['totalkeepbuy'] = 1 if buy > sell else 0
+            day['ebuyratio'] = percent(buy, day['totalvolume'])
+        for it in self._creditcoll._get_collection().find(query, {'stockid': 1, 'date': 1, 'finance': 1}):
+            day = days.get((it['stockid'], it['date']), None)
+            if not day:
+                continue
+            finance = it.get('finance', {})
+            day['efinanceremain'] = percent(finance.get('curremain', 0), finance.get('limit', 0))
+        for it in self._futurecoll._get_collection().find(query, {'stockid': 1, 'date': 1, 'data': 1, 'future': 1}):
+            day = days.get((it['stockid'], it['date']), None)
+            if day and 'data' in it and 'future' in it:
+                day['edfcdiff'] = round(it['data']['close'] - it['future']['close'], 2)
+        return days.values(), [k for k in keys if k not in days]
+
+    def _roll(self, stockid, starttime):
+        """ windows of stockid from starttime on, each day adds itself to the previous day
+        window and subtracts the day leaving it, full sum only when there is no previous row
+        """
+        coll = self._coll._get_collection()
+        maxwin = max(self._windows)
+        days = list(coll.find({'stockid': stockid, 'window': 1, 'date': {'$lt': starttime}}).sort('date', -1).limit(maxwin))[::-1]
+        prev = {}
+        if days:
+            query = {'stockid': stockid, 'date': days[-1]['date'], 'window': {'$in': self._windows}}
+            prev = {it['window']: it for it in coll.find(query)}
+        rows = []
+        for day in coll.find({'stockid': stockid, 'window': 1, 'date': {'$gte': starttime}}).sort('date', 1):
+            days = days[-maxwin:] + [day]
+            for win in self._windows:
+                row = {'stockid': stockid, 'date': day['date'], 'window': win}
+                if win in prev:
+                    out = days[-win-1] if len(days) > win else None
+                    for k in self.sums:
+                        row[k] = prev[win][k] + day[k] - (out[k] if out else 0)
+                else:
+                    for k in self.sums:
+                        row[k] = sum(it[k] for it in days[-win:])
+                row['totalhldiff'] = round(row['totalhldiff'], 2)
+                row.update({k: day[k] for k in self.lasts})
+                prev[win] = row
+                rows.append(row)
+        return bulk_upsert(self._coll, rows, keys=('stockid', 'date', 'window'))
+
+    def update(self, item):
+        """ refresh summary after insert_raw of any his target,
+        item: inserted rows or trader item, each with stockid/date
+        """
+        if not item:
+            return
+        item = item if isinstance(item, list) else [item]
+        keys = set((it['stockid'], it['date']) for it in item)
+        days, empties = self._days(keys)
+        bulk_upsert(self._coll, days, keys=('stockid', 'date', 'window'))
+        if empties:
+            # a day that lost its volume leaves every window
+            self._coll._get_collection().remove({'$or': [{'stockid': k, 'date': v} for k, v in empties]})
+        starts = {}
+        for stockid, date in keys:
+            starts[stockid] = min(date, starts.get(stockid, date))
+        for stockid, starttime in starts.iteritems():
+            self._roll(stockid, starttime)
+        return {'stocks': len(starts), 'days': len(keys)}
+
+    def build(self, starttime, endtime, stockids=[]):
+        """ backfill summary of days already in stock coll """
+        query = {'date': {'$gte': starttime, '$lte': endtime}}
+        if stockids:
+            query.update({'stockid': {'$in': stockids}})
+        groups = defaultdict(list)
+        for it in self._stockcoll._get_collection().find(query, {'stockid': 1, 'date': 1}):
+            groups[it['stockid']].append(it)
+        result = {'stocks': 0, 'days': 0}
+        for stockid, item in groups.iteritems():
+            for k, v in self.update(item).items():
+                result[k] += v
+        return result
+
+    @profiled('summary', lambda self: self._coll._get_db())
+    def query_raw(self, starttime, endtime, stockids=[], base='stock', constraint=None, order=None, limit=10, callback=None, stream=False, window=5):
+        """ one precomputed row per stock on the latest summary day in [starttime, endtime],
+        aggregate engine only
+        """
+        latest = self._coll.objects(Q(window=window) & Q(date__gte=starttime) & Q(date__lte=endtime)).order_by('-date').first()
+        if not latest:
+            return iter([]) if stream else []
+        pipeline = [
+            {'$project': {
+                '_id': {'stockid': '$stockid'},
+                'date': 1,
+                'totalvolume': 1,
+                'totalhldiff': 1,
+                'totalkeepbuy': 1,
+                'ebuyratio': 1,
+                'efinanceremain': 1,
+                'edfcdiff': 1
+            }}
+        ]
+        cursor = self._coll.objects(Q(window=window) & Q(date=latest.date))
+        if stockids:
+            cursor = cursor.filter(stockid__in=stockids)
+        stages, constraint, order = pushdown(constraint, order, limit, ['stockid'])
+        stages = ordered(stages, ['stockid']) if stream else stages
+        results = select(aggregate(cursor, pipeline + stages), constraint, order, limit)
+
+        def iter_results(results):
+            for it in results:
+                coll = {
+                    # key
+                    'date': it.value['date'],
+                    'window': window,
+                    'stockid': it.key['stockid'],
+                    'stocknm': self._id.stock.get_name(it.key['stockid'])
+                }
+                # value
+                coll.update({k: it.value[k] for k in self.sums + self.lasts})
+                yield coll
+
+        retval = iter_results(results) if stream else list(iter_results(results))
+        return callback(retval) if callback else retval
+
+
+class TwseLatestHisDBHandler(object):
+    """ market snapshot as the last complete row of each stockid """
+
+    # his doc query of each target part and the raw fields it keeps on the snapshot,
+    # trader keeps only its derived e* values, never the toplist array
+    parts = OrderedDict([
+        ('stock', ({'data': {'$exists': True}}, ['data'])),
+        ('trader', ({'toplist': {'$exists': True}}, [])),
+        ('credit', ({'finance': {'$exists': True}, 'bearish': {'$exists': True}}, ['finance', 'bearish'])),
+        ('future', ({'future': {'$exists': True}}, ['future']))
+    ])
+
+    def __init__(self, **kwargs):
+        self._coll = kwargs.pop('coll', None)
+        self._colls = {
+            'stock': kwargs.pop('stockcoll', None),
+            'trader': kwargs.pop('tradercoll', None),
+            'credit': kwargs.pop('creditcoll', None),
+            'future': kwargs.pop('futurecoll', None)
+        }
+        self._debug = kwargs.pop('debug', False)
+        kwargs = {
+            'id': {
+                'debug': self._debug,
+                'opt': 'twse'
+            }
+        }
+        self._id = get_handler(TwseIdDBHandler, **kwargs['id'])
+
+    @property
+    def coll(self):
+        return self._coll
+
+    def _latest(self, stockid):
+        """ newest doc of each target on the (stockid, date) index and the e* values of them """
+        row = {'stockid': stockid, 'dates': {}}
+        for target, (query, keeps) in self.parts.items():
+            query = dict(query, stockid=stockid)
+            it = self._colls[target]._get_collection().find_one(query, sort=[('date', -1)])
+            if not it:
+                continue
+            row['dates'][target] = it['date']
+            row.update({k: it[k] for k in keeps})
+            if target == 'trader':
+                volume = it.get('data', {}).get('volume', 0)
+                row['ebuyratio'] = percent(sum(t['data'].get('buyvolume', 0) for t in it['toplist']), volume)
+            if target == 'future' and 'data' in it:
+                row['edfcdiff'] = round(it['data']['close'] - it['future']['close'], 2)
+        if 'stock' not in row['dates']:
+            return None
+        row['date'] = row['dates']['stock']
+        row['eclose'] = row['data'].get('close', 0)
+        row['evolume'] = row['data'].get('volume', 0)
+        if 'finance' in row:
+            finance, bearish = row['finance'], row['bearish']
+            row['efinanceremain'] = percent(finance.get('curremain', 0), finance.get('limit', 0))
+            row['ebearishremain'] = percent(bearish.get('curremain', 0), bearish.get('limit', 0))
+            row['ebearfinaratio'] = percent(bearish.get('curremain', 0), finance.get('curremain', 0))
+        return row
+
+    def update(self, item):
+        """ refresh snapshot of stockids in item after insert_raw of any his target """
+        if not item:
+            return
+        item = item if isinstance(item, list) else [item]
+        stockids = list(set(it['stockid'] for it in item))
+        rows = [self._latest(stockid) for stockid in stockids]
+        result = bulk_upsert(self._coll, [it for it in rows if it], keys=('stockid',))
+        # rows written before the snapshot stopped keeping toplist
+        self._coll._get_collection().update(
+            {'stockid': {'$in': stockids}, 'toplist': {'$exists': True}}, {'$unset': {'toplist': ''}}, multi=True)
+        return result
+
+    def build(self, stockids=[]):
+        """ backfill snapshot of stockids, every stockid in stock coll as default """
+        stockids = stockids or self._colls['stock']._get_collection().distinct('stockid')
+        return self.update([{'stockid': it} for it in stockids])
+
+    @profiled('latest', lambda self: self._coll._get_db())
+    def snapshot(self, stockids=[], constraint=None, order=None, limit=None):
+        """ whole market (or stockids) latest rows in one read
+        constraint/order: declarative specs run on server, lambdas on x.value as query_raw
+        """
+        query = {'stockid': {'$in': stockids}} if stockids else {}
+        sort = None
+        if is_spec(constraint):
+            query.update(compile_constraint(constraint))
+            constraint = None
+        if is_spec(order):
+            if not constraint:
+                sort = compile_order(order).items()
+                order = None
+            else:
+                order = order_func(order)
+        cursor = self._coll._get_collection().find(query, {'_id': 0, '_cls': 0, 'toplist': 0})
+        if sort:
+            cursor = cursor.sort(sort)
+            if limit:
+                cursor = cursor.limit(limit)
+        results = (AggregateResult({'stockid': it['stockid']}, it) for it in cursor)
+        if limit:
+            results = select(results, constraint, order, limit)
+        else:
+            results = select(results, constraint)
+            results = sorted(results, key=order) if order else results
+        retval = []
+        for it in results:
+            it.value.update({'stocknm': self._id.stock.get_name(it.key['stockid'])})
+            retval.append(it.value)
+        return retval[:limit] if limit else retval
+
+
+class TwseRollupHisDBHandler(object):
+    """ weekly/monthly rollup rows in the daily doc shape, so every his query_raw runs on them
+    data/future as period OHLCV, toplist as period sums of each trader,
+    finance/bearish as period end remain with period buy/sell volume
+    """
+
+    # daily coll of each target part, the query of the docs holding it and their fields
+    parts = OrderedDict([
+        ('stock', ('_stockcoll', {'data': {'$exists': True}}, ['data'])),
+        ('trader', ('_tradercoll', {'toplist': {'$exists': True}}, ['toplist'])),
+        ('credit', ('_creditcoll', {'finance': {'$exists': True}, 'bearish': {'$exists': True}}, ['finance', 'bearish'])),
+        ('future', ('_futurecoll', {'future': {'$exists': True}}, ['future']))
+    ])
+
+    def __init__(self, **kwargs):
+        self._coll = kwargs.pop('coll', None)
+        self._stockcoll = kwargs.pop('stockcoll', None)
+        self._tradercoll = kwargs.pop('tradercoll', None)
+        self._creditcoll = kwargs.pop('creditcoll', None)
+        self._futurecoll = kwargs.pop('futurecoll', None)
+        self._frequencies = kwargs.pop('frequencies', ['week', 'month'])
+        self._debug = kwargs.pop('debug', False)
+
+    @property
+    def coll(self):
+        return self._coll
+
+    def _toplist(self, days, toplist=[]):
+        """ period buy/sell volume of each trader on top of period toplist, avg prices weighted by volume """
+        traders = OrderedDict()
+        for it in [{'toplist': toplist}] + list(days):
+            for t in it.get('toplist', []):
+                acc = traders.setdefault(t['traderid'], defaultdict(float))
+                for k in ['buyvolume', 'sellvolume', 'totalvolume']:
+                    acc[k] += t['data'].get(k, 0)
+                acc['buyamount'] += t['data'].get('avgbuyprice', 0) * t['data'].get('buyvolume', 0)
+                acc['sellamount'] += t['data'].get('avgsellprice', 0) * t['data'].get('sellvolume', 0)
+        return [{
+            'traderid': traderid,
+            'data': {
+                'buyvolume': int(acc['buyvolume']),
+                'sellvolume': int(acc['sellvolume']),
+                'totalvolume': int(acc['totalvolume']),
+                'avgbuyprice': round(acc['buyamount'] / acc['buyvolume'], 2) if acc['buyvolume'] else 0.0,
+                'avgsellprice': round(acc['sellamount'] / acc['sellvolume'], 2) if acc['sellvolume'] else 0.0
+            }
+        } for traderid, acc in traders.items()]
+
+    def _credit(self, days):
+        """ period end remain/limit, preremain of the period start, summed buy/sell/daytrade """
+        return {
+            'preremain': days[0].get('preremain', 0),
+            'curremain': days[-1].get('curremain', 0),
+            'limit': days[-1].get('limit', 0),
+            'buyvolume': sum(it.get('buyvolume', 0) for it in days),
+            'sellvolume': sum(it.get('sellvolume', 0) for it in days),
+            'daytrade': sum(it.get('daytrade', 0) for it in days)
+        }
+
+    def _days(self, target, query):
+        """ daily docs of target holding its part, in date order """
+        coll, exists, fields = self.parts[target]
+        coll = getattr(self, coll)
+        if not coll:
+            return []
+        fields = dict({k: 1 for k in fields}, stockid=1, date=1)
+        return list(coll._get_collection().find(dict(query, **exists), fields).sort('date', 1))
+
+    def _rollup(self, stockid, start, frequency):
+        """ period row rebuilt from its days, at most a month of daily docs """
+        query = {'stockid': stockid, 'date': {'$gte': start, '$lt': next_period(start, frequency)}}
+        days = self._days('stock', query)
+        if not days:
+            return None
+        data = [it['data'] for it in days]
+        row = {
+            'stockid': stockid,
+            'date': start,
+            'frequency': frequency,
+            'enddate': days[-1]['date'],
+            'enddates': {'stock': days[-1]['date']},
+            'data': {
+                'open': data[0].get('open', 0),
+                'high': max(it.get('high', 0) for it in data),
+                'low': min(it.get('low', 0) for it in data),
+                'close': data[-1].get('close', 0),
+                'price': data[-1].get('close', 0),
+                'volume': sum(it.get('volume', 0) for it in data)
+            },
+            'buyvolume': 0,
+            'sellvolume': 0,
+            'financeremain': 0,
+            'bearishremain': 0
+        }
+        traders = self._days('trader', query)
+        toplist = self._toplist(traders)
+        if toplist:
+            row['toplist'] = toplist
+            row['buyvolume'] = sum(it['data']['buyvolume'] for it in toplist)
+            row['sellvolume'] = sum(it['data']['sellvolume'] for it in toplist)
+            row['enddates']['trader'] = traders[-1]['date']
+        credits = self._days('credit', query)
+        if credits:
+            row['finance'] = self._credit([it['finance'] for it in credits])
+            row['bearish'] = self._credit([it['bearish'] for it in credits])
+            row['financeremain'] = row['finance']['curremain']
+            row['bearishremain'] = row['bearish']['curremain']
+            row['enddates']['credit'] = credits[-1]['date']
+        futures = self._days('future', query)
+        if futures:
+            items = [it['future'] for it in futures]
+            row['future'] = dict(items[-1], **{
+                'open': items[0].get('open', 0),
+                'high': max(it.get('high', 0) for it in items),
+                'low': min(it.get('low', 0) for it in items),
+                'volume': sum(it.get('volume', 0) for it in items),
+                'untrdcount': sum(it.get('untrdcount', 0) for it in items)
+            })
+            row['enddates']['future'] = futures[-1]['date']
+        return row
+
+    def _delta(self, target, days, row):
+        """ update of period row by days newer than any of target it holds,
+        sums as $inc, high/low as $max/$min, last day values as $set
+        """
+        first = target not in row['enddates']
+        update = defaultdict(dict)
+        update['$set']['enddates.%s' % (target)] = days[-1]['date']
+        if target == 'stock':
+            data = [it['data'] for it in days]
+            update['$max']['data.high'] = max(it.get('high', 0) for it in data)
+            update['$min']['data.low'] = min(it.get('low', 0) for it in data)
+            update['$inc']['data.volume'] = sum(it.get('volume', 0) for it in data)
+            update['$set'].update({
+                'data.close': data[-1].get('close', 0),
+                'data.price': data[-1].get('close', 0),
+                'enddate': days[-1]['date']
+            })
+        elif target == 'trader':
+            # avg prices re-weighted by the period volume, within a cent of a rebuild, the toplist is set whole
+            toplist = self._toplist(days, row.get('toplist', []))
+            update['$set']['toplist'] = toplist
+            update['$inc']['buyvolume'] = sum(t['data'].get('buyvolume', 0) for it in days for t in it['toplist'])
+            update['$inc']['sellvolume'] = sum(t['data'].get('sellvolume', 0) for it in days for t in it['toplist'])
+        elif target == 'credit':
+            for k in ['finance', 'bearish']:
+                items = [it[k] for it in days]
+                if first:
+                    update['$set']['%s.preremain' % (k)] = items[0].get('preremain', 0)
+                update['$set']['%s.curremain' % (k)] = items[-1].get('curremain', 0)
+                update['$set']['%s.limit' % (k)] = items[-1].get('limit', 0)
+                update['$set']['%sremain' % (k)] = items[-1].get('curremain', 0)
+                for f in ['buyvolume', 'sellvolume', 'daytrade']:
+                    update['$inc']['%s.%s' % (k, f)] = sum(it.get(f, 0) for it in items)
+        elif target == 'future':
+            items = [it['future'] for it in days]
+            if first:
+                update['$set']['future.open'] = items[0].get('open', 0)
+            update['$max']['future.high'] = max(it.get('high', 0) for it in items)
+            update['$min']['future.low'] = min(it.get('low', 0) for it in items)
+            for f in ['volume', 'untrdcount']:
+                update['$inc']['future.%s' % (f)] = sum(it.get(f, 0) for it in items)
+            update['$set'].update({
+                'future.%s' % (k): v for k, v in items[-1].items() if k not in ['open', 'high', 'low', 'volume', 'untrdcount']
+            })
+        return dict(update)
+
+    def update(self, item, target=None):
+        """ bring the periods touched by item in step after insert_raw of target,
+        days newer than the target part of the period row are applied as a delta,
+        an older or same day (a correction), a new period or a row without enddates is rebuilt,
+        target None rebuilds every touched period
+        """
+        if not item:
+            return
+        item = item if isinstance(item, list) else [item]
+        if target is None:
+            keys = set(
+                (it['stockid'], period(it['date'], frequency), frequency)
+                for it in item for frequency in self._frequencies)
+            rows = [self._rollup(*key) for key in keys]
+            return bulk_upsert(self._coll, [it for it in rows if it], keys=('stockid', 'date', 'frequency'))
+        dates = defaultdict(set)
+        for it in item:
+            dates[it['stockid']].add(it['date'])
+        query = {'$or': [{'stockid': k, 'date': {'$in': list(v)}} for k, v in dates.iteritems()]}
+        groups = defaultdict(list)
+        for it in self._days(target, query):
+            for frequency in self._frequencies:
+                groups[(it['stockid'], period(it['date'], frequency), frequency)].append(it)
+        if not groups:
+            return {'matched': 0, 'upserted': 0}
+        query = {'$or': [{'stockid': k[0], 'date': k[1], 'frequency': k[2]} for k in groups.keys()]}
+        fields = ['stockid', 'date', 'frequency', 'enddates'] + (['toplist'] if target == 'trader' else [])
+        rows = {(it['stockid'], it['date'], it['frequency']): it for it in self._coll._get_collection().find(query, fields)}
+        rebuilds, result = [], {'matched': 0, 'upserted': 0}
+        bulk = self._coll._get_collection().initialize_unordered_bulk_op()
+        for key, days in groups.iteritems():
+            row = rows.get(key, None)
+            if not row and target != 'stock':
+                # the period row starts with its first stock day, rebuilt with this day then
+                continue
+            if not row or 'enddates' not in row or 'stock' not in row['enddates'] or \
+                    days[0]['date'] <= row['enddates'].get(target, datetime.min):
+                rebuilds.append(key)
+                continue
+            bulk.find({'stockid': key[0], 'date': key[1], 'frequency': key[2]}).update_one(self._delta(target, days, row))
+            result['matched'] += 1
+        if result['matched']:
+            bulk.execute()
+        rows = [self._rollup(*key) for key in rebuilds]
+        for k, v in bulk_upsert(self._coll, [it for it in rows if it], keys=('stockid', 'date', 'frequency')).items():
+            result[k] += v
+        return result
+
+    def build(self, starttime, endtime, stockids=[]):
+        """ backfill rollups of days already in stock coll """
+        query = {'date': {'$gte': starttime, '$lte': endtime}}
+        if stockids:
+            query.update({'stockid': {'$in': stockids}})
+        groups = defaultdict(list)
+        for it in self._stockcoll._get_collection().find(query, {'stockid': 1, 'date': 1}):
+            groups[it['stockid']].append(it)
+        result = {'matched': 0, 'upserted': 0}
+        for stockid, item in groups.iteritems():
+            for k, v in self.update(item).items():
+                result[k] += v
+        return result
 
 
 class OtcStockHisDBHandler(TwseStockHisDBHandler):
@@ -896,7 +2131,7 @@ class OtcStockHisDBHandler(TwseStockHisDBHandler):
                 'opt': 'otc'
             }
         }
-        self._id = OtcIdDBHandler(**kwargs['id'])
+        self._id = get_handler(OtcIdDBHandler, **kwargs['id'])
 
 class OtcTraderHisDBHandler(TwseTraderHisDBHandler):
 
@@ -908,7 +2143,7 @@ class OtcTraderHisDBHandler(TwseTraderHisDBHandler):
                 'opt': 'otc'
             }
         }
-        self._id = OtcIdDBHandler(**kwargs['id'])
+        self._id = get_handler(OtcIdDBHandler, **kwargs['id'])
 
 class OtcCreditHisDBHandler(TwseCreditHisDBHandler):
 
@@ -920,7 +2155,7 @@ class OtcCreditHisDBHandler(TwseCreditHisDBHandler):
                 'opt': 'otc'
             }
         }
-        self._id = OtcIdDBHandler(**kwargs['id'])
+        self._id = get_handler(OtcIdDBHandler, **kwargs['id'])
 
 class OtcFutureHisDBHandler(TwseFutureHisDBHandler):
 
@@ -932,4 +2167,31 @@ class OtcFutureHisDBHandler(TwseFutureHisDBHandler):
                 'opt': 'otc'
             }
         }
-        self._id = OtcIdDBHandler(**kwargs['id'])
+        self._id = get_handler(OtcIdDBHandler, **kwargs['id'])
+
+class OtcSummaryHisDBHandler(TwseSummaryHisDBHandler):
+
+    def __init__(self, **kwargs):
+        super(OtcSummaryHisDBHandler, self).__init__(**copy.deepcopy(kwargs))
+        kwargs = {
+            'id': {
+                'debug': kwargs['debug'],
+                'opt': 'otc'
+            }
+        }
+        self._id = get_handler(OtcIdDBHandler, **kwargs['id'])
+
+class OtcLatestHisDBHandler(TwseLatestHisDBHandler):
+
+    def __init__(self, **kwargs):
+        super(OtcLatestHisDBHandler, self).__init__(**copy.deepcopy(kwargs))
+        kwargs = {
+            'id': {
+                'debug': kwargs['debug'],
+                'opt': 'otc'
+            }
+        }
+        self._id = get_handler(OtcIdDBHandler, **kwargs['id'])
+
+class OtcRollupHisDBHandler(TwseRollupHisDBHandler):
+    pass
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+# process-local bidirectional id <-> name map per id coll
+# loaded in one query, reloaded when the version stamp bumped by insert_raw changes
+# or the ttl expires, so get_name/get_id per result row are dict lookups
+# the n-gram name index is rebuilt with the map and updated in place on local writes
+
+import time
+import threading
+from handler.nameindex import NameIndex
+
+__all__ = ['IdCache']
+
+
+class IdCache(object):
+    """ shared by every id handler on the same (db, coll) in this process
+    cache = IdCache.get(coll, 'stockid', 'stocknm')
+    cache.name('2317') -> u'鴻海'
+    cache.id(u'鴻海') -> '2317'
+    """
+
+    _pool = {}
+    _lock = threading.Lock()
+
+    # ttl: full reload in secs
+    # check: version stamp poll in secs
+    ttl = 600
+    check = 30
+
+    @classmethod
+    def get(cls, coll, idkey, nmkey):
+        key = (coll._meta['db_alias'], coll._get_collection_name())
+        with cls._lock:
+            if key not in cls._pool:
+                cls._pool[key] = cls(coll, idkey, nmkey)
+            return cls._pool[key]
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._pool = {}
+
+    def __init__(self, coll, idkey, nmkey):
+        self._coll = coll
+        self._idkey = idkey
+        self._nmkey = nmkey
+        self._names = {}
+        self._ids = {}
+        self._index = NameIndex()
+        self._version = None
+        self._loaded = 0
+        self._checked = 0
+        self._hits = 0
+        self._loads = 0
+
+    @property
+    def stats(self):
+        return {'hits': self._hits, 'loads': self._loads, 'version': self._version, 'size': len(self._names)}
+
+    def _stamps(self):
+        return self._coll._get_db()['id_version']
+
+    def _stamp(self):
+        it = self._stamps().find_one({'_id': self._coll._get_collection_name()})
+        return it['version'] if it else 0
+
+    def bump(self):
+        """ publish id coll changed to every process,
+        local map stays as is when nobody else wrote in between, otherwise reload on next access
+        """
+        it = self._stamps().find_and_modify(
+            {'_id': self._coll._get_collection_name()},
+            {'$inc': {'version': 1}}, upsert=True, new=True)
+        if self._version is not None and it['version'] == self._version + 1:
+            self._version = it['version']
+        else:
+            self._loaded = 0
+
+    def put(self, id, nm):
+        """ incremental update after insert_raw """
+        if not self._loaded:
+            return
+        old = self._names.get(id, None)
+        if old is not None and self._ids.get(old, None) == id:
+            del self._ids[old]
+        self._names[id] = nm
+        if nm is not None:
+            self._ids.setdefault(nm, id)
+        self._index.add(id, nm)
+
+    def load(self):
+        """ one query for the whole coll, first id wins on duplicated names """
+        version = self._stamp()
+        names, ids = {}, {}
+        cursor = self._coll._get_collection().find({}, {self._idkey: 1, self._nmkey: 1, '_id': 0})
+        for it in cursor.sort(self._idkey, 1):
+            id, nm = it.get(self._idkey, None), it.get(self._nmkey, None)
+            if id is None:
+                continue
+            names[id] = nm
+            if nm is not None:
+                ids.setdefault(nm, id)
+        self._names, self._ids = names, ids
+        self._index = NameIndex(names.iteritems())
+        self._version = version
+        self._loaded = self._checked = time.time()
+        self._loads += 1
+
+    def refresh(self):
+        now = time.time()
+        if now - self._loaded > self.ttl:
+            self.load()
+        elif now - self._checked > self.check:
+            self._checked = now
+            if self._stamp() != self._version:
+                self.load()
+
+    def name(self, id):
+        self.refresh()
+        self._hits += 1
+        return self._names.get(id, None)
+
+    def id(self, nm):
+        self.refresh()
+        self._hits += 1
+        return self._ids.get(nm, None)
+
+    def has_id(self, id):
+        self.refresh()
+        return id in self._names
+
+    def has_name(self, nm):
+        self.refresh()
+        return nm in self._ids
+
+    def names(self):
+        self.refresh()
+        return self._ids.keys()
+
+    def search(self, nm, limit=10):
+        """ fuzzy name search, [(id, name, score)] """
+        self.refresh()
+        return self._index.search(nm, limit)
+
+    def prefix(self, text, limit=10):
+        """ name/id prefix search for autocomplete, [(id, name)] """
+        self.refresh()
+        return self._index.prefix(text, limit)
@@ -5,28 +5,32 @@ import pandas as pd
 import numpy as np
 import os
 import copy
-import difflib
+import threading
 
 from mongoengine import *
 from bin.start import switch
-from bin.mongodb_driver import MongoDBDriver
+from handler.registry import connect_db, count
 from handler.models import TwseIdColl, OtcIdColl, TraderIdColl, StockIdColl
+from handler.idcache import IdCache
+from handler.profiler import profiled
 
 __all__ = ['TwseIdDBHandler', 'OtcIdDBHandler', 'TraderIdDBHandler']
 
+_lock = threading.RLock()
+
 
 class TwseIdDBHandler(object):
 
     def __init__(self, **kwargs):
         self._debug = kwargs.pop('debug', False)
-        host, port = MongoDBDriver._host, MongoDBDriver._port
         db = 'traderiddb' if not self._debug else 'testtraderiddb'
-        connect(db, host=host, port=port, alias=db)
+        connect_db(db)
         traderidcoll = switch(TraderIdColl, db)
         db = 'twseiddb' if not self._debug else 'testtwseiddb'
-        connect(db, host=host, port=port, alias=db)
+        connect_db(db)
         twseidcoll = switch(TwseIdColl, db)
-        kwargs = {
+        # sub handlers are built on first access
+        self._kwargs = {
             'stock': {
                 'coll': twseidcoll,
                 'debug': self._debug,
@@ -38,31 +42,38 @@ class TwseIdDBHandler(object):
                 'opt': 'twse'
             }
         }
-        self._stock = StockIdDBHandler(**kwargs['stock'])
-        self._trader = TraderIdDBHandler(**kwargs['trader'])
+        self._handlers = {}
+
+    def _get(self, target):
+        # async layer reaches sub handlers from pool threads
+        with _lock:
+            if target not in self._handlers:
+                cls = StockIdDBHandler if target == 'stock' else TraderIdDBHandler
+                self._handlers[target] = cls(**self._kwargs[target])
+                count('subhandler')
+            return self._handlers[target]
 
     @property
     def stock(self):
-        return self._stock
+        return self._get('stock')
 
     @property
     def trader(self):
-        return self._trader
+        return self._get('trader')
 
 
 class OtcIdDBHandler(TwseIdDBHandler):
 
     def __init__(self, **kwargs):
-        super(OtcIdDBHandler, self).__init__(**copy.deepcopy(kwargs))
         self._debug = kwargs.pop('debug', False)
-        host, port = MongoDBDriver._host, MongoDBDriver._port
         db = 'traderiddb' if not self._debug else 'testtraderiddb'
-        connect(db, host=host, port=port, alias=db)
+        connect_db(db)
         traderidcoll = switch(TraderIdColl, db)
         db = 'otciddb' if not self._debug else 'testotciddb'
-        connect(db, host=host, port=port, alias=db)
+        connect_db(db)
         otcidcoll = switch(OtcIdColl, db)
-        kwargs = {
+        # sub handlers are built on first access
+        self._kwargs = {
             'stock': {
                 'coll': otcidcoll,
                 'debug': self._debug,
@@ -74,8 +85,7 @@ class OtcIdDBHandler(TwseIdDBHandler):
                 'opt': 'otc'
             }
         }
-        self._stock = StockIdDBHandler(**kwargs['stock'])
-        self._trader = TraderIdDBHandler(**kwargs['trader'])
+        self._handlers = {}
 
 
 class StockIdDBHandler(object):
@@ -85,6 +95,7 @@ class StockIdDBHandler(object):
         self._debug = kwargs.pop('debug', False)
         self._opt = kwargs.pop('opt', None)
         assert(self._coll)
+        self._cache = IdCache.get(self._coll, 'stockid', 'stocknm')
 
     @property
     def coll(self):
@@ -118,32 +129,35 @@ class StockIdDBHandler(object):
             for it in cursor:
                 yield it.stocknm
 
+    @property
+    def cache(self):
+        return self._cache
+
     def get_id(self, stocknm):
-        cursor = self._coll.objects(Q(stocknm=stocknm)).limit(1)
-        cursor = list(cursor)
-        if cursor:
-            return cursor[0].stockid
+        stockid = self._cache.id(stocknm)
+        if stockid:
+            return stockid
         else:
-            stocknms = map(lambda x: x.stocknm, self._coll.objects.all())
-            cursor = difflib.get_close_matches(stocknm, stocknms)
+            cursor = self._cache.search(stocknm, 1)
             if cursor:
-                return cursor[0] 
+                return cursor[0][0]
+
+    def search(self, stocknm, limit=10):
+        """ fuzzy stocknm search as [(stockid, stocknm, score)] """
+        return self._cache.search(stocknm, limit)
+
+    def prefix(self, text, limit=10):
+        """ stockid/stocknm prefix search as [(stockid, stocknm)] """
+        return self._cache.prefix(text, limit)
 
     def get_name(self, stockid):
-        cursor = self._coll.objects(Q(stockid=stockid)).limit(1)
-        cursor = list(cursor)
-        if cursor:
-            return cursor[0].stocknm
+        return self._cache.name(stockid)
 
     def has_id(self, stockid):
-        cursor = self._coll.objects(Q(stockid=stockid)).limit(1)
-        cursor = list(cursor)
-        return True if cursor else False
+        return self._cache.has_id(stockid)
 
     def has_name(self, stocknm):
-        cursor = self._coll.objects(Q(stocknm=stocknm)).limit(1)
-        cursor = list(cursor)
-        return True if cursor else False
+        return self._cache.has_name(stocknm)
 
     def is_warrant(self, stockid):
         return len(stockid) >= 6
@@ -162,7 +176,10 @@ class StockIdDBHandler(object):
             coll = self._coll() if len(cursor) == 0 else cursor[0]
             [setattr(coll, k, it[k]) for k in keys]
             coll.save()
+            self._cache.put(it['stockid'], it['stocknm'])
+        self._cache.bump()
 
+    @profiled('stockid', lambda self: self._coll._get_db())
     def query_raw(self, callback=None):
         # class by market, or tag
         map_f = """
@@ -217,6 +234,7 @@ class TraderIdDBHandler(object):
         self._debug = kwargs.pop('debug', False)
         self._opt = kwargs.pop('opt', None)
         assert(self._coll)
+        self._cache = IdCache.get(self._coll, 'traderid', 'tradernm')
 
     @property
     def coll(self):
@@ -244,32 +262,35 @@ class TraderIdDBHandler(object):
             for it in cursor:
                 yield it.tradernm
 
+    @property
+    def cache(self):
+        return self._cache
+
     def get_id(self, tradernm):
-        cursor = self._coll.objects(Q(tradernm=tradernm)).limit(1)
-        cursor = list(cursor)
-        if cursor:
-            return cursor[0].traderid
+        traderid = self._cache.id(tradernm)
+        if traderid:
+            return traderid
         else:
-            tradernms = map(lambda x: x.tradernm, self._coll.objects.all())
-            cursor = difflib.get_close_matches(tradernm, tradernms)
+            cursor = self._cache.search(tradernm, 1)
             if cursor:
-                return cursor[0] 
+                return cursor[0][0]
+
+    def search(self, tradernm, limit=10):
+        """ fuzzy tradernm search as [(traderid, tradernm, score)] """
+        return self._cache.search(tradernm, limit)
+
+    def prefix(self, text, limit=10):
+        """ traderid/tradernm prefix search as [(traderid, tradernm)] """
+        return self._cache.prefix(text, limit)
 
     def get_name(self, traderid):
-        cursor = self._coll.objects(Q(traderid=traderid)).limit(1)
-        cursor = list(cursor)
-        if cursor:
-            return cursor[0].tradernm
+        return self._cache.name(traderid)
 
     def has_id(self, traderid):
-        cursor = self._coll.objects(Q(traderid=traderid)).limit(1)
-        cursor = list(cursor)
-        return True if cursor else False
+        return self._cache.has_id(traderid)
 
     def has_name(self, tradernm):
-        cursor = self._coll.objects(Q(tradernm=tradernm)).limit(1)
-        cursor = list(cursor)
-        return True if cursor else False
+        return self._cache.has_name(tradernm)
 
     def update_raw(self, item):
         self.insert_raw(item)
@@ -285,7 +306,10 @@ class TraderIdDBHandler(object):
             coll = self._coll() if len(cursor) == 0 else cursor[0]
             [setattr(coll, k, it[k]) for k in keys]
             coll.save()
+            self._cache.put(it['traderid'], it['tradernm'])
+        self._cache.bump()
 
+    @profiled('traderid', lambda self: self._coll._get_db())
     def query_raw(self, callback=None):
         # class by market, or tag
         map_f = """
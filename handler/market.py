@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+# twse + otc as one market, both his handlers queried in parallel on the async pool,
+# every record tagged with its market and merged under one order/limit
+
+from handler.hisdb_handler import TwseHisDBHandler, OtcHisDBHandler
+from handler.async_handler import AsyncHisDBHandler, gather
+from handler.aggregate import AggregateResult, is_spec
+
+__all__ = ['MarketHisDBHandler']
+
+def merge_key(order):
+    """ sort key of order on query_raw records as returned,
+    his query_raw keeps every declarative order field on its records, e* ones too,
+    lambda order sees each record as both key and value
+    """
+    if is_spec(order):
+        order = [(-1 if it.startswith('-') else 1, it.lstrip('+-')) for it in order]
+        return lambda x: [sign * x[k] for sign, k in order]
+    return lambda x: order(AggregateResult(x, x))
+
+
+markets = {
+    'twse': TwseHisDBHandler,
+    'otc': OtcHisDBHandler
+}
+
+
+class MarketHisDBHandler(object):
+    """ ref tests.py
+    db = MarketHisDBHandler(debug=True)
+    item = db.query_raw('stock', starttime, endtime, order=['-totalvolume'], limit=10)
+    item[0]['market'] -> 'twse' or 'otc'
+    """
+
+    def __init__(self, opts=['twse', 'otc'], **kwargs):
+        self._dbs = [(opt, AsyncHisDBHandler(markets[opt], **kwargs)) for opt in opts]
+
+    def market(self, opt):
+        """ his handler of one market """
+        return dict(self._dbs)[opt].db
+
+    def query_raw(self, target, starttime, endtime, stockids=[], traderids=[], base='stock', constraint=None, order=None, limit=10):
+        """ merged query_raw records of every market
+        each market returns its own top limit, so the global top limit is among them,
+        order runs again on the merged records with the fields each market sorted on,
+        otherwise markets stay in opts order
+        """
+        if target == 'trader':
+            args = (starttime, endtime, stockids, traderids, base, constraint, order, limit)
+        else:
+            args = (starttime, endtime, stockids, base, constraint, order, limit)
+        items = gather([db.query_raw(target, *args) for opt, db in self._dbs])
+        merged = []
+        for (opt, db), item in zip(self._dbs, items):
+            for it in item:
+                it.update({'market': opt})
+                merged.append(it)
+        if order:
+            merged = sorted(merged, key=merge_key(order))
+        return merged[:limit] if limit else merged
@@ -55,6 +55,7 @@ class StockHisColl(Document):
         'db_alias': 'stockhisdb',
         'allow_inheritance': True,
         'indexes': [('stockid', 'date')],
+        'index_background': True,
         'ordering': [('-date')]
     }
 
@@ -64,6 +65,214 @@ class TwseHisColl(StockHisColl):
 class OtcHisColl(StockHisColl):
     pass
 
+# per-domain his colls sharing (stockid, date) key, StockHisColl above is kept as migration source
+# raw reads (rawdb, archive, summary/latest/rollup) don't filter on _cls, so their indexes leave it out
+class HisStockColl(Document):
+    stockid = StringField()
+    date = DateTimeField(default=datetime.utcnow())
+    data = EmbeddedDocumentField(StockData)
+    meta = {
+        'db_alias': 'stockhisdb',
+        'allow_inheritance': True,
+        'indexes': [
+            {'fields': ['stockid', 'date'], 'cls': False},
+            {'fields': ['date', 'stockid'], 'cls': False}
+        ],
+        'index_background': True,
+        'ordering': [('-date')]
+    }
+
+class TwseHisStockColl(HisStockColl):
+    pass
+
+class OtcHisStockColl(HisStockColl):
+    pass
+
+class HisTraderColl(Document):
+    stockid = StringField()
+    date = DateTimeField(default=datetime.utcnow())
+    toplist = ListField(EmbeddedDocumentField(TraderInfo))
+    # stock day data copy as buy/sell ratio base
+    data = EmbeddedDocumentField(StockData)
+    meta = {
+        'db_alias': 'stockhisdb',
+        'allow_inheritance': True,
+        'indexes': [
+            {'fields': ['stockid', 'date'], 'cls': False},
+            {'fields': ['date', 'stockid'], 'cls': False},
+            {'fields': ['toplist.traderid', 'date'], 'cls': False}
+        ],
+        'index_background': True,
+        'ordering': [('-date')]
+    }
+
+class TwseHisTraderColl(HisTraderColl):
+    pass
+
+class OtcHisTraderColl(HisTraderColl):
+    pass
+
+class HisCreditColl(Document):
+    stockid = StringField()
+    date = DateTimeField(default=datetime.utcnow())
+    finance = EmbeddedDocumentField(CreditData)
+    bearish = EmbeddedDocumentField(CreditData)
+    meta = {
+        'db_alias': 'stockhisdb',
+        'allow_inheritance': True,
+        'indexes': [
+            {'fields': ['stockid', 'date'], 'cls': False},
+            {'fields': ['date', 'stockid'], 'cls': False}
+        ],
+        'index_background': True,
+        'ordering': [('-date')]
+    }
+
+class TwseHisCreditColl(HisCreditColl):
+    pass
+
+class OtcHisCreditColl(HisCreditColl):
+    pass
+
+class HisFutureColl(Document):
+    stockid = StringField()
+    date = DateTimeField(default=datetime.utcnow())
+    future = EmbeddedDocumentField(FutureData)
+    # stock day data copy as stock/future diff base
+    data = EmbeddedDocumentField(StockData)
+    meta = {
+        'db_alias': 'stockhisdb',
+        'allow_inheritance': True,
+        'indexes': [
+            {'fields': ['stockid', 'date'], 'cls': False},
+            {'fields': ['date', 'stockid'], 'cls': False}
+        ],
+        'index_background': True,
+        'ordering': [('-date')]
+    }
+
+class TwseHisFutureColl(HisFutureColl):
+    pass
+
+class OtcHisFutureColl(HisFutureColl):
+    pass
+
+class TraderStockColl(Document):
+    # inverted toplist as trader-centric index, maintained by trader/stock insert_raw
+    traderid = StringField()
+    stockid = StringField()
+    date = DateTimeField(default=datetime.utcnow())
+    volume = IntField(min_value=0, max_value=9999999)
+    data = EmbeddedDocumentField(TraderData)
+    meta = {
+        'db_alias': 'stockhisdb',
+        'allow_inheritance': True,
+        'indexes': [
+            {'fields': ['traderid', 'date', 'stockid'], 'cls': False},
+            {'fields': ['stockid', 'date'], 'cls': False}
+        ],
+        'index_background': True,
+        'ordering': [('-date')]
+    }
+
+class TwseTraderStockColl(TraderStockColl):
+    pass
+
+class OtcTraderStockColl(TraderStockColl):
+    pass
+
+class HisSummaryColl(Document):
+    # rolling window summary per (stockid, date, window), maintained by his summary update,
+    # window 1 rows hold the day values wider windows add and subtract
+    stockid = StringField()
+    date = DateTimeField(default=datetime.utcnow())
+    window = IntField(min_value=1, max_value=999)
+    totalvolume = IntField()
+    totalhldiff = FloatField()
+    totalkeepbuy = IntField()
+    ebuyratio = FloatField()
+    efinanceremain = FloatField()
+    edfcdiff = FloatField()
+    meta = {
+        'db_alias': 'stockhisdb',
+        'allow_inheritance': True,
+        'indexes': [
+            {'fields': ['stockid', 'window', 'date'], 'cls': False},
+            {'fields': ['window', 'date'], 'cls': False}
+        ],
+        'ordering': [('-date')]
+    }
+
+class TwseHisSummaryColl(HisSummaryColl):
+    pass
+
+class OtcHisSummaryColl(HisSummaryColl):
+    pass
+
+class HisLatestColl(Document):
+    # last complete row per stockid across stock/trader/credit/future, upserted by his pipelines,
+    # dates keeps the day each part came from
+    stockid = StringField()
+    date = DateTimeField(default=datetime.utcnow())
+    dates = DictField()
+    data = EmbeddedDocumentField(StockData)
+    finance = EmbeddedDocumentField(CreditData)
+    bearish = EmbeddedDocumentField(CreditData)
+    future = EmbeddedDocumentField(FutureData)
+    eclose = FloatField()
+    evolume = IntField()
+    ebuyratio = FloatField()
+    efinanceremain = FloatField()
+    ebearishremain = FloatField()
+    ebearfinaratio = FloatField()
+    edfcdiff = FloatField()
+    meta = {
+        'db_alias': 'stockhisdb',
+        'allow_inheritance': True,
+        'indexes': [{'fields': ['stockid'], 'unique': True, 'cls': False}],
+        'ordering': [('+stockid')]
+    }
+
+class TwseHisLatestColl(HisLatestColl):
+    pass
+
+class OtcHisLatestColl(HisLatestColl):
+    pass
+
+class HisRollupColl(Document):
+    # weekly/monthly rollup keyed on (stockid, period start date, frequency),
+    # data/toplist/finance/bearish/future in daily doc shape so every his pipeline runs on it unchanged
+    stockid = StringField()
+    date = DateTimeField(default=datetime.utcnow())
+    frequency = StringField(choices=('week', 'month'))
+    enddate = DateTimeField()
+    # last day of each target applied, an older or same day landing is a correction
+    enddates = DictField()
+    data = EmbeddedDocumentField(StockData)
+    toplist = ListField(EmbeddedDocumentField(TraderInfo))
+    finance = EmbeddedDocumentField(CreditData)
+    bearish = EmbeddedDocumentField(CreditData)
+    future = EmbeddedDocumentField(FutureData)
+    buyvolume = IntField()
+    sellvolume = IntField()
+    financeremain = IntField()
+    bearishremain = IntField()
+    meta = {
+        'db_alias': 'stockhisdb',
+        'allow_inheritance': True,
+        'indexes': [
+            {'fields': ['frequency', 'stockid', 'date'], 'cls': False},
+            {'fields': ['frequency', 'toplist.traderid', 'date'], 'cls': False}
+        ],
+        'ordering': [('-date')]
+    }
+
+class TwseHisRollupColl(HisRollupColl):
+    pass
+
+class OtcHisRollupColl(HisRollupColl):
+    pass
+
 class StockIdColl(Document):
     stockid = StringField()
     stocknm = StringField()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# character n-gram index over stocknm/tradernm for fuzzy and prefix search
+# CJK names are short (2~4 chars) so every CJK char is a gram of its own plus
+# bigrams, latin/digit runs are lowered and cut as bigrams only
+
+import re
+import bisect
+import heapq
+from collections import defaultdict
+
+__all__ = ['NameIndex', 'grams']
+
+_cjk = re.compile(u'[㐀-䶿一-鿿豈-﫿]')
+_strip = re.compile(u'[\s\-_\.\(\)（）]+')
+
+
+def normalize(text):
+    return _strip.sub(u'', text if isinstance(text, unicode) else text.decode('utf-8')).lower()
+
+
+def grams(text):
+    """ set of char n-grams of name """
+    text = normalize(text)
+    retval = set(text[i:i+2] for i in range(len(text) - 1))
+    retval.update(c for c in text if _cjk.match(c))
+    if len(text) == 1:
+        retval.add(text)
+    return retval
+
+
+class NameIndex(object):
+    """ ref tests.py
+    index = NameIndex()
+    index.add('2317', u'鴻海')
+    index.search(u'鴻海精密') -> [('2317', u'鴻海', 0.67)]
+    index.prefix(u'鴻') -> [('2317', u'鴻海')]
+    """
+
+    def __init__(self, items=[]):
+        self._postings = defaultdict(set)
+        self._grams = {}
+        self._names = {}
+        # sorted (key, id) for prefix search on normalized names and ids
+        self._keys = []
+        for id, nm in items:
+            self.add(id, nm)
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, id, nm):
+        """ add or rename id incrementally """
+        if id in self._names:
+            self.remove(id)
+        if not nm:
+            return
+        gs = grams(nm)
+        for g in gs:
+            self._postings[g].add(id)
+        self._grams[id] = gs
+        self._names[id] = nm
+        for key in [normalize(nm), normalize(id)]:
+            bisect.insort(self._keys, (key, id))
+
+    def remove(self, id):
+        nm = self._names.pop(id, None)
+        if nm is None:
+            return
+        for g in self._grams.pop(id, []):
+            self._postings[g].discard(id)
+            if not self._postings[g]:
+                del self._postings[g]
+        for key in [normalize(nm), normalize(id)]:
+            i = bisect.bisect_left(self._keys, (key, id))
+            if i < len(self._keys) and self._keys[i] == (key, id):
+                del self._keys[i]
+
+    def search(self, text, limit=10, cutoff=0.3):
+        """ top-k ids by dice similarity of n-grams, [(id, name, score)] """
+        qs = grams(text)
+        if not qs:
+            return []
+        hits = defaultdict(int)
+        for g in qs:
+            for id in self._postings.get(g, ()):
+                hits[id] += 1
+        scores = (
+            (2.0 * n / (len(qs) + len(self._grams[id])), id)
+            for id, n in hits.iteritems())
+        top = heapq.nlargest(limit, (it for it in scores if it[0] >= cutoff))
+        return [(id, self._names[id], round(score, 2)) for score, id in top]
+
+    def prefix(self, text, limit=10):
+        """ ids whose name or id starts with text, [(id, name)] """
+        key = normalize(text)
+        retval, seen = [], set()
+        i = bisect.bisect_left(self._keys, (key,))
+        while i < len(self._keys) and len(retval) < limit:
+            k, id = self._keys[i]
+            if not k.startswith(key):
+                break
+            if id not in seen:
+                seen.add(id)
+                retval.append((id, self._names[id]))
+            i += 1
+        return retval
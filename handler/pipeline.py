@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+
+# in process evaluator of only the mongo query/pipeline subset his handlers build,
+# runs aggregate pipelines over raw docs that are not on the server, as archive read-through
+# query:        $and $or $in $nin $exists $eq $ne $gt $gte $lt $lte, dotted paths through lists,
+#               cursor filters and compile_constraint
+# stages:       $match $project $sort $group $unwind of query_raw pipelines, $match $sort $limit of pushdown
+# expressions:  $<path> $cond $subtract $multiply $divide $gt $lt $and,
+#               absolute/ratio/trend and the query_raw projections
+# accumulators: $first $last $sum $avg $push
+# anything else raises ValueError instead of silently diverging from the server,
+# parity with the server per his target is in tests.py TestTwseHisArchive
+
+import copy
+from itertools import islice
+from datetime import datetime
+from calendar import timegm
+
+__all__ = ['match', 'run']
+
+_missing = object()
+
+
+def _norm(v):
+    """ aware datetime as naive utc, as stored by the server """
+    if isinstance(v, datetime) and v.tzinfo is not None:
+        return v.replace(tzinfo=None) - v.utcoffset()
+    return v
+
+
+def _rank(v):
+    # bson comparison order of the types his docs hold
+    if v is _missing or v is None:
+        return 0
+    if isinstance(v, bool):
+        return 8
+    if isinstance(v, (int, long, float)):
+        return 1
+    if isinstance(v, basestring):
+        return 2
+    if isinstance(v, dict):
+        return 3
+    if isinstance(v, (list, tuple)):
+        return 4
+    if isinstance(v, datetime):
+        return 9
+    return 10
+
+
+def _key(v):
+    """ sort key in bson order across types """
+    v = _norm(v)
+    return (_rank(v), None if v is _missing else v)
+
+
+def _cmp(a, b):
+    return cmp(_key(a), _key(b))
+
+
+def _get(doc, path):
+    """ value at dotted path, lists of docs map to lists of values, _missing if not there """
+    it = doc
+    for k in path.split('.'):
+        if isinstance(it, dict):
+            it = it.get(k, _missing)
+        elif isinstance(it, list):
+            it = [x[k] for x in it if isinstance(x, dict) and k in x]
+        else:
+            return _missing
+        if it is _missing:
+            return _missing
+    return it
+
+
+def _values(doc, path):
+    """ every value a query on path tests, leaf lists by element and as a whole """
+    items = [doc]
+    for k in path.split('.'):
+        items = [it[k] for it in _expand(items) if isinstance(it, dict) and k in it]
+    retval = []
+    for it in items:
+        retval.append(it)
+        if isinstance(it, list):
+            retval.extend(it)
+    return retval
+
+
+def _expand(items):
+    for it in items:
+        if isinstance(it, list):
+            for x in it:
+                yield x
+        else:
+            yield it
+
+
+def _same(a, b):
+    return _rank(a) == _rank(b) and _norm(a) == _norm(b)
+
+
+def _test(values, cond):
+    if isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond.keys()):
+        return all(_op(values, op, v) for op, v in cond.items())
+    return _op(values, '$eq', cond)
+
+
+def _op(values, op, arg):
+    if op == '$exists':
+        return bool(values) == bool(arg)
+    if op == '$eq':
+        return any(_same(v, arg) for v in values) or (arg is None and not values)
+    if op == '$ne':
+        return not _op(values, '$eq', arg)
+    if op == '$in':
+        return any(_op(values, '$eq', it) for it in arg)
+    if op == '$nin':
+        return not _op(values, '$in', arg)
+    if op in _query_cmp:
+        # type bracketing, numbers never match a date bound
+        return any(_rank(v) == _rank(arg) and _query_cmp[op](_cmp(v, arg)) for v in values)
+    raise ValueError("pipeline: unsupported query op %s" % (op))
+
+_query_cmp = {
+    '$gt': lambda c: c > 0,
+    '$gte': lambda c: c >= 0,
+    '$lt': lambda c: c < 0,
+    '$lte': lambda c: c <= 0
+}
+
+
+def match(doc, query):
+    """ doc passes mongo query """
+    for k, cond in query.items():
+        if k == '$and':
+            if not all(match(doc, it) for it in cond):
+                return False
+        elif k == '$or':
+            if not any(match(doc, it) for it in cond):
+                return False
+        elif not _test(_values(doc, k), cond):
+            return False
+    return True
+
+
+def _match(docs, query):
+    for it in docs:
+        if match(it, query):
+            yield it
+
+
+def _truth(v):
+    return not (v is _missing or v is None or v is False or (_rank(v) == 1 and v == 0))
+
+
+def _num(v):
+    return None if v is _missing else v
+
+
+def _ms(v):
+    return timegm(_norm(v).utctimetuple()) * 1000 + _norm(v).microsecond // 1000
+
+
+def _subtract(a, b):
+    if a is None or b is None:
+        return None
+    if isinstance(a, datetime) and isinstance(b, datetime):
+        return _ms(a) - _ms(b)
+    return a - b
+
+
+def _divide(a, b):
+    if a is None or b is None:
+        return None
+    return float(a) / b
+
+
+def _multiply(args):
+    if any(it is None for it in args):
+        return None
+    return reduce(lambda a, b: a * b, args)
+
+_exprs = {
+    '$multiply': _multiply,
+    '$subtract': lambda args: _subtract(*args),
+    '$divide': lambda args: _divide(*args),
+    '$gt': lambda args: _cmp(*args) > 0,
+    '$lt': lambda args: _cmp(*args) < 0,
+    '$and': lambda args: all(_truth(it) for it in args)
+}
+
+
+def _eval(expr, doc):
+    """ aggregation expression on doc, _missing for a path not there """
+    if isinstance(expr, basestring) and expr.startswith('$'):
+        return _get(doc, expr[1:])
+    if isinstance(expr, dict):
+        if len(expr) == 1 and expr.keys()[0].startswith('$'):
+            op, args = expr.items()[0]
+            if op == '$cond':
+                args = [args['if'], args['then'], args['else']] if isinstance(args, dict) else args
+                return _eval(args[1] if _truth(_eval(args[0], doc)) else args[2], doc)
+            if op not in _exprs:
+                raise ValueError("pipeline: unsupported expression %s" % (op))
+            args = args if isinstance(args, list) else [args]
+            return _exprs[op]([_num(_eval(it, doc)) for it in args])
+        retval = {}
+        for k, v in expr.items():
+            v = _eval(v, doc)
+            if v is not _missing:
+                retval[k] = v
+        return retval
+    if isinstance(expr, list):
+        return [_num(_eval(it, doc)) for it in expr]
+    return expr
+
+
+def _set(doc, path, v):
+    keys = path.split('.')
+    for k in keys[:-1]:
+        doc = doc.setdefault(k, {})
+    doc[keys[-1]] = v
+
+
+def _include(src, keys, dst):
+    """ copy src path keys onto dst, through sub docs and lists of docs """
+    k = keys[0]
+    if not isinstance(src, dict) or k not in src:
+        return
+    v = src[k]
+    if len(keys) == 1:
+        dst[k] = copy.deepcopy(v)
+    elif isinstance(v, dict):
+        _include(v, keys[1:], dst.setdefault(k, {}))
+    elif isinstance(v, list):
+        items = dst.setdefault(k, [{} for it in v])
+        for it, out in zip(v, items):
+            _include(it, keys[1:], out)
+
+
+def _exclude(doc, keys):
+    if not isinstance(doc, dict) or keys[0] not in doc:
+        return
+    if len(keys) == 1:
+        del doc[keys[0]]
+    elif isinstance(doc[keys[0]], list):
+        for it in doc[keys[0]]:
+            _exclude(it, keys[1:])
+    else:
+        _exclude(doc[keys[0]], keys[1:])
+
+
+def _project(docs, spec):
+    excludes = [k for k, v in spec.items() if k != '_id' and v in [0, False]]
+    for doc in docs:
+        if excludes:
+            out = copy.deepcopy(doc)
+            for k in excludes:
+                _exclude(out, k.split('.'))
+        else:
+            out = {}
+            for k, v in spec.items():
+                if v in [0, False]:
+                    continue
+                if v is True or _rank(v) == 1:
+                    _include(doc, k.split('.'), out)
+                else:
+                    v = _eval(v, doc)
+                    if v is not _missing:
+                        _set(out, k, v)
+            if '_id' in doc and '_id' not in spec:
+                out['_id'] = doc['_id']
+        if spec.get('_id', 1) in [0, False]:
+            out.pop('_id', None)
+        yield out
+
+
+def _sort(docs, spec):
+    docs = list(docs)
+    # stable sorts from the last key to the first
+    for k, sign in reversed(spec.items()):
+        docs.sort(key=lambda x: _key(_get(x, k)), reverse=sign < 0)
+    return docs
+
+
+def _unwind(docs, spec):
+    path = (spec['path'] if isinstance(spec, dict) else spec)[1:]
+    for doc in docs:
+        v = _get(doc, path)
+        if isinstance(v, list):
+            for it in v:
+                out = copy.deepcopy(doc) if '.' in path else copy.copy(doc)
+                _set(out, path, it)
+                yield out
+        elif v is not _missing and v is not None:
+            yield doc
+
+
+def _hashable(v):
+    if isinstance(v, dict):
+        return tuple((k, _hashable(x)) for k, x in v.items())
+    if isinstance(v, list):
+        return tuple(_hashable(x) for x in v)
+    return _norm(v)
+
+
+class _Acc(object):
+
+    def __init__(self, op):
+        if op not in ['$first', '$last', '$sum', '$avg', '$push']:
+            raise ValueError("pipeline: unsupported accumulator %s" % (op))
+        self.op = op
+        self.n = 0
+        self.value = [] if op == '$push' else (0 if op in ['$sum', '$avg'] else _missing)
+
+    def add(self, v):
+        op = self.op
+        if op == '$first':
+            if not self.n:
+                self.value = v
+        elif op == '$last':
+            self.value = v
+        elif op == '$push':
+            if v is not _missing:
+                self.value.append(v)
+        elif op in ['$sum', '$avg']:
+            if _rank(v) == 1 and not isinstance(v, bool):
+                self.value += v
+                self.n += 1
+            return
+        self.n += 1
+
+    def result(self):
+        if self.op == '$avg':
+            return float(self.value) / self.n if self.n else None
+        return None if self.value is _missing else self.value
+
+
+def _group(docs, spec):
+    groups, keys = {}, []
+    for doc in docs:
+        key = _eval(spec['_id'], doc)
+        key = None if key is _missing else key
+        h = _hashable(key)
+        if h not in groups:
+            groups[h] = (key, [(k, _Acc(v.keys()[0])) for k, v in spec.items() if k != '_id'])
+            keys.append(h)
+        for k, acc in groups[h][1]:
+            acc.add(_eval(spec[k].values()[0], doc))
+    for h in keys:
+        key, accs = groups[h]
+        out = {'_id': key}
+        out.update((k, acc.result()) for k, acc in accs)
+        yield out
+
+
+def run(docs, stages):
+    """ pipeline stages over an iterable of raw docs, lazy where the stage allows """
+    for stage in stages:
+        name, spec = stage.items()[0]
+        if name == '$match':
+            docs = _match(docs, spec)
+        elif name == '$project':
+            docs = _project(docs, spec)
+        elif name == '$sort':
+            docs = iter(_sort(docs, spec))
+        elif name == '$group':
+            docs = _group(docs, spec)
+        elif name == '$unwind':
+            docs = _unwind(docs, spec)
+        elif name == '$limit':
+            docs = islice(docs, spec)
+        else:
+            raise ValueError("pipeline: unsupported stage %s" % (name))
+    return docs
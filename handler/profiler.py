@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# slow query instrumentation for his/id/alg handler queries
+# every wrapped call appends one json line to <logpath>/metrics/queries.log:
+#   handler, target, method, window days, stockid/traderid count,
+#   elapsed ms, docs returned, docs examined by this query (explain executionStats
+#   of the $match run by aggregate(), None for calls that don't go through it),
+#   server wide docs examined (serverStatus delta, counts overlapping queries too),
+#   bson bytes shipped back by aggregate()/find_raw, the explain itself when slow
+# off by default, every wrapped call costs an explain, two serverStatus commands and a log write,
+# GIANT_PROFILE=1 turns it on
+# python bin/querystats.py ranks the logged query shapes
+
+import os
+import json
+import time
+import inspect
+import threading
+import functools
+import types
+from bson import BSON
+from datetime import datetime
+from bin.mongodb_driver import MongoDBDriver
+
+__all__ = ['profiled', 'capture', 'account', 'settings', 'read_log']
+
+# enabled: log every wrapped call, GIANT_PROFILE=1
+# threshold: elapsed ms over which explain is captured
+settings = {
+    'enabled': os.environ.get('GIANT_PROFILE', '0') == '1',
+    'threshold': float(os.environ.get('GIANT_SLOW_MS', '500')),
+    'path': os.path.join(MongoDBDriver._logpath, 'metrics', 'queries.log')
+}
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def capture(collection, query):
+    """ remember the leading $match of the running query, called by aggregate() """
+    if getattr(_local, 'calls', None):
+        _local.calls[-1]['match'] = (collection, query)
+
+
+def account(doc):
+    """ add bson size of a doc shipped back to the running query, called per result """
+    if getattr(_local, 'calls', None):
+        record = _local.calls[-1]
+        record['bytes'] = (record['bytes'] or 0) + len(BSON.encode(doc))
+
+
+def _scanned(db):
+    """ server wide keys + docs examined so far """
+    try:
+        metrics = db.command('serverStatus')['metrics']['queryExecutor']
+        return metrics.get('scanned', 0) + metrics.get('scannedObjects', 0)
+    except Exception:
+        return None
+
+
+def _explain(collection, query):
+    """ plan summary of query on collection, 2.x and 3.x explain layouts """
+    try:
+        plan = collection.find(query).explain()
+    except Exception as e:
+        return {'error': str(e)}
+    stats = plan.get('executionStats', {})
+    winning = plan.get('queryPlanner', {}).get('winningPlan', None)
+    return {
+        'coll': collection.name,
+        'cursor': plan.get('cursor', None) or json.dumps(winning, default=str)[:500],
+        'examined': plan.get('nscannedObjects', stats.get('totalDocsExamined', None)),
+        'keys': plan.get('nscanned', stats.get('totalKeysExamined', None)),
+        'returned': plan.get('n', stats.get('nReturned', None))
+    }
+
+
+def _write(record):
+    path = settings['path']
+    line = json.dumps(record, default=str)
+    with _lock:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'a') as f:
+            f.write(line + '\n')
+
+
+def read_log(path=None):
+    path = path if path else settings['path']
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def profiled(target, db=lambda self: None):
+    """ wrap handler query method as profiled call of target
+    db: handler -> pymongo db for server wide serverStatus deltas, optional
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            if not settings['enabled']:
+                return fn(self, *args, **kwargs)
+            try:
+                params = inspect.getcallargs(fn, self, *args, **kwargs)
+            except TypeError:
+                params = {}
+            starttime, endtime = params.get('starttime', None), params.get('endtime', None)
+            record = {
+                'at': datetime.utcnow(),
+                'handler': self.__class__.__name__,
+                'target': target,
+                'method': fn.__name__,
+                'window': (endtime - starttime).days if starttime and endtime else None,
+                'stockids': len(params.get('stockids', None) or []),
+                'traderids': len(params.get('traderids', None) or []),
+                'bytes': None
+            }
+            pdb = db(self)
+            before = _scanned(pdb) if pdb is not None else None
+            calls = _local.__dict__.setdefault('calls', [])
+            calls.append(record)
+            start = time.time()
+            try:
+                retval = fn(self, *args, **kwargs)
+            except Exception:
+                calls.pop()
+                raise
+
+            def finish(returned):
+                record['elapsed'] = round((time.time() - start) * 1000, 2)
+                record['returned'] = returned
+                after = _scanned(pdb) if before is not None else None
+                record['server_examined'] = after - before if after is not None else None
+                match = record.pop('match', None)
+                plan = _explain(*match) if match else {}
+                record['examined'] = plan.get('examined', None)
+                if plan and record['elapsed'] >= settings['threshold']:
+                    record['explain'] = plan
+                _write(record)
+
+            calls.pop()
+            if isinstance(retval, types.GeneratorType):
+                # stream mode, log once the caller drained it
+                def drain(retval):
+                    n = 0
+                    calls.append(record)
+                    try:
+                        for it in retval:
+                            n += 1
+                            yield it
+                    finally:
+                        calls.remove(record)
+                    finish(n)
+                return drain(retval)
+            finish(len(retval) if hasattr(retval, '__len__') else None)
+            return retval
+        return wrapper
+    return decorator
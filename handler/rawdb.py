@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+# raw pymongo fast path of his colls, opt in for bulk scans
+# reads return plain dicts or numpy columns under an explicit projection,
+# no mongoengine Document is built or validated per doc,
+# writes of the same shape go through hisdb_handler.bulk_upsert (bulk=True handlers)
+# mongoengine docs stay for admin, forms and the non bulk insert_raw
+# python bin/rawbench.py compares docs/sec of both paths
+
+import numpy as np
+from collections import OrderedDict
+from handler.profiler import account
+
+__all__ = ['projections', 'find_raw', 'to_columns']
+
+# target -> fields read by default besides stockid/date, only the ones its query_raw
+# pipeline uses, so unused fields like data.price never leave the server
+projections = {
+    'stock': ['data.open', 'data.high', 'data.low', 'data.close', 'data.volume'],
+    'trader': ['data.volume', 'toplist'],
+    'credit': ['finance', 'bearish'],
+    'future': ['future', 'data.open', 'data.high', 'data.low', 'data.close']
+}
+
+
+def projection(fields):
+    """ pymongo projection of stockid, date and fields, _id left out """
+    retval = {'_id': 0, 'stockid': 1, 'date': 1}
+    retval.update({k: 1 for k in fields})
+    return retval
+
+
+def find_raw(coll, starttime, endtime, stockids=[], fields=[], archive=None, batch_size=1000):
+    """ raw docs of coll in [starttime, endtime] sorted by (stockid, date)
+    fields: top level or dotted fields, as 'data' or 'data.close'
+    archive: windows reaching it read both tiers, ref archive.read
+    """
+    query = {'date': {'$gte': starttime, '$lte': endtime}}
+    if stockids:
+        query.update({'stockid': {'$in': list(stockids)}})
+    sort = [('stockid', 1), ('date', 1)]
+    if archive is not None:
+        cursor = archive.read(coll, query, starttime, endtime, projection(fields), sort, batch_size)
+    else:
+        cursor = coll._get_collection().find(query, projection(fields), sort=sort).batch_size(batch_size)
+    for it in cursor:
+        account(it)
+        yield it
+
+
+def _flatten(doc, prefix, out):
+    for k, v in doc.iteritems():
+        if isinstance(v, dict):
+            _flatten(v, prefix + k + '.', out)
+        elif not isinstance(v, list):
+            out[prefix + k] = v
+    return out
+
+
+def to_columns(docs):
+    """ {path: array} of raw docs, one row per doc
+    stockid as unicode, date as datetime64, other scalars as float64 with nan when missing,
+    list fields like toplist are left out, read them from find_raw
+    """
+    rows = [_flatten(it, '', {}) for it in docs]
+    paths = []
+    for row in rows:
+        for k in row.iterkeys():
+            if k not in paths:
+                paths.append(k)
+    retval = OrderedDict()
+    for k in ['stockid', 'date'] + sorted(it for it in paths if it not in ['stockid', 'date']):
+        if k == 'stockid':
+            retval[k] = np.array([it.get(k, u'') for it in rows], dtype=np.unicode_)
+        elif k == 'date':
+            retval[k] = np.array([it.get(k, None) for it in rows], dtype='datetime64[ns]')
+        else:
+            values = [it.get(k, None) for it in rows]
+            retval[k] = np.array([v if isinstance(v, (int, long, float)) else np.nan for v in values], dtype=np.float64)
+    return retval
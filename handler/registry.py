@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# registry of db connections and db handlers
+# one connect() per db alias per process and one handler per (class, kwargs) such as
+# (market, debug) per thread, handlers keep per-query state (trader alias pool, ids),
+# so a thread never sees the one of a query running on another thread
+# counters tell how many were really created vs reused
+
+import threading
+from collections import Counter
+from mongoengine import connect
+from bin.mongodb_driver import MongoDBDriver
+
+__all__ = ['connect_db', 'get_handler', 'count', 'counters', 'delta', 'clear']
+
+_lock = threading.RLock()
+_conns = {}
+_local = threading.local()
+# bumped by clear(), handlers of older generations are dropped on next access
+_generation = [0]
+_counters = Counter()
+
+
+def count(key, n=1):
+    with _lock:
+        _counters[key] += n
+
+
+def connect_db(db):
+    """ connect mongoengine alias db once per process """
+    with _lock:
+        if db not in _conns:
+            host, port = MongoDBDriver._host, MongoDBDriver._port
+            _conns[db] = connect(db, host=host, port=port, alias=db)
+            count('connect')
+        else:
+            count('connect_reuse')
+        return _conns[db]
+
+
+def _handlers():
+    if getattr(_local, 'generation', None) != _generation[0]:
+        _local.handlers = {}
+        _local.generation = _generation[0]
+    return _local.handlers
+
+
+def get_handler(cls, **kwargs):
+    """ shared handler instance of this thread per (cls, kwargs) like (TwseHisDBHandler, debug=True) """
+    key = (cls, tuple(sorted(kwargs.items())))
+    handlers = _handlers()
+    if key not in handlers:
+        handlers[key] = cls(**kwargs)
+        count('handler')
+    else:
+        count('handler_reuse')
+    return handlers[key]
+
+
+def counters():
+    return dict(_counters)
+
+
+def delta(before):
+    """ counters since before = counters() snapshot, as created per task """
+    return {k: v - before.get(k, 0) for k, v in _counters.items() if v - before.get(k, 0)}
+
+
+def clear():
+    """ drop handlers of every thread and reset counters """
+    with _lock:
+        _generation[0] += 1
+        _counters.clear()
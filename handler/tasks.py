@@ -3,8 +3,13 @@ from __future__ import absolute_import
 
 import pickle
 import pandas as pd
+from datetime import datetime, timedelta
 from handler.iddb_handler import TwseIdDBHandler, OtcIdDBHandler
 from handler.hisdb_handler import TwseHisDBHandler, OtcHisDBHandler
+from handler.colstore import ColumnStore
+from handler.hiscache import HisCache, make_key
+from handler.market import MarketHisDBHandler
+from handler.registry import get_handler, counters, delta
 
 from giant.celery import app
 from celery import shared_task
@@ -27,6 +32,7 @@ iditems = ['stock', 'trader']
 
 @shared_task(time_limit=60*60)
 def collect_iditem(stream):
+    before = counters()
     args, kwargs = pickle.loads(stream)
 
     opt = kwargs.pop('opt', None)
@@ -35,21 +41,37 @@ def collect_iditem(stream):
     debug = kwargs.pop('debug', False)
 
     item = {}
-    idhandler = iddb_tasks[opt](debug=debug)
+    idhandler = get_handler(iddb_tasks[opt], debug=debug)
     for target in targets:
         ptr = getattr(idhandler, target)
         dt = ptr.query_raw()
         if dt:
             item.update({target+'item': dt})
 
+    logger.info("collect_iditem registry: %s" % (delta(before)))
     return pickle.dumps(item)
 
 
 def collect_idframe():
     pass
 
+
+def search_iditem(opt, term, targets=['stock', 'trader'], limit=10, debug=False):
+    """ autocomplete ids by id/name prefix first, then fuzzy name match """
+    retval = []
+    idhandler = get_handler(iddb_tasks[opt], debug=debug)
+    for target in targets:
+        ptr = getattr(idhandler, target)
+        pool = ptr.prefix(term, limit)
+        ids = set(id for id, nm in pool)
+        pool += [(id, nm) for id, nm, score in ptr.search(term, limit) if id not in ids]
+        for id, nm in pool[:limit]:
+            retval.append({'label': u"%s %s" % (id, nm), 'value': id, 'target': target})
+    return retval
+
 @shared_task(time_limit=60*60)
 def collect_hisitem(stream):
+    before = counters()
     args, kwargs = pickle.loads(stream)
 
     opt = kwargs.pop('opt', None)
@@ -62,53 +84,173 @@ def collect_hisitem(stream):
     stockids = kwargs.pop('stockids', [])
     traderids = kwargs.pop('traderids', [])
     limit = kwargs.pop('limit', 10)
+    window = kwargs.pop('window', 5)
+    frequency = kwargs.pop('frequency', 'day')
+    # {target: [field, ...]} projection, per target defaults of rawdb.projections otherwise
+    fields = kwargs.pop('fields', {})
     callback = kwargs.pop('callback', None)
+    engine = kwargs.pop('engine', 'aggregate')
+    cache = kwargs.pop('cache', True)
     debug = kwargs.pop('debug', False)
-    
+    # query_raw checks each projection covers what constraint/order read
+    if fields and engine != 'aggregate':
+        raise ValueError("fields: projection is aggregate engine only, not %s" % (engine))
+
     item = {}
-    dbhandler = hisdb_tasks[opt](debug=debug)
+    dbhandler = get_handler(hisdb_tasks[opt], debug=debug, engine=engine)
+    qcache = HisCache.get_cache(opt, dbhandler.version, debug=debug) if cache else None
     for target in targets:
-        if target in hisitems:
+        if target in hisitems + ['summary']:
             ptr = getattr(dbhandler, target)
             if target in ['trader']:
                 args = (starttime, endtime, stockids, traderids, base, constraint, order, limit)
             else:
                 args = (starttime, endtime, stockids, base, constraint, order, limit)
+            # summary reads precomputed rolling window rows, his targets may read week/month rollups
+            extra = {'window': window} if target == 'summary' else {'frequency': frequency}
+            if target in fields:
+                extra.update({'fields': tuple(fields[target])})
 
-            dt = ptr.query_raw(*args)
+            key = make_key(opt, target, starttime, endtime, stockids, traderids, base, limit, constraint, order, engine=engine, fn='item', **extra)
+            dt = qcache.get(key) if qcache and key else None
+            if dt is None:
+                dt = ptr.query_raw(*args, **extra)
+                if qcache and key:
+                    qcache.put(key, dt)
             if dt:
                 item.update({target+'item': dt})
 
+    logger.info("collect_hisitem registry: %s" % (delta(before)))
+    if qcache:
+        logger.info("collect_hisitem cache: %s" % (qcache.stats))
     return pickle.dumps(item)
 
 
-def collect_hisframe(opt, targets, starttime, endtime, base='stock', constraint=None, order=None, stockids=[], traderids=[], limit=10, callback=None, debug=False):
+@shared_task(time_limit=60*60)
+def collect_marketitem(stream):
+    """ collect_hisitem over twse and otc at once, records tagged by market,
+    order/limit applied on the merged records
+    """
+    before = counters()
+    args, kwargs = pickle.loads(stream)
+
+    opts = kwargs.pop('opts', ['twse', 'otc'])
+    targets = kwargs.pop('targets', [])
+    engine = kwargs.pop('engine', 'aggregate')
+    debug = kwargs.pop('debug', False)
+
+    item = {}
+    dbhandler = MarketHisDBHandler(opts, debug=debug, engine=engine)
+    for target in targets:
+        if target in hisitems:
+            dt = dbhandler.query_raw(target, **kwargs)
+            if dt:
+                item.update({target+'item': dt})
+
+    logger.info("collect_marketitem registry: %s" % (delta(before)))
+    return pickle.dumps(item)
+
+
+def collect_hisframe(opt, targets, starttime, endtime, base='stock', constraint=None, order=None, stockids=[], traderids=[], limit=10, callback=None, engine='aggregate', source='mongo', layout='panel', stream=False, cache=True, frequency='day', debug=False):
     """ raw his stock/toptrader/credit/future item to df
     <stockid>                                | <stockid> ...
                 open| high| financeused| top0|           open | ...
     20140928    100 | 101 | 0,2        | 100 |20140928 | 110  | ...
     20140929    100 | 102 | 0.3        | 200 |20140929 | 110  | ...
+    source: 'colstore' reads stock target of given stockids from local columnar store,
+            falls back to mongo when store is not built or stockids are not there
+    layout: 'panel' as above, 'frame' as long df indexed by (stockid, date)
+    stream: build frames from query_raw records one stock at a time
+    cache: reuse frames of the same query until the market data version changes
+    frequency: 'week'/'month' reads his targets from rollups, one row per period
     """
 
+    before = counters()
     group = []
-    dbhandler = hisdb_tasks[opt](debug=debug)
+    dbhandler = get_handler(hisdb_tasks[opt], debug=debug, engine=engine)
+    qcache = HisCache.get_cache(opt, dbhandler.version, debug=debug) if cache else None
     for target in targets:
+        if target == 'stock' and source == 'colstore' and stockids and frequency == 'day':
+            store = ColumnStore(opt=opt, debug=debug)
+            if store.exists():
+                df = store.to_pandas(stockids, starttime, endtime) if layout == 'panel' else store.to_frame(stockids, starttime, endtime)
+                if not df.empty:
+                    group.append(df)
+                    continue
         if target in hisitems:
             ptr = getattr(dbhandler, target)
-            cb = ptr.to_pandas
+            cb = ptr.to_pandas if layout == 'panel' else ptr.to_frame
             if target in ['trader']:
                 ptr.ids = stockids if base == 'stock' else traderids
                 args = (starttime, endtime, stockids, traderids, base, constraint, order, limit, cb)
             else:
                 ptr.ids = stockids
                 args = (starttime, endtime, stockids, base, constraint, order, limit, cb)
+            extra = {'frequency': frequency}
 
-            df = ptr.query_raw(*args)
+            key = make_key(opt, target, starttime, endtime, stockids, traderids, base, limit, constraint, order, engine=engine, layout=layout, fn='frame', **extra)
+            # trader alias pool for get_alias() rides along with its frame
+            hit = qcache.get(key) if qcache and key else None
+            if hit is None:
+                df = ptr.query_raw(*args, stream=stream, **extra)
+                if qcache and key:
+                    qcache.put(key, (df, getattr(ptr, '_cache', None)))
+            else:
+                df, aliases = hit
+                if aliases is not None:
+                    ptr._cache = aliases
             if not df.empty:
                 group.append(df)
                 
+    logger.info("collect_hisframe registry: %s" % (delta(before)))
+    if qcache:
+        logger.info("collect_hisframe cache: %s" % (qcache.stats))
+    if layout == 'frame':
+        if group:
+            return pd.concat(group, axis=1).fillna(0), dbhandler
+        return pd.DataFrame(), dbhandler
+
     if group:
         panel = pd.concat(group, axis=2).fillna(0)
         return panel, dbhandler
         
-    return pd.Panel(), dbhandler
\ No newline at end of file
+    return pd.Panel(), dbhandler
+
+
+def collect_hisarray(opt, targets, starttime, endtime, stockids=[], names=None, debug=False):
+    """ his targets as one dense (stockid, date, field) ndarray plus axis labels,
+    for cross-sectional jobs that work on the whole block instead of panel[stockid]
+    array[i, j, k] -> axes['stockid'][i] on axes['date'][j] of axes['field'][k], nan as missing
+    """
+    dbhandler = get_handler(hisdb_tasks[opt], debug=debug)
+    array, axes = dbhandler.to_array(stockids, starttime, endtime, targets, names)
+    return array, axes
+
+
+@shared_task(time_limit=60*60*4)
+def archive_his(opt, days=365*6, debug=False):
+    """ move his days older than days into the local cold archive,
+    queries reaching back further read through archive files
+    """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    dbhandler = get_handler(hisdb_tasks[opt], debug=debug)
+    result = {}
+    for target in hisitems:
+        ptr = getattr(dbhandler, target)
+        result[target] = ptr._archive.freeze(ptr.coll, cutoff)
+    # inverted toplist is derived, queries reaching the archive don't use it
+    dbhandler.trader._invcoll._get_collection().remove({'date': {'$lt': cutoff}})
+    logger.info("archive %s: %s" % (opt, result))
+    return pickle.dumps(result)
+
+
+@shared_task(time_limit=60*60)
+def build_colstore(opt, days=365*5, debug=False):
+    """ nightly rebuild local columnar store from his stock coll """
+    endtime = datetime.utcnow()
+    starttime = endtime - timedelta(days=days)
+    dbhandler = get_handler(hisdb_tasks[opt], debug=debug)
+    store = ColumnStore(opt=opt, debug=debug)
+    result = store.build(dbhandler.stock.coll, starttime, endtime, archive=dbhandler.stock._archive)
+    logger.info("colstore %s: %s" % (opt, result))
+    return pickle.dumps(result)
@@ -10,7 +10,36 @@ import timeit
 import unittest
 from datetime import datetime, timedelta
 from main.tests import NoSQLTestCase
+from mongoengine import Q
 from handler.tasks import *
+from handler.aggregate import *
+from bin.start import switch
+from bin.migrate import *
+from handler.hisdb_handler import build_state
+from handler.models import *
+from handler.colstore import ColumnStore
+from handler.frame import *
+from handler.idcache import IdCache
+from handler.nameindex import NameIndex
+from handler import registry
+from handler.hiscache import HisCache, make_key
+from handler.archive import encode, decode
+from handler.pipeline import run
+import shutil
+import time
+import threading
+from handler.async_handler import *
+from handler.market import MarketHisDBHandler, markets
+from handler import profiler
+from handler.profiler import read_log
+from bin.querystats import summarize
+from bin import indexes
+from bin import framebench
+import os
+import tempfile
+import pandas as pd
+import numpy as np
+from collections import OrderedDict
 from bson import json_util
 import json
 
@@ -22,12 +51,222 @@ import json
 # scrapy crawl twsehisfuture -s LOG_FILE=twsehisfuture.log -s GIANT_DEBUG=1 -s GIANT_LIMIT=1 -s LOG_LEVEL=DEBUG
 
 skip_tests = {
+    'TestTwseHisBulkInsert': False,
+    'TestTwseHisEngineDiff': False,
+    'TestTwseHisSpecQuery': False,
+    'TestTwseHisTraderInverted': False,
+    'TestTwseHisMigrate': False,
     'TestTwseHisItemQuery': False,
     'TestTwseHisFrameQuery': False,
+    'TestTwseHisColStore': False,
+    'TestHisFrameBuild': False,
+    'TestTwseIdCache': False,
+    'TestNameIndex': False,
+    'TestHandlerRegistry': False,
+    'TestTwseHisStreamQuery': False,
+    'TestTwseHisQueryCache': False,
+    'TestTwseHisSummary': False,
+    'TestTwseHisArray': False,
+    'TestTwseHisLatest': False,
+    'TestTwseHisRollup': False,
+    'TestTwseHisArchive': False,
+    'TestAsyncHandler': False,
+    'TestMarketHisQuery': False,
+    'TestQueryProfiler': False,
+    'TestIndexAdvisor': False,
+    'TestTwseHisRawPath': False,
+    'TestTwseHisProjection': False,
     'TestOtcHisItemQuery': False,
     'TestOtcHisFrameQuery': False
 }
 
+@unittest.skipIf(skip_tests['TestTwseHisBulkInsert'], "skip")
+class TestTwseHisBulkInsert(NoSQLTestCase):
+
+    def test_on_stock(self):
+        date = datetime(2015, 1, 5)
+        item = [{
+            'stockid': '2317', 'date': date,
+            'open': 10.0, 'high': 11.0, 'low': 9.0, 'close': 10.5, 'volume': 100
+        }]
+        dbhandler = TwseHisDBHandler(debug=True, bulk=True)
+        dbhandler.stock.coll.objects(Q(date=date) & Q(stockid='2317')).delete()
+        result = dbhandler.stock.insert_raw(item)
+        self.assertEqual(result, {'matched': 0, 'upserted': 1})
+        result = dbhandler.stock.insert_raw(item)
+        self.assertEqual(result, {'matched': 1, 'upserted': 0})
+        cursor = list(dbhandler.stock.coll.objects(Q(date=date) & Q(stockid='2317')))
+        self.assertEqual(len(cursor), 1)
+        self.assertEqual(cursor[0].data.close, 10.5)
+
+    def test_on_trader(self):
+        date = datetime(2015, 1, 5)
+        item = {
+            'stockid': '2317', 'date': date,
+            'toplist': [{
+                'traderid': '1590',
+                'data': {'avgbuyprice': 10.0, 'buyvolume': 10, 'avgsellprice': 0.0, 'sellvolume': 0, 'totalvolume': 10}
+            }]
+        }
+        dbhandler = TwseHisDBHandler(debug=True, bulk=True)
+        result = dbhandler.trader.insert_raw(item)
+        self.assertEqual(result['matched'] + result['upserted'], 1)
+        cursor = list(dbhandler.trader.coll.objects(Q(date=date) & Q(stockid='2317')))
+        self.assertEqual(cursor[0].toplist[0].traderid, '1590')
+
+
+@unittest.skipIf(skip_tests['TestTwseHisEngineDiff'], "skip")
+class TestTwseHisEngineDiff(NoSQLTestCase):
+    """ aggregate engine should return the same item as map_reduce """
+
+    def _diff(self, target, keys):
+        kwargs = {
+            'opt': 'twse',
+            'targets': [target],
+            'starttime': datetime.utcnow() - timedelta(days=5),
+            'endtime': datetime.utcnow(),
+            'stockids': ['2317', '2330'],
+            'base': 'stock',
+            'limit': 2,
+            'debug': True
+        }
+        items = {}
+        for engine in ['mapreduce', 'aggregate']:
+            kwargs.update({'engine': engine})
+            stream = pickle.dumps(((), dict(kwargs)))
+            item = pickle.loads(collect_hisitem.delay(stream).get())
+            items[engine] = sorted(item.get(target+'item', []), key=lambda x: (x['stockid'], x.get('traderid')))
+        self.assertEqual(len(items['mapreduce']), len(items['aggregate']))
+        for mr, ag in zip(items['mapreduce'], items['aggregate']):
+            for k in keys:
+                self.assertAlmostEqual(mr[k], ag[k], places=1)
+            self.assertEqual([i['date'] for i in mr['datalist']], [i['date'] for i in ag['datalist']])
+            if target == 'trader':
+                # templates read tradernm per data entry
+                for it in [mr, ag]:
+                    self.assertEqual(set(i['tradernm'] for i in it['datalist']), set([it['tradernm']]))
+
+    def test_on_stock(self):
+        self._diff('stock', ['totalvolume', 'totalhldiff', 'totalocdiff'])
+
+    def test_on_trader(self):
+        self._diff('trader', ['totalvolume', 'totalbuyvolume', 'totalsellvolume', 'totalkeepbuy'])
+
+    def test_on_credit(self):
+        self._diff('credit', ['totalfinanceremain', 'totalbearishremain'])
+
+    def test_on_future(self):
+        self._diff('future', ['totalvolume', 'totalhldiff', 'totalocdiff'])
+
+
+@unittest.skipIf(skip_tests['TestTwseHisSpecQuery'], "skip")
+class TestTwseHisSpecQuery(NoSQLTestCase):
+
+    def test_on_compile(self):
+        constraint = {'eclose': {'>': 30}, 'or': [{'edfcdiff': {'<': 0}}, {'stockid': '2317'}]}
+        query = compile_constraint(constraint, ['stockid'])
+        self.assertEqual(query['eclose'], {'$gt': 30})
+        self.assertEqual(query['$or'], [{'edfcdiff': {'$lt': 0}}, {'_id.stockid': {'$eq': '2317'}}])
+        order = compile_order(['-totalvolume', '+eclose'])
+        self.assertEqual(order.items(), [('totalvolume', -1), ('eclose', 1)])
+        stages, cb, ob = pushdown(constraint, ['-totalvolume'], 5, ['stockid'])
+        self.assertEqual([it.keys()[0] for it in stages], ['$match', '$sort', '$limit'])
+        self.assertTrue(cb is None and ob is None)
+        stages, cb, ob = pushdown(lambda x: True, ['-totalvolume'], 5, ['stockid'])
+        self.assertEqual(stages, [])
+        self.assertTrue(callable(cb) and callable(ob))
+        # unlimited scan sorts without $limit
+        stages, cb, ob = pushdown(None, ['-totalvolume'], None, ['stockid'])
+        self.assertEqual([it.keys()[0] for it in stages], ['$sort'])
+        # lambda order without limit keeps every result, sorted
+        results = [AggregateResult({'stockid': k}, {'totalvolume': v}) for k, v in [('a', 1), ('b', 3), ('c', 2)]]
+        items = list(select(iter(results), order=lambda x: -x.value['totalvolume'], limit=None))
+        self.assertEqual([it.key['stockid'] for it in items], ['b', 'c', 'a'])
+
+    def test_on_stock(self):
+        for engine in ['mapreduce', 'aggregate']:
+            stream = pickle.dumps(((), {
+                'opt': 'twse',
+                'targets': ['stock'],
+                'starttime': datetime.utcnow() - timedelta(days=5),
+                'endtime': datetime.utcnow(),
+                'stockids': ['2317', '2330'],
+                'base': 'stock',
+                'constraint': {'eclose': {'>': 0}, 'evolume': {'>': 0}},
+                'order': ['-totalvolume', '-eclose'],
+                'limit': 1,
+                'engine': engine,
+                'debug': True
+            }))
+            item = pickle.loads(collect_hisitem.delay(stream).get())
+            self.assertTrue(item)
+            self.assertEqual(len(item['stockitem']), 1)
+
+
+@unittest.skipIf(skip_tests['TestTwseHisTraderInverted'], "skip")
+class TestTwseHisTraderInverted(NoSQLTestCase):
+    """ base='trader' on inverted coll should return the same item as embedded toplist """
+
+    def test_on_parity(self):
+        starttime, endtime = datetime.utcnow() - timedelta(days=5), datetime.utcnow()
+        dbhandler = TwseHisDBHandler(debug=True)
+        dbhandler.trader.build_inverted(starttime, endtime)
+        kwargs = {
+            'starttime': starttime,
+            'endtime': endtime,
+            'traderids': ['1440', '1470'],
+            'base': 'trader',
+            'order': ['-totalvolume'],
+            'limit': 10
+        }
+        items = {}
+        for inverted in [False, True]:
+            dbhandler.trader.inverted = inverted
+            start = timeit.default_timer()
+            items[inverted] = sorted(dbhandler.trader.query_raw(**kwargs), key=lambda x: (x['traderid'], x['stockid']))
+            print "inverted: %s, %.4fs" % (inverted, timeit.default_timer() - start)
+        self.assertEqual(len(items[False]), len(items[True]))
+        for em, inv in zip(items[False], items[True]):
+            for k in ['totalvolume', 'totalbuyvolume', 'totalsellvolume', 'totalkeepbuy', 'totalbuyratio']:
+                self.assertAlmostEqual(em[k], inv[k], places=1)
+            self.assertEqual([i['date'] for i in em['datalist']], [i['date'] for i in inv['datalist']])
+
+    def test_on_backfill(self):
+        # read path stays on embedded toplist until backfill marks the inverted coll built
+        dbhandler = TwseHisDBHandler(debug=True)
+        invcoll = dbhandler.trader._invcoll
+        invcoll._get_db()['migrate_state'].remove({'_id': build_state(invcoll)['_id']})
+        self.assertFalse(dbhandler.trader.inverted)
+        states = backfill('twse', ['inverted'], debug=True)
+        self.assertTrue(states['inverted']['done'])
+        self.assertTrue(TwseHisDBHandler(debug=True).trader.inverted)
+
+
+@unittest.skipIf(skip_tests['TestTwseHisMigrate'], "skip")
+class TestTwseHisMigrate(NoSQLTestCase):
+
+    def test_on_migrate(self):
+        date = datetime(2015, 1, 5)
+        dbhandler = TwseHisDBHandler(debug=True)
+        src = switch(TwseHisColl, 'testtwsehisdb')
+        src.objects(Q(date=date) & Q(stockid='2317')).delete()
+        src(stockid='2317', date=date,
+            data=StockData(open=10.0, high=11.0, low=9.0, close=10.5, volume=100),
+            toplist=[TraderInfo(traderid='1590', data=TraderData(buyvolume=10, sellvolume=0, totalvolume=10))],
+            finance=CreditData(preremain=10, curremain=12, limit=100)).save()
+        stats = migrate('twse', batch=100, debug=True, restart=True)
+        self.assertTrue(stats['stock']['count'] > 0)
+        stock = list(dbhandler.stock.coll.objects(Q(date=date) & Q(stockid='2317')))
+        self.assertEqual(stock[0].data.close, 10.5)
+        trader = list(dbhandler.trader.coll.objects(Q(date=date) & Q(stockid='2317')))
+        self.assertEqual(trader[0].toplist[0].traderid, '1590')
+        self.assertEqual(trader[0].data.volume, 100)
+        credit = list(dbhandler.credit.coll.objects(Q(date=date) & Q(stockid='2317')))
+        self.assertEqual(credit[0].finance.curremain, 12)
+        future = list(dbhandler.future.coll.objects(Q(date=date) & Q(stockid='2317')))
+        self.assertEqual(len(future), 0)
+
+
 @unittest.skipIf(skip_tests['TestTwseHisItemQuery'], "skip")
 class TestTwseHisItemQuery(NoSQLTestCase):
 
@@ -168,6 +407,854 @@ class TestTwseHisFrameQuery(NoSQLTestCase):
         print panel['2317']
 
 
+@unittest.skipIf(skip_tests['TestTwseHisColStore'], "skip")
+class TestTwseHisColStore(NoSQLTestCase):
+
+    def test_on_build(self):
+        starttime, endtime = datetime.utcnow() - timedelta(days=5), datetime.utcnow()
+        dbhandler = TwseHisDBHandler(debug=True)
+        store = ColumnStore(opt='twse', debug=True)
+        result = store.build(dbhandler.stock.coll, starttime - timedelta(days=30), endtime)
+        self.assertTrue(result['rows'] > 0)
+        views = store.read(['2317'], starttime, endtime)
+        close = views['2317']['close']
+        # row slice shares the mmap buffer
+        self.assertTrue(close.base is not None)
+        self.assertEqual(len(close), len(store.dates(starttime, endtime)))
+        # small chunks stream into the same arrays
+        expect = np.array(close)
+        self.assertEqual(store.build(dbhandler.stock.coll, starttime - timedelta(days=30), endtime, chunk=7), result)
+        np.testing.assert_array_equal(store.read(['2317'], starttime, endtime)['2317']['close'], expect)
+
+    def test_on_frame(self):
+        kwargs = {
+            'opt': 'twse',
+            'targets': ['stock'],
+            'starttime': datetime.utcnow() - timedelta(days=5),
+            'endtime': datetime.utcnow(),
+            'stockids': ['2317'],
+            'limit': 1,
+            'debug': True
+        }
+        panels = {}
+        for source in ['mongo', 'colstore']:
+            kwargs.update({'source': source})
+            panels[source], _ = collect_hisframe(**kwargs)
+        for k in ['open', 'high', 'low', 'close', 'volume']:
+            self.assertEqual(list(panels['mongo']['2317'][k]), list(panels['colstore']['2317'][k]))
+
+
+@unittest.skipIf(skip_tests['TestHisFrameBuild'], "skip")
+class TestHisFrameBuild(NoSQLTestCase):
+    """ 1,000 stocks x 250 days query_raw items, row by row Panel vs long frame,
+    timing as bin/framebench.py
+    """
+
+    def test_on_equal(self):
+        cursor = framebench.fixture(1000, 250)
+        old = framebench.to_panel_rows(cursor)
+        df = to_frame(cursor, 'stockid')
+        new = to_panel(df)
+        self.assertEqual(len(df), 1000 * 250)
+        self.assertEqual(sorted(old.items), sorted(new.items))
+        for k in ['close', 'volume']:
+            self.assertEqual(list(old['0005'][k]), list(new['0005'][k]))
+            self.assertEqual(list(df.xs('0005', level=0)[k]), list(old['0005'][k]))
+
+    def test_on_trader(self):
+        cursor = [{
+            'stockid': '2317', 'traderid': t, 'alias': a,
+            'datalist': [{'date': datetime(2015, 1, 5), 'buyratio': 1.0, 'sellratio': 0.0, 'keepbuy': 1, 'keepsell': 0,
+                'avgbuyprice': 10.0, 'avgsellprice': 0.0, 'buyvolume': 10, 'sellvolume': 0}]
+        } for t, a in [('1440', 'top0'), ('1470', 'top1')]]
+        df = to_frame(cursor, 'stockid', names=['buyvolume', 'sellvolume'], prefix='alias')
+        self.assertEqual(len(df), 1)
+        self.assertEqual(sorted(df.columns), ['top0_buyvolume', 'top0_sellvolume', 'top1_buyvolume', 'top1_sellvolume'])
+        # a day only one alias traded is filled as 0, same as the unprefixed frame
+        cursor[1]['datalist'][0]['date'] = datetime(2015, 1, 6)
+        df = to_frame(cursor, 'stockid', names=['buyvolume', 'sellvolume'], prefix='alias')
+        self.assertEqual(len(df), 2)
+        self.assertFalse(df.isnull().values.any())
+        self.assertEqual(list(df['top1_buyvolume']), [0, 10])
+
+
+@unittest.skipIf(skip_tests['TestTwseIdCache'], "skip")
+class TestTwseIdCache(NoSQLTestCase):
+
+    def test_on_lookup(self):
+        IdCache.clear()
+        idhandler = TwseIdDBHandler(debug=True)
+        idhandler.stock.insert_raw([{'stockid': '2317', 'stocknm': u'鴻海', 'industry': u'', 'onmarket': u''}])
+        for i in range(200):
+            self.assertEqual(idhandler.stock.get_name('2317'), u'鴻海')
+            self.assertEqual(idhandler.stock.get_id(u'鴻海'), '2317')
+        self.assertTrue(idhandler.stock.has_id('2317'))
+        self.assertTrue(idhandler.stock.has_name(u'鴻海'))
+        self.assertEqual(idhandler.stock.cache.stats['loads'], 1)
+        # shared by handlers in the same process
+        self.assertTrue(TwseIdDBHandler(debug=True).stock.cache is idhandler.stock.cache)
+
+    def test_on_version(self):
+        IdCache.clear()
+        idhandler = TwseIdDBHandler(debug=True)
+        idhandler.trader.insert_raw([{'traderid': '9999', 'tradernm': u'test0'}])
+        self.assertEqual(idhandler.trader.get_name('9999'), u'test0')
+        idhandler.trader.insert_raw([{'traderid': '9999', 'tradernm': u'test1'}])
+        self.assertEqual(idhandler.trader.get_name('9999'), u'test1')
+        # own writes update the map in place
+        self.assertEqual(idhandler.trader.cache.stats['loads'], 1)
+        self.assertEqual(idhandler.trader.search(u'test1')[0][0], '9999')
+        idhandler.trader.coll.objects(traderid='9999').delete()
+
+
+@unittest.skipIf(skip_tests['TestNameIndex'], "skip")
+class TestNameIndex(NoSQLTestCase):
+
+    def setUp(self):
+        self.index = NameIndex([
+            ('2317', u'鴻海'), ('2330', u'台積電'), ('1590', u'花旗環球'), ('1470', u'台灣摩根')
+        ])
+
+    def test_on_search(self):
+        self.assertEqual(self.index.search(u'鴻海精密', 1)[0][0], '2317')
+        self.assertEqual(self.index.search(u'摩根台灣', 1)[0][0], '1470')
+        self.assertEqual(self.index.search(u'xyz'), [])
+
+    def test_on_prefix(self):
+        self.assertEqual([id for id, nm in self.index.prefix(u'台')], ['1470', '2330'])
+        self.assertEqual([id for id, nm in self.index.prefix('23')], ['2317', '2330'])
+
+    def test_on_update(self):
+        self.index.add('2317', u'鴻準')
+        self.assertEqual(self.index.search(u'鴻海', 1)[0][1], u'鴻準')
+        self.index.remove('2317')
+        self.assertEqual(self.index.prefix('23'), [('2330', u'台積電')])
+
+    def test_on_timing(self):
+        index = NameIndex(("%d" % (i), u''.join(unichr(0x4e00 + (i * 7 + j) % 3000) for j in range(4))) for i in range(5000))
+        start = timeit.default_timer()
+        for i in range(100):
+            index.search(u'一丁七万', 5)
+        print "search: %.4fms" % ((timeit.default_timer() - start) * 10)
+
+
+@unittest.skipIf(skip_tests['TestHandlerRegistry'], "skip")
+class TestHandlerRegistry(NoSQLTestCase):
+
+    def test_on_reuse(self):
+        registry.clear()
+        before = registry.counters()
+        db0 = registry.get_handler(OtcHisDBHandler, debug=True)
+        db1 = registry.get_handler(OtcHisDBHandler, debug=True)
+        self.assertTrue(db0 is db1)
+        counts = registry.delta(before)
+        self.assertEqual(counts['handler'], 1)
+        self.assertEqual(counts['handler_reuse'], 1)
+        # otc no longer builds twse his handlers first, sub handlers are lazy
+        self.assertFalse('subhandler' in counts)
+        db0.stock
+        db1.stock
+        self.assertEqual(registry.delta(before)['subhandler'], 1)
+
+    def test_on_thread(self):
+        # per-query state like the trader alias pool never crosses threads
+        db0 = registry.get_handler(OtcHisDBHandler, debug=True)
+        found = []
+        worker = threading.Thread(target=lambda: found.append(registry.get_handler(OtcHisDBHandler, debug=True)))
+        worker.start()
+        worker.join()
+        self.assertFalse(found[0] is db0)
+        self.assertTrue(registry.get_handler(OtcHisDBHandler, debug=True) is db0)
+
+    def test_on_frame(self):
+        kwargs = {
+            'opt': 'twse',
+            'targets': ['stock'],
+            'starttime': datetime.utcnow() - timedelta(days=5),
+            'endtime': datetime.utcnow(),
+            'stockids': ['2317'],
+            'debug': True
+        }
+        collect_hisframe(**kwargs)
+        before = registry.counters()
+        collect_hisframe(**kwargs)
+        counts = registry.delta(before)
+        self.assertFalse('handler' in counts)
+        self.assertFalse('connect' in counts)
+
+
+@unittest.skipIf(skip_tests['TestTwseHisStreamQuery'], "skip")
+class TestTwseHisStreamQuery(NoSQLTestCase):
+    """ streaming records should match the materialized ones """
+
+    def setUp(self):
+        self.dbhandler = TwseHisDBHandler(debug=True)
+        self.kwargs = {
+            'starttime': datetime.utcnow() - timedelta(days=5),
+            'endtime': datetime.utcnow(),
+            'stockids': ['2317', '2330', '1314'],
+            'limit': 10
+        }
+
+    def test_on_stock(self):
+        items = self.dbhandler.stock.query_raw(**self.kwargs)
+        stream = self.dbhandler.stock.query_raw(stream=True, **self.kwargs)
+        self.assertFalse(isinstance(stream, list))
+        stream = list(stream)
+        self.assertEqual([it['stockid'] for it in stream], sorted(it['stockid'] for it in items))
+        self.assertEqual(sorted(items), sorted(stream))
+
+    def test_on_order(self):
+        for order in [['-totalvolume'], lambda x: -x.value['totalvolume']]:
+            self.kwargs.update({'order': order, 'limit': 2})
+            items = self.dbhandler.stock.query_raw(**self.kwargs)
+            stream = list(self.dbhandler.stock.query_raw(stream=True, **self.kwargs))
+            self.assertEqual([it['stockid'] for it in items], [it['stockid'] for it in stream])
+            self.assertTrue(len(stream) <= 2)
+
+
+@unittest.skipIf(skip_tests['TestTwseHisQueryCache'], "skip")
+class TestTwseHisQueryCache(NoSQLTestCase):
+
+    def setUp(self):
+        HisCache.clear_all()
+        self.dbhandler = TwseHisDBHandler(debug=True)
+        self.kwargs = {
+            'opt': 'twse',
+            'targets': ['stock'],
+            'starttime': datetime.utcnow() - timedelta(days=5),
+            'endtime': datetime.utcnow(),
+            'stockids': ['2317', '2330'],
+            'debug': True
+        }
+
+    def test_on_hit(self):
+        collect_hisframe(**self.kwargs)
+        collect_hisframe(**self.kwargs)
+        stats = HisCache.get_cache('twse', self.dbhandler.version, debug=True).stats
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+        # stockid order doesn't change the key
+        self.kwargs['stockids'] = ['2330', '2317']
+        collect_hisframe(**self.kwargs)
+        self.assertEqual(HisCache.get_cache('twse', self.dbhandler.version, debug=True).stats['hits'], 2)
+
+    def test_on_stale(self):
+        cache = HisCache('twse', self.dbhandler.version)
+        cache.check = 0
+        key = make_key('twse', 'stock', self.kwargs['starttime'], self.kwargs['endtime'], ['2317'])
+        cache.put(key, 'item')
+        self.assertEqual(cache.get(key), 'item')
+        self.dbhandler.publish()
+        self.assertEqual(cache.get(key), None)
+        self.assertEqual(cache.stats['stales'], 1)
+
+    def test_on_evict(self):
+        cache = HisCache('twse', lambda: 0, maxsize=2)
+        for i in range(3):
+            cache.put(i, i)
+        cache.get(1)
+        cache.put(3, 3)
+        self.assertEqual(cache.get(0), None)
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(cache.get(1), 1)
+        self.assertEqual(cache.stats['evictions'], 2)
+
+    def test_on_copy(self):
+        cache = HisCache('twse', lambda: 0)
+        value = {'stockid': '2317', 'close': [10.0, 10.5]}
+        cache.put('key', value)
+        value['close'].append(11.0)
+        cache.get('key')['close'].append(12.0)
+        self.assertEqual(cache.get('key'), {'stockid': '2317', 'close': [10.0, 10.5]})
+
+
+@unittest.skipIf(skip_tests['TestTwseHisSummary'], "skip")
+class TestTwseHisSummary(NoSQLTestCase):
+    """ rolling windows updated day by day should match a full rebuild """
+
+    def setUp(self):
+        self.dbhandler = TwseHisDBHandler(debug=True, bulk=True)
+        self.dates = [datetime(2015, 1, 5) + timedelta(days=i) for i in range(7)]
+        self.item = [{
+            'stockid': '9999', 'date': date,
+            'open': 10.0, 'high': 11.0 + i, 'low': 9.0, 'close': 10.5, 'volume': 100 * (i + 1)
+        } for i, date in enumerate(self.dates)]
+        self.dbhandler.stock.coll.objects(stockid='9999').delete()
+        self.dbhandler.summary.coll.objects(stockid='9999').delete()
+
+    def _row(self, date, window):
+        return self.dbhandler.summary.coll.objects(Q(stockid='9999') & Q(date=date) & Q(window=window)).first()
+
+    def test_on_update(self):
+        for it in self.item:
+            self.dbhandler.stock.insert_raw([it])
+            self.dbhandler.summary.update([it])
+        row = self._row(self.dates[-1], 5)
+        self.assertEqual(row.totalvolume, sum(it['volume'] for it in self.item[-5:]))
+        self.assertEqual(row.totalhldiff, sum(it['high'] - it['low'] for it in self.item[-5:]))
+        row = self._row(self.dates[-1], 10)
+        self.assertEqual(row.totalvolume, sum(it['volume'] for it in self.item))
+
+        rolled = {(it.date, it.window): it.totalvolume for it in self.dbhandler.summary.coll.objects(stockid='9999')}
+        self.dbhandler.summary.coll.objects(stockid='9999').delete()
+        self.dbhandler.summary.build(self.dates[0], self.dates[-1], ['9999'])
+        built = {(it.date, it.window): it.totalvolume for it in self.dbhandler.summary.coll.objects(stockid='9999')}
+        self.assertEqual(rolled, built)
+
+    def test_on_backfill(self):
+        self.dbhandler.stock.insert_raw(self.item)
+        states = backfill('twse', ['summary'], debug=True, restart=True)
+        self.assertTrue(states['summary']['done'])
+        row = self._row(self.dates[-1], 5)
+        self.assertEqual(row.totalvolume, sum(it['volume'] for it in self.item[-5:]))
+
+    def test_on_query(self):
+        self.dbhandler.stock.insert_raw(self.item)
+        self.dbhandler.summary.update(self.item)
+        item = self.dbhandler.summary.query_raw(self.dates[0], self.dates[-1], ['9999'], window=5)
+        self.assertEqual(len(item), 1)
+        self.assertEqual(item[0]['date'], self.dates[-1])
+        self.assertEqual(item[0]['totalvolume'], sum(it['volume'] for it in self.item[-5:]))
+
+    def test_on_empty(self):
+        # a zero volume day is no window day, the 5 day window reaches one day further back
+        self.item[3]['volume'] = 0
+        self.dbhandler.stock.insert_raw(self.item)
+        self.dbhandler.summary.update(self.item)
+        self.assertEqual(self._row(self.dates[3], 1), None)
+        days = [it for it in self.item if it['volume'] > 0]
+        row = self._row(self.dates[-1], 5)
+        self.assertEqual(row.totalvolume, sum(it['volume'] for it in days[-5:]))
+        self.assertEqual(row.totalhldiff, sum(it['high'] - it['low'] for it in days[-5:]))
+
+
+@unittest.skipIf(skip_tests['TestTwseHisArray'], "skip")
+class TestTwseHisArray(NoSQLTestCase):
+
+    def setUp(self):
+        self.kwargs = {
+            'opt': 'twse',
+            'targets': ['stock', 'credit'],
+            'starttime': datetime.utcnow() - timedelta(days=10),
+            'endtime': datetime.utcnow(),
+            'stockids': ['2317', '2330', '0000'],
+            'debug': True
+        }
+
+    def test_on_shape(self):
+        array, axes = collect_hisarray(**self.kwargs)
+        self.assertEqual(array.shape, (3, len(axes['date']), len(axes['field'])))
+        self.assertEqual(axes['stockid'], ['2317', '2330', '0000'])
+        self.assertTrue(array.flags['C_CONTIGUOUS'])
+        # unknown stock stays on the axis as nan
+        self.assertTrue(np.isnan(array[2]).all())
+
+    def test_on_align(self):
+        array, axes = collect_hisarray(names=['close'], **self.kwargs)
+        self.assertEqual(axes['field'], ['close'])
+        dbhandler = TwseHisDBHandler(debug=True)
+        item = dbhandler.stock.query_raw(self.kwargs['starttime'], self.kwargs['endtime'], ['2317'])
+        for data in item[0]['datalist'] if item else []:
+            j = axes['date'].index(data['date'])
+            self.assertEqual(array[0, j, 0], data['close'])
+
+
+@unittest.skipIf(skip_tests['TestTwseHisLatest'], "skip")
+class TestTwseHisLatest(NoSQLTestCase):
+
+    def setUp(self):
+        self.dbhandler = TwseHisDBHandler(debug=True, bulk=True)
+        self.dates = [datetime(2015, 1, 5), datetime(2015, 1, 6)]
+        self.item = [{
+            'stockid': '9999', 'date': date,
+            'open': 10.0, 'high': 11.0, 'low': 9.0, 'close': 10.0 + i, 'volume': 100 + i
+        } for i, date in enumerate(self.dates)]
+        self.dbhandler.stock.coll.objects(stockid='9999').delete()
+        self.dbhandler.trader.coll.objects(stockid='9999').delete()
+        self.dbhandler.latest.coll.objects(stockid='9999').delete()
+
+    def test_on_update(self):
+        self.dbhandler.stock.insert_raw(self.item)
+        self.dbhandler.latest.update(self.item)
+        # older day landing later doesn't move the snapshot back
+        self.dbhandler.stock.insert_raw(self.item[:1])
+        self.dbhandler.latest.update(self.item[:1])
+        item = self.dbhandler.latest.snapshot(['9999'])
+        self.assertEqual(len(item), 1)
+        self.assertEqual(item[0]['date'], self.dates[-1])
+        self.assertEqual(item[0]['eclose'], 11.0)
+        self.assertEqual(item[0]['evolume'], 101)
+
+    def test_on_trader(self):
+        # trader part ships its e* scalars only, not the toplist array
+        self.dbhandler.stock.insert_raw(self.item)
+        self.dbhandler.trader.insert_raw({
+            'stockid': '9999', 'date': self.dates[-1],
+            'toplist': [{
+                'traderid': '1590',
+                'data': {'avgbuyprice': 10.0, 'buyvolume': 50, 'avgsellprice': 0.0, 'sellvolume': 0, 'totalvolume': 50}
+            }]
+        })
+        self.dbhandler.latest.update(self.item)
+        item = self.dbhandler.latest.snapshot(['9999'])
+        self.assertFalse('toplist' in item[0])
+        self.assertEqual(item[0]['ebuyratio'], round(50.0 / 101 * 100, 2))
+        self.assertFalse('toplist' in self.dbhandler.latest.coll._get_collection().find_one({'stockid': '9999'}))
+
+    def test_on_backfill(self):
+        self.dbhandler.stock.insert_raw(self.item)
+        states = backfill('twse', ['latest'], batch=50, debug=True, restart=True)
+        self.assertTrue(states['latest']['done'])
+        item = self.dbhandler.latest.snapshot(['9999'])
+        self.assertEqual(item[0]['date'], self.dates[-1])
+
+    def test_on_snapshot(self):
+        self.dbhandler.latest.build()
+        item = self.dbhandler.latest.snapshot(constraint={'evolume': {'>': 0}}, order=['-evolume'], limit=5)
+        self.assertTrue(len(item) <= 5)
+        self.assertEqual([it['evolume'] for it in item], sorted([it['evolume'] for it in item], reverse=True))
+
+
+@unittest.skipIf(skip_tests['TestTwseHisRollup'], "skip")
+class TestTwseHisRollup(NoSQLTestCase):
+
+    def setUp(self):
+        self.dbhandler = TwseHisDBHandler(debug=True, bulk=True)
+        # mon 2015/1/5 ~ tue 2015/1/13, two weeks in one month
+        self.dates = [datetime(2015, 1, 5) + timedelta(days=i) for i in range(9) if i not in [5, 6]]
+        self.item = [{
+            'stockid': '9999', 'date': date,
+            'open': 10.0 + i, 'high': 12.0 + i, 'low': 9.0 + i, 'close': 11.0 + i, 'volume': 100
+        } for i, date in enumerate(self.dates)]
+        for target in ['stock', 'trader', 'credit', 'future', 'rollup']:
+            getattr(self.dbhandler, target).coll.objects(stockid='9999').delete()
+
+    def test_on_update(self):
+        for it in self.item:
+            self.dbhandler.stock.insert_raw([it])
+            self.dbhandler.rollup.update([it])
+        weeks = list(self.dbhandler.rollup.coll.objects(Q(stockid='9999') & Q(frequency='week')).order_by('date'))
+        self.assertEqual([it.date for it in weeks], [datetime(2015, 1, 5), datetime(2015, 1, 12)])
+        self.assertEqual(weeks[0].data.open, 10.0)
+        self.assertEqual(weeks[0].data.close, 15.0)
+        self.assertEqual(weeks[0].data.high, 16.0)
+        self.assertEqual(weeks[0].data.volume, 500)
+        month = self.dbhandler.rollup.coll.objects(Q(stockid='9999') & Q(frequency='month')).first()
+        self.assertEqual(month.date, datetime(2015, 1, 1))
+        self.assertEqual(month.data.volume, 700)
+        self.assertEqual(month.enddate, self.dates[-1])
+
+    def _rows(self):
+        cursor = self.dbhandler.rollup.coll._get_collection().find({'stockid': '9999'}, {'_id': 0})
+        return {(it['date'], it['frequency']): it for it in cursor}
+
+    def test_on_delta(self):
+        # day by day deltas of every target should land on the same rows as a rebuild,
+        # a corrected day rebuilds its periods
+        for i, date in enumerate(self.dates):
+            self.dbhandler.stock.insert_raw([self.item[i]])
+            self.dbhandler.rollup.update([self.item[i]], 'stock')
+            item = {
+                'stockid': '9999', 'date': date,
+                'toplist': [{
+                    'traderid': '1590',
+                    'data': {'avgbuyprice': 10.0 + i, 'buyvolume': 10 + i, 'avgsellprice': 0.0, 'sellvolume': 0, 'totalvolume': 10 + i}
+                }]
+            }
+            self.dbhandler.trader.insert_raw(item)
+            self.dbhandler.rollup.update(item, 'trader')
+            item = [{
+                'stockid': '9999', 'date': date, 'type': k,
+                'preremain': 100 + i, 'curremain': 101 + i, 'buyvolume': 1, 'sellvolume': 0, 'daytrade': 0, 'limit': 1000
+            } for k in ['finance', 'bearish']]
+            self.dbhandler.credit.insert_raw(item)
+            self.dbhandler.rollup.update(item, 'credit')
+            item = [{
+                'stockid': '9999', 'date': date,
+                'open': 10.0 + i, 'high': 12.0 + i, 'low': 9.0 + i, 'close': 11.0 + i, 'volume': 10,
+                'price': 11.0 + i, 'setprice': 11.0, 'untrdcount': 0, 'bestbuy': 11.0, 'bestsell': 11.0
+            }]
+            self.dbhandler.future.insert_raw(item)
+            self.dbhandler.rollup.update(item, 'future')
+        self.item[2]['close'] = 20.0
+        self.dbhandler.stock.insert_raw([self.item[2]])
+        self.dbhandler.rollup.update([self.item[2]], 'stock')
+        deltas = self._rows()
+        self.dbhandler.rollup.coll.objects(stockid='9999').delete()
+        self.dbhandler.rollup.build(self.dates[0], self.dates[-1], ['9999'])
+        self.assertEqual(deltas, self._rows())
+
+    def test_on_backfill(self):
+        self.dbhandler.stock.insert_raw(self.item)
+        states = backfill('twse', ['rollup'], debug=True, restart=True)
+        self.assertTrue(states['rollup']['done'])
+        month = self.dbhandler.rollup.coll.objects(Q(stockid='9999') & Q(frequency='month')).first()
+        self.assertEqual(month.data.volume, 700)
+
+    def test_on_frequency(self):
+        self.dbhandler.stock.insert_raw(self.item)
+        self.dbhandler.rollup.build(self.dates[0], self.dates[-1], ['9999'])
+        item = self.dbhandler.stock.query_raw(self.dates[0], self.dates[-1], ['9999'], frequency='week')
+        self.assertEqual(len(item[0]['datalist']), 2)
+        self.assertEqual(item[0]['totalvolume'], 700)
+
+    def test_on_targets(self):
+        # trader/credit/future rollups read back through their own query_raw
+        self.dbhandler.stock.insert_raw(self.item)
+        for i, date in enumerate(self.dates):
+            self.dbhandler.trader.insert_raw({
+                'stockid': '9999', 'date': date,
+                'toplist': [{
+                    'traderid': '1590',
+                    'data': {'avgbuyprice': 10.0 + i, 'buyvolume': 10, 'avgsellprice': 0.0, 'sellvolume': 0, 'totalvolume': 10}
+                }]
+            })
+        self.dbhandler.credit.insert_raw([{
+            'stockid': '9999', 'date': date, 'type': k,
+            'preremain': 100 + i, 'curremain': 101 + i, 'buyvolume': 1, 'sellvolume': 0, 'daytrade': 0, 'limit': 1000
+        } for i, date in enumerate(self.dates) for k in ['finance', 'bearish']])
+        self.dbhandler.future.insert_raw([{
+            'stockid': '9999', 'date': date,
+            'open': 10.0 + i, 'high': 12.0 + i, 'low': 9.0 + i, 'close': 11.0 + i, 'volume': 10,
+            'price': 11.0 + i, 'setprice': 11.0, 'untrdcount': 0, 'bestbuy': 11.0, 'bestsell': 11.0
+        } for i, date in enumerate(self.dates)])
+        self.dbhandler.rollup.build(self.dates[0], self.dates[-1], ['9999'])
+        args = (self.dates[0], self.dates[-1], ['9999'])
+        item = self.dbhandler.trader.query_raw(*args, frequency='week')
+        self.assertEqual(len(item[0]['datalist']), 2)
+        self.assertEqual(item[0]['totalbuyvolume'], 70)
+        self.assertEqual(item[0]['datalist'][0]['avgbuyprice'], 12.0)
+        item = self.dbhandler.credit.query_raw(*args, frequency='month')
+        self.assertEqual(len(item[0]['datalist']), 1)
+        self.assertEqual(item[0]['datalist'][0]['financebuyvolume'], 7)
+        item = self.dbhandler.future.query_raw(*args, frequency='week')
+        self.assertEqual(len(item[0]['datalist']), 2)
+        self.assertEqual(item[0]['totalvolume'], 70)
+        # collect_hisframe routes frequency to every his target
+        kwargs = {
+            'opt': 'twse', 'targets': ['trader', 'credit', 'future'], 'starttime': self.dates[0], 'endtime': self.dates[-1],
+            'stockids': ['9999'], 'frequency': 'week', 'cache': False, 'layout': 'frame', 'debug': True
+        }
+        df, dbhandler = collect_hisframe(**kwargs)
+        self.assertEqual(len(df.loc['9999']), 2)
+
+
+@unittest.skipIf(skip_tests['TestTwseHisArchive'], "skip")
+class TestTwseHisArchive(NoSQLTestCase):
+    """ queries crossing the archive cutoff should see the same series as before freeze """
+
+    def setUp(self):
+        self.dbhandler = TwseHisDBHandler(debug=True, bulk=True)
+        self.coll = self.dbhandler.stock.coll
+        self.archive = self.dbhandler.stock._archive
+        shutil.rmtree(self.archive._dir(self.coll), ignore_errors=True)
+        self.dates = [datetime(2001, 1, 29) + timedelta(days=i) for i in range(6)]
+        self.item = [{
+            'stockid': '9999', 'date': date,
+            'open': 10.0, 'high': 11.0, 'low': 9.0, 'close': 10.0 + i, 'volume': 100 + i
+        } for i, date in enumerate(self.dates)]
+        self.coll.objects(stockid='9999').delete()
+        self.dbhandler.stock.insert_raw(self.item)
+
+    def tearDown(self):
+        shutil.rmtree(self.archive._dir(self.coll), ignore_errors=True)
+
+    def test_on_encode(self):
+        docs = [{
+            'stockid': '9999', 'date': datetime(2001, 1, 2), '_cls': 'HisTraderColl.TwseHisTraderColl',
+            'toplist': [{'traderid': '1590', 'data': {'buyvolume': 10, 'avgbuyprice': 1.5}}]
+        }, {
+            'stockid': '9998', 'date': datetime(2001, 1, 3), '_cls': 'HisTraderColl.TwseHisTraderColl',
+            'data': {'close': 10.5, 'volume': 3}, 'toplist': []
+        }]
+        self.assertEqual(decode(encode(docs)), docs)
+
+    def test_on_pipeline(self):
+        docs = [{
+            'stockid': '9999', 'date': date, 'data': {'high': 11.0, 'low': 9.0 + i, 'volume': 100 + i},
+            'toplist': [{'traderid': '1590', 'data': {'buyvolume': i}}]
+        } for i, date in enumerate(self.dates)]
+        stages = [
+            {'$match': {'date': {'$gte': self.dates[1]}, 'toplist.traderid': {'$in': ['1590']}}},
+            {'$sort': {'date': -1}},
+            {'$project': {'stockid': 1, 'data': 1, 'hldiff': absolute({'$subtract': ['$data.low', '$data.high']})}},
+            {'$group': {
+                '_id': {'stockid': '$stockid'},
+                'evolume': {'$first': '$data.volume'},
+                'totalhldiff': {'$sum': '$hldiff'},
+                'data': {'$push': {'volume': '$data.volume', 'missing': '$data.close'}}
+            }},
+            {'$match': {'totalhldiff': {'$gt': 0}}}
+        ]
+        self.assertEqual(list(run(docs, stages)), [{
+            '_id': {'stockid': '9999'}, 'evolume': 105, 'totalhldiff': 7.0,
+            'data': [{'volume': 100 + i} for i in range(5, 0, -1)]
+        }])
+        for stage in [{'$lookup': {}}, {'$skip': 1}, {'$project': {'x': {'$abs': '$data.low'}}}]:
+            with self.assertRaises(ValueError):
+                list(run(docs, [stage]))
+
+    def test_on_parity(self):
+        # a cutoff past the window with no partition thaws only hot docs,
+        # so each target runs its pipeline in process on what the server aggregates
+        starttime, endtime = datetime.utcnow() - timedelta(days=10), datetime.utcnow()
+        specs = {
+            'stock': ({'totalvolume': {'>': 0}}, ['-totalvolume']),
+            'trader': ({'totalvolume': {'>': 0}}, ['-totalvolume']),
+            'credit': ({'totalfinanceremain': {'>': 0}}, ['-totalfinanceremain']),
+            'future': ({'totalvolume': {'>': 0}}, ['-totalvolume'])
+        }
+        for target, (constraint, order) in specs.items():
+            handler = getattr(self.dbhandler, target)
+            archive, handler._archive = handler._archive, None
+            kwargs = {
+                'starttime': starttime, 'endtime': endtime, 'stockids': ['2317', '2330', '1314'],
+                'constraint': constraint, 'order': order, 'limit': 3
+            }
+            try:
+                server = handler.query_raw(**kwargs)
+                if not os.path.exists(archive._dir(handler.coll)):
+                    os.makedirs(archive._dir(handler.coll))
+                archive._set_cutoff(handler.coll, datetime(2100, 1, 1))
+                handler._archive = archive
+                self.assertEqual(handler.query_raw(**kwargs), server, target)
+            finally:
+                handler._archive = archive
+                shutil.rmtree(archive._dir(handler.coll), ignore_errors=True)
+
+    def test_on_read_through(self):
+        kwargs = {'starttime': self.dates[0], 'endtime': self.dates[-1], 'stockids': ['9999']}
+        before = self.dbhandler.stock.query_raw(**kwargs)
+        raw = list(self.dbhandler.stock.find_raw(self.dates[0], self.dates[-1], ['9999']))
+        array, axes = self.dbhandler.to_array(['9999'], self.dates[0], self.dates[-1])
+        names = set(self.coll._get_db().collection_names())
+        result = self.archive.freeze(self.coll, datetime(2001, 2, 1))
+        self.assertEqual(result['docs'], 3)
+        self.assertEqual(self.coll.objects(stockid='9999').count(), 3)
+        after = self.dbhandler.stock.query_raw(**kwargs)
+        self.assertEqual(before, after)
+        # archived months merge in memory, no scratch coll on the read path
+        self.assertEqual(set(self.coll._get_db().collection_names()), names)
+        # every read path goes through the same archive check
+        mapreduce = TwseHisDBHandler(debug=True, bulk=True, engine='mapreduce')
+        self.assertEqual(mapreduce.stock.query_raw(**kwargs), after)
+        self.assertEqual(list(self.dbhandler.stock.find_raw(self.dates[0], self.dates[-1], ['9999'])), raw)
+        thawed, thawedaxes = self.dbhandler.to_array(['9999'], self.dates[0], self.dates[-1])
+        np.testing.assert_array_equal(thawed, array)
+        self.assertEqual(thawedaxes, axes)
+        store = ColumnStore(opt='twse', debug=True)
+        result = store.build(self.coll, self.dates[0], self.dates[-1], archive=self.archive)
+        self.assertEqual(result['rows'], len(self.dates))
+        self.assertEqual(list(store.read(['9999'])['9999']['close']), [it['close'] for it in self.item])
+        # window after cutoff stays on hot coll
+        kwargs['starttime'] = datetime(2001, 2, 1)
+        self.assertEqual(len(self.dbhandler.stock.query_raw(**kwargs)[0]['datalist']), 3)
+
+
+@unittest.skipIf(skip_tests['TestAsyncHandler'], "skip")
+class TestAsyncHandler(NoSQLTestCase):
+
+    def setUp(self):
+        self.db = AsyncHisDBHandler(TwseHisDBHandler, debug=True)
+        self.args = (datetime.utcnow() - timedelta(days=5), datetime.utcnow(), ['2317', '2330'])
+
+    def test_on_query(self):
+        targets = ['stock', 'credit', 'future']
+        items = gather([self.db.query_raw(target, *self.args) for target in targets])
+        for target, item in zip(targets, items):
+            self.assertEqual(item, getattr(self.db.db, target).query_raw(*self.args))
+        panel = self.db.to_pandas('stock', *self.args).result()
+        self.assertEqual(sorted(panel.items), sorted(self.db.db.stock.to_pandas(self.db.db.stock.query_raw(*self.args)).items))
+
+    def test_on_fanout(self):
+        # wall clock bounded by the slowest call, not the sum
+        start = time.time()
+        gather([self.db.submit(time.sleep, 0.2) for i in range(4)])
+        self.assertTrue(time.time() - start < 0.6)
+
+    def test_on_isolation(self):
+        # pooled queries run on their worker handler, the caller alias pool stays its own
+        self.assertFalse(self.db.submit(lambda: self.db.db).result() is self.db.db)
+        trader = self.db.db.trader
+        item = trader.query_raw(*self.args)
+        gather([self.db.query_raw('trader', self.args[0], self.args[1], ['2330']) for i in range(4)])
+        self.assertEqual(list(trader.get_alias(base='stock', aliases=['top0'])), [it['stockid'] for it in item[:1]])
+
+    def test_on_error(self):
+        with self.assertRaises(AttributeError):
+            gather([self.db.query_raw('stock', *self.args), self.db.submit(getattr, object(), 'missing')])
+
+    def test_on_id(self):
+        db = AsyncIdDBHandler(TwseIdDBHandler, debug=True)
+        self.assertEqual(db.call('stock', 'get_name', '2317').result(), db.db.stock.get_name('2317'))
+
+
+@unittest.skipIf(skip_tests['TestMarketHisQuery'], "skip")
+class TestMarketHisQuery(NoSQLTestCase):
+
+    def test_on_stock(self):
+        stream = pickle.dumps(((), {
+            'targets': ['stock'],
+            'starttime': datetime.utcnow() - timedelta(days=5),
+            'endtime': datetime.utcnow(),
+            'stockids': ['2317', '2330', '5371', '8086'],
+            'order': ['-totalvolume'],
+            'limit': 3,
+            'debug': True
+        }))
+        item = pickle.loads(collect_marketitem.delay(stream).get())
+        self.assertTrue(len(item['stockitem']) <= 3)
+        volumes = [it['totalvolume'] for it in item['stockitem']]
+        self.assertEqual(volumes, sorted(volumes, reverse=True))
+        self.assertTrue(all(it['market'] in ['twse', 'otc'] for it in item['stockitem']))
+
+    def test_on_merge(self):
+        db = MarketHisDBHandler(debug=True)
+        args = (datetime.utcnow() - timedelta(days=5), datetime.utcnow(), ['2317', '5371'])
+        item = db.query_raw('stock', *args, limit=None)
+        for opt in ['twse', 'otc']:
+            ids = [it['stockid'] for it in db.market(opt).stock.query_raw(*args)]
+            self.assertEqual(sorted(ids), sorted(it['stockid'] for it in item if it['market'] == opt))
+
+    def test_on_top(self):
+        # otc holds the global top row, twse records come first in merge order
+        date = datetime(2015, 1, 5)
+        volumes = {'twse': ('9998', 100, 20.0), 'otc': ('9999', 500, 10.5)}
+        for opt, (stockid, volume, close) in volumes.items():
+            dbhandler = markets[opt](debug=True, bulk=True)
+            dbhandler.stock.insert_raw([{
+                'stockid': stockid, 'date': date,
+                'open': 10.0, 'high': 21.0, 'low': 9.0, 'close': close, 'volume': volume
+            }])
+        db = MarketHisDBHandler(debug=True)
+        try:
+            item = db.query_raw('stock', date, date, ['9998', '9999'], order=['-totalvolume'], limit=1)
+            self.assertEqual([(it['market'], it['stockid']) for it in item], [('otc', '9999')])
+            # e* order fields are not record fields of their own, they ride along for the merge
+            item = db.query_raw('stock', date, date, ['9998', '9999'], order=['-eclose'], limit=2)
+            self.assertEqual([(it['market'], it['stockid'], it['eclose']) for it in item], [('twse', '9998', 20.0), ('otc', '9999', 10.5)])
+        finally:
+            for opt, (stockid, volume, close) in volumes.items():
+                db.market(opt).stock.coll.objects(Q(date=date) & Q(stockid=stockid)).delete()
+
+
+@unittest.skipIf(skip_tests['TestQueryProfiler'], "skip")
+class TestQueryProfiler(NoSQLTestCase):
+
+    def setUp(self):
+        self._settings = dict(profiler.settings)
+        self._path = tempfile.mkdtemp()
+        profiler.settings.update({'enabled': True, 'path': os.path.join(self._path, 'queries.log'), 'threshold': 0})
+
+    def tearDown(self):
+        profiler.settings.update(self._settings)
+        shutil.rmtree(self._path)
+
+    def test_on_stock(self):
+        dbhandler = TwseHisDBHandler(debug=True)
+        starttime, endtime = datetime.utcnow() - timedelta(days=5), datetime.utcnow()
+        item = dbhandler.stock.query_raw(starttime, endtime, ['2317', '2330'])
+        list(dbhandler.stock.query_raw(starttime, endtime, ['2317'], stream=True))
+        records = list(read_log())
+        self.assertEqual(len(records), 2)
+        self.assertEqual([it['stockids'] for it in records], [2, 1])
+        self.assertEqual(records[0]['target'], 'stock')
+        self.assertEqual(records[0]['window'], 5)
+        self.assertEqual(records[0]['returned'], len(item))
+        self.assertTrue('explain' in records[0])
+        # per query count from explain, the serverStatus delta is kept apart
+        self.assertEqual(records[0]['examined'], records[0]['explain']['examined'])
+        self.assertTrue('server_examined' in records[0])
+        stats = summarize(records)
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(sum(it['count'] for it in stats), 2)
+
+
+@unittest.skipIf(skip_tests['TestIndexAdvisor'], "skip")
+class TestIndexAdvisor(NoSQLTestCase):
+
+    def test_on_provision(self):
+        indexes.provision('twse', debug=True)
+        self.assertEqual(indexes.advise('twse', debug=True), [])
+        coll = TwseHisDBHandler(debug=True).trader.coll
+        names = [it['key'] for it in coll._get_collection().index_information().values()]
+        self.assertTrue([('toplist.traderid', 1), ('date', 1)] in names)
+
+    def test_on_cls(self):
+        # raw his reads carry no _cls, an index led by it doesn't serve them
+        self.assertFalse(indexes.covered([('stockid', 1), ('date', 1)], [[('_cls', 1), ('stockid', 1), ('date', 1)]]))
+        coll = TwseHisDBHandler(debug=True).stock.coll
+        self.assertTrue(all('_cls' not in dict(keys) for keys in indexes.needed(coll, 'stock')))
+
+    def test_on_bench(self):
+        rows = indexes.bench(stocks=20, days=30, repeat=1, debug=True)
+        self.assertEqual(len(rows), 6)
+        self.assertTrue(all(it[3] > 0 for it in rows))
+
+
+@unittest.skipIf(skip_tests['TestTwseHisRawPath'], "skip")
+class TestTwseHisRawPath(NoSQLTestCase):
+
+    def test_on_stock(self):
+        date = datetime(2015, 1, 5)
+        dbhandler = TwseHisDBHandler(debug=True, bulk=True)
+        dbhandler.stock.insert_raw([
+            {'stockid': stockid, 'date': date, 'open': 10.0, 'high': 11.0, 'low': 9.0, 'close': close, 'volume': 100}
+            for stockid, close in [('2317', 10.5), ('2330', 20.5)]])
+        item = list(dbhandler.stock.find_raw(date, date, ['2330', '2317']))
+        self.assertEqual([it['stockid'] for it in item], ['2317', '2330'])
+        self.assertEqual(sorted(item[0].keys()), ['data', 'date', 'stockid'])
+        orm = list(dbhandler.stock.coll.objects(Q(date=date) & Q(stockid='2317')))
+        self.assertEqual(item[0]['data']['close'], orm[0].data.close)
+        columns = dbhandler.stock.to_columns(date, date, ['2317', '2330'], fields=['data.close', 'data.volume'])
+        self.assertEqual(columns.keys(), ['stockid', 'date', 'data.close', 'data.volume'])
+        self.assertEqual(list(columns['data.close']), [10.5, 20.5])
+
+
+@unittest.skipIf(skip_tests['TestTwseHisProjection'], "skip")
+class TestTwseHisProjection(NoSQLTestCase):
+
+    def setUp(self):
+        self._settings = dict(profiler.settings)
+        self._path = tempfile.mkdtemp()
+        profiler.settings.update({'enabled': True, 'path': os.path.join(self._path, 'queries.log')})
+
+    def tearDown(self):
+        profiler.settings.update(self._settings)
+        shutil.rmtree(self._path)
+
+    def test_on_stock(self):
+        dbhandler = TwseHisDBHandler(debug=True)
+        args = (datetime.utcnow() - timedelta(days=5), datetime.utcnow(), ['2317', '2330'])
+        item = dbhandler.stock.query_raw(*args, limit=None)
+        ids = [it['stockid'] for it in item]
+        item = dbhandler.stock.query_raw(*args, limit=None, fields=['data.close', 'data.volume'])
+        self.assertEqual(sorted(ids), sorted(it['stockid'] for it in item))
+        for it in item:
+            self.assertTrue(all('open' not in data and 'close' in data for data in it['datalist']))
+        records = list(read_log())
+        self.assertEqual(len(records), 2)
+        if ids:
+            self.assertTrue(records[1]['bytes'] < records[0]['bytes'])
+
+    def test_on_check(self):
+        # a projection without the raw paths a spec is computed from fails loud, not as zero sums
+        dbhandler = TwseHisDBHandler(debug=True)
+        args = (datetime.utcnow() - timedelta(days=5), datetime.utcnow(), ['2317', '2330'])
+        dbhandler.stock.query_raw(*args, constraint={'totalvolume': {'>': 0}}, order=['-eclose'], fields=['data.close', 'data.volume'])
+        with self.assertRaises(ValueError):
+            dbhandler.stock.query_raw(*args, order=['-totalhldiff'], fields=['data.close'])
+        with self.assertRaises(ValueError):
+            TwseHisDBHandler(debug=True, engine='mapreduce').stock.query_raw(*args, fields=['data.close'])
+        stream = pickle.dumps(((), {
+            'opt': 'twse', 'targets': ['stock'], 'starttime': args[0], 'endtime': args[1], 'stockids': args[2],
+            'fields': {'stock': ['data.close']}, 'engine': 'mapreduce', 'debug': True
+        }))
+        with self.assertRaises(ValueError):
+            collect_hisitem(stream)
+
+
 @unittest.skipIf(skip_tests['TestOtcHisItemQuery'], "skip")
 class TestOtcHisItemQuery(NoSQLTestCase):
 
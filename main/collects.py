@@ -40,12 +40,16 @@ def create_search_collect(request):
 
 def create_autocmp_collect(request):
     opt = None
+    term = None
 
     if 'opt' in request.GET and request.GET['opt']:
         opt = request.GET['opt']
+    if 'term' in request.GET and request.GET['term']:
+        term = request.GET['term']
 
     collect = {
         'opt': opt,
+        'term': term,
         #'debug': settings.DEBUG,
         'debug': False
     }
@@ -2,10 +2,15 @@
 from routers.loader import Loader
 from datetime import datetime, timedelta
 from main.models import *
+from handler.tasks import search_iditem
 
 def schedule_autocmp_tasks(**collect):
     opt = collect.pop('opt', 'twse')
     debug = collect.pop('debug', False)
+    term = collect.pop('term', None)
+    # typed term goes to the in-process name index
+    if term:
+        return search_iditem(opt, term, debug=debug)
     ends = autocmp['AllIdAutoCmp'][1][opt][0]
     tmps = autocmp['AllIdAutoCmp'][1]['otc'] if opt == 'twse' else autocmp['AllIdAutoCmp'][1]['twse']
     cuts = []
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import os
+from twisted.internet import defer
+from twisted.trial import unittest
+from crawler.captchapool import CaptchaPool, get_pool
+
+path = './crawler/spiders/train'
+
+
+class TestCaptchaPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = CaptchaPool(workers=2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    @defer.inlineCallbacks
+    def test_on_solve(self):
+        # whole captcha bodies as the spiders download them, text as read in process
+        tests = [
+            ('twse0', 'twse_test0.jpeg', 'HKYAX'),
+            ('twse1', 'twse_test0.jpeg', 'HKYAX'),
+            ('twse2', 'twse_test0.jpeg', 'HKYAX'),
+            ('otc1', 'otc_test0.png', 'AFDXF')
+        ]
+        ds = []
+        for solver, name, exp in tests:
+            with open(os.path.join(path, name), 'rb') as f:
+                ds.append(self.pool.submit(solver, f.read()))
+        self.assertEqual(self.pool.depth, 4)
+        texts = yield defer.gatherResults(ds)
+        self.assertEqual(texts, [exp for solver, name, exp in tests])
+        self.assertEqual(self.pool.depth, 0)
+        self.assertEqual(self.pool.stats['solved'], 4)
+        self.assertEqual(self.pool.stats['depth_max'], 4)
+
+    def test_on_shutdown(self):
+        pool = get_pool(3)
+        self.assertTrue(get_pool(3) is pool)
+        pool.shutdown()
+        self.assertFalse(get_pool(3) is pool)
+        get_pool(3).shutdown()
+
+    @defer.inlineCallbacks
+    def test_on_fail(self):
+        with self.assertRaises(KeyError):
+            yield self.pool.submit('unknown', '')
+        self.assertEqual(self.pool.stats['failed'], 1)
+        self.assertEqual(self.pool.depth, 0)